@@ -0,0 +1,266 @@
+import copy
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from lib.synthetic_corpus import ZipfCorpus
+from lib.featurize_document import main as featurize_document
+from lib.tree_store import TreeStore
+from lib.batch_files import write_batch
+from lib.constants import TARGET_DICTIONARY_COUNT
+import argparse  # Import argparse for command-line parsing
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARK_VERSION = 1
+
+def peak_rss_kb(rusage):
+    # Linux reports ru_maxrss in kilobytes, macOS in bytes.
+    return rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+
+def measure(run, setup=None, repeat=1):
+    """Fastest of `repeat` runs, in seconds, and what the last run returned. Setup isn't timed."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        result = run(argument) if setup else run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def stage_benchmarks(words, corpus, repeat, directory):
+    """Time each training and merging stage on its own for a corpus of `words` words."""
+    # Imported here because importing merge_batches creates training directories in the working directory
+    from lib.create_dictionary import create_dictionary, remove_scores_and_flatten_predictions
+    from lib.tokenizer import Tokenizer
+    from lib.merge_batches import merge, prune, kway_merge
+
+    results = []
+    def record(stage, seconds, word_count=words, **extra):
+        result = {"stage": stage, "words": words, "seconds": round(seconds, 6)}
+        if word_count:
+            result["words_per_second"] = round(word_count / seconds) if seconds else None
+        result["peak_rss_kb"] = peak_rss_kb(resource.getrusage(resource.RUSAGE_SELF))
+        result.update(extra)
+        results.append(result)
+        print(f"{stage:>16} {words:>12,} words {seconds:10.3f}s")
+
+    seconds, documents = measure(lambda: [document.split() for document in corpus.documents(words)])
+    record("generate", seconds)
+
+    seconds, windows = measure(lambda: [featurize_document(document) for document in documents], repeat=repeat)
+    record("featurize", seconds)
+
+    def file_windows(tree_store):
+        add = tree_store.add
+        for document_windows in windows:
+            for anchor, first_clause, second_clause, predictive_words in document_windows:
+                add(anchor, first_clause, second_clause, predictive_words)
+        return tree_store
+    seconds, tree_store = measure(file_windows, setup=TreeStore, repeat=repeat)
+    record("file", seconds, anchors=len(tree_store), contexts=len(tree_store.leaves))
+
+    def create_batch(path):
+        pruned_tree = create_dictionary(tree_store.to_nested_dict(TARGET_DICTIONARY_COUNT), TARGET_DICTIONARY_COUNT)
+        write_batch(pruned_tree, path)
+        return pruned_tree
+    batch_paths = [os.path.join(directory, f"batch_{words}_0.batch")]
+    seconds, batch = measure(lambda: create_batch(batch_paths[0]), repeat=repeat)
+    record("create_batch", seconds, batch_bytes=os.path.getsize(batch_paths[0]))
+
+    # A second batch from different documents of the same size to merge with
+    other_corpus = ZipfCorpus(len(corpus.vocabulary), corpus.exponent, corpus.seed + 1)
+    other_store = TreeStore()
+    for document in other_corpus.documents(words):
+        for window in featurize_document(document.split()):
+            other_store.add(*window)
+    other_batch = create_dictionary(other_store.to_nested_dict(TARGET_DICTIONARY_COUNT), TARGET_DICTIONARY_COUNT)
+    batch_paths.append(os.path.join(directory, f"batch_{words}_1.batch"))
+    write_batch(other_batch, batch_paths[1])
+
+    seconds, merged = measure(lambda trees: merge(*trees), setup=lambda: (copy.deepcopy(batch), copy.deepcopy(other_batch)), repeat=repeat)
+    record("merge", seconds, word_count=None)
+
+    seconds, pruned = measure(lambda tree: prune(tree, TARGET_DICTIONARY_COUNT), setup=lambda: copy.deepcopy(merged), repeat=repeat)
+    record("prune", seconds, word_count=None)
+
+    seconds, _ = measure(lambda: kway_merge(batch_paths, TARGET_DICTIONARY_COUNT), repeat=repeat)
+    record("kway_merge", seconds, word_count=None, batches=len(batch_paths))
+
+    def tokenize(tree):
+        tree = remove_scores_and_flatten_predictions(tree)
+        tokenizer = Tokenizer()
+        tokenizer.fit(tree)
+        return tokenizer.tokenize(tree)
+
+    seconds, _ = measure(tokenize, setup=lambda: copy.deepcopy(pruned), repeat=repeat)
+    record("tokenize", seconds, word_count=None)
+
+    return results
+
+# Runs a script or module the way python would, then records the peak RSS of the new process image.
+# A child's ru_maxrss also counts whatever its parent had resident when it forked, VmHWM doesn't.
+PEAK_RSS_WRAPPER = """
+import atexit, runpy, sys
+report_path, kind, target = sys.argv[1:4]
+def report():
+    try:
+        with open('/proc/self/status') as status:
+            peak = next(line.split()[1] for line in status if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        return
+    with open(report_path, 'w') as f:
+        f.write(peak)
+atexit.register(report)
+sys.argv = [target] + sys.argv[4:]
+if kind == 'module':
+    runpy.run_module(target, run_name='__main__', alter_sys=True)
+else:
+    sys.path.insert(0, __import__('os').path.dirname(target))
+    runpy.run_path(target, run_name='__main__')
+"""
+
+def run_and_measure(kind, target, arguments, cwd):
+    """Run a script or module, returning its wall time and peak RSS. Its output is thrown away."""
+    env = dict(os.environ, PYTHONPATH=REPOSITORY + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    report_path = os.path.join(cwd, '.peak_rss')
+    command = [sys.executable, '-c', PEAK_RSS_WRAPPER, report_path, kind, target] + arguments
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{target} {' '.join(arguments)} exited with {process.returncode}")
+
+    if os.path.exists(report_path):
+        with open(report_path) as f:
+            peak = int(f.read())
+        os.remove(report_path)
+        return elapsed, peak
+    # No /proc: fall back to the less exact figure
+    return elapsed, peak_rss_kb(rusage)
+
+def end_to_end_benchmarks(words, prune_frequencies, corpus, directory):
+    """Run train.py on a synthetic corpus, then merge and tokenize, once per prune frequency."""
+    corpus_directory = os.path.join(directory, "corpus")
+    corpus.write(corpus_directory, words)
+
+    results = []
+    for prune_frequency in prune_frequencies:
+        run_directory = os.path.join(directory, f"run_{prune_frequency}")
+        os.makedirs(run_directory)
+
+        train_seconds, train_rss = run_and_measure(
+            'script', os.path.join(REPOSITORY, 'train.py'),
+            ['--source', 'local', '--corpus', corpus_directory, '--prune-frequency', str(prune_frequency)],
+            run_directory,
+        )
+        batches = len(os.listdir(os.path.join(run_directory, 'training', 'batches')))
+        merge_seconds, merge_rss = run_and_measure('module', 'lib.merge_batches', ['--strategy', 'kway'], run_directory)
+
+        results.append({
+            "stage": "end_to_end",
+            "words": words,
+            "prune_frequency": prune_frequency,
+            "batches": batches,
+            "seconds": round(train_seconds + merge_seconds, 6),
+            "train_seconds": round(train_seconds, 6),
+            "train_words_per_second": round(words / train_seconds),
+            "train_peak_rss_kb": train_rss,
+            "merge_and_tokenize_seconds": round(merge_seconds, 6),
+            "merge_and_tokenize_peak_rss_kb": merge_rss,
+            "dictionary_bytes": os.path.getsize(os.path.join(run_directory, 'dictionary.msgpack')),
+        })
+        print(f"{'end_to_end':>16} {words:>12,} words {train_seconds + merge_seconds:10.3f}s (prune frequency {prune_frequency:,}, train peak RSS {train_rss:,} KB)")
+
+    return results
+
+def result_key(result):
+    return (result["stage"], result["words"], result.get("prune_frequency"))
+
+def compare(results, baseline, tolerance):
+    """Results more than `tolerance` (a fraction) slower than the same stage and size in the baseline."""
+    baseline_seconds = {result_key(result): result["seconds"] for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = baseline_seconds.get(result_key(result))
+        if before and result["seconds"] > before * (1 + tolerance):
+            regressions.append({"stage": result["stage"], "words": result["words"], "prune_frequency": result.get("prune_frequency"),
+                                "baseline_seconds": before, "seconds": result["seconds"], "slowdown": round(result["seconds"] / before, 3)})
+    return regressions
+
+def main(sizes, end_to_end_words, prune_frequencies, output, vocabulary=50000, exponent=1.1, seed=0, repeat=3, baseline=None, tolerance=0.2):
+    corpus = ZipfCorpus(vocabulary, exponent, seed)
+    results = []
+
+    original_directory = os.getcwd()
+    output = os.path.abspath(output)
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for words in sizes:
+                results += stage_benchmarks(words, corpus, repeat, directory)
+            if end_to_end_words:
+                results += end_to_end_benchmarks(end_to_end_words, prune_frequencies, corpus, directory)
+        finally:
+            os.chdir(original_directory)
+
+    report = {
+        "benchmark_version": BENCHMARK_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "sizes": sizes, "end_to_end_words": end_to_end_words, "prune_frequencies": prune_frequencies,
+            "vocabulary": vocabulary, "exponent": exponent, "seed": seed, "repeat": repeat,
+            "target_dictionary_count": TARGET_DICTIONARY_COUNT,
+        },
+        "results": results,
+    }
+
+    if baseline:
+        with open(baseline, 'r') as f:
+            report["regressions"] = compare(results, json.load(f), tolerance)
+        for regression in report["regressions"]:
+            print(f"Regression: {regression['stage']} at {regression['words']:,} words took {regression['slowdown']}x the baseline")
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark training, merging and tokenization on a reproducible synthetic corpus.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100 * 1000, 1000 * 1000], help='Corpus sizes in words to time each stage at.')
+    parser.add_argument('--end-to-end-words', type=int, default=2 * 1000 * 1000, help='Corpus size for the train.py + merge runs. 0 skips them.')
+    parser.add_argument('--prune-frequencies', type=int, nargs='+', default=[250 * 1000, 1000 * 1000], help='train.py --prune-frequency values to compare end to end.')
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--exponent', type=float, default=1.1, help='Zipf exponent of the word distribution.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage. The fastest is reported.')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='Earlier results to compare against. Exits with status 1 on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='How much slower than the baseline counts as a regression.')
+    args = parser.parse_args()
+
+    report = main(args.sizes, args.end_to_end_words, args.prune_frequencies, args.output, vocabulary=args.vocabulary, exponent=args.exponent,
+                  seed=args.seed, repeat=args.repeat, baseline=args.baseline, tolerance=args.tolerance)
+    if report.get("regressions"):
+        sys.exit(1)
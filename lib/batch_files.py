@@ -0,0 +1,337 @@
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+from array import array
+from lib.constants import BATCH_FORMAT
+
+# First record of a sorted run. Anything else at the start of a file is a legacy pickled tree.
+SORTED_RUN_HEADER = ("tiny-predictive-text sorted run", 1)
+
+# First bytes of a columnar batch.
+COLUMNAR_MAGIC = b"TPTCOL01"
+
+# Batches aren't necessarily pickles, so they're named for what they are rather than how they're written.
+# Batches written before the columnar format, and the merged dictionary.pkl, still end in .pkl.
+BATCH_EXTENSION = ".batch"
+LEGACY_BATCH_EXTENSION = ".pkl"
+
+def is_batch_file(name):
+    """Whether a file name is a batch load_batch can read, whichever format it was written in."""
+    return name.endswith((BATCH_EXTENSION, LEGACY_BATCH_EXTENSION))
+
+def merged_batch_name(name):
+    """The name a merge of name with the next batch is saved under."""
+    return os.path.splitext(os.path.basename(name))[0] + '_merged' + BATCH_EXTENSION
+
+def write_batch(tree, path, batch_format=BATCH_FORMAT):
+    """Write a tree in the configured batch format. Every format can be read back with load_batch or iter_batch."""
+    if batch_format == "columnar":
+        write_columnar(tree, path)
+    else:
+        write_sorted_run(tree, path)
+
+def write_sorted_run(tree, path):
+    """
+    Write a tree as a sorted run: a header, then one pickled (anchor, subtree) record per anchor in anchor order.
+
+    Readers can stream a run one anchor at a time instead of unpickling the whole tree at once.
+    """
+    with open(path, 'wb') as f:
+        pickle.dump(SORTED_RUN_HEADER, f, protocol=pickle.HIGHEST_PROTOCOL)
+        for anchor in sorted(tree):
+            # One dump per record keeps the pickle memo from growing across the whole file.
+            pickle.dump((anchor, tree[anchor]), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def is_columnar(path):
+    with open(path, 'rb') as f:
+        return f.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+
+def iter_batch(path):
+    """Yield (anchor, subtree) pairs in anchor order from a columnar batch, a sorted run or a legacy pickled tree."""
+    if is_columnar(path):
+        with ColumnarBatch(path) as batch:
+            yield from batch.items()
+        return
+
+    with open(path, 'rb') as f:
+        first = pickle.load(f)
+        if first != SORTED_RUN_HEADER:
+            # Legacy batches have to be loaded whole before they can be sorted.
+            for anchor in sorted(first):
+                yield anchor, first[anchor]
+            return
+
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def load_batch(path):
+    """Load a whole batch as a nested dict, whichever format it was written in."""
+    if is_columnar(path):
+        return dict(iter_batch(path))
+
+    with open(path, 'rb') as f:
+        first = pickle.load(f)
+    if first != SORTED_RUN_HEADER:
+        return first
+    return dict(iter_batch(path))
+
+##################
+# COLUMNAR FORMAT #
+##################
+# A columnar batch is the magic bytes, a little-endian uint64 header length, a JSON header, then flat
+# typed arrays, each starting on an 8 byte boundary:
+#
+#   string_bytes        every distinct string, utf-8, back to back
+#   string_offsets      uint32, start of string i is string_offsets[i], end is string_offsets[i + 1]
+#   anchor_strings      uint32 string id per anchor, sorted by anchor so lookups can binary search
+#   anchor_scores       uint64
+#   anchor_children     uint32 offsets into the second clause arrays, one more than there are anchors
+#   second_*            the same three arrays for second clauses, children pointing into first clauses
+#   first_*             the same three arrays for first clauses, children pointing into predictions
+#   prediction_scores   uint64
+#   prediction_children uint32 offsets into prediction_tokens
+#   prediction_tokens   uint32 string ids of the predicted words
+#
+# Nothing needs unpickling: a reader maps the file and casts each section in place.
+
+STRING_ID = 'I'
+SCORE = 'Q'
+
+COLUMNS = [
+    ("string_bytes", 'B'),
+    ("string_offsets", STRING_ID),
+    ("anchor_strings", STRING_ID),
+    ("anchor_scores", SCORE),
+    ("anchor_children", STRING_ID),
+    ("second_strings", STRING_ID),
+    ("second_scores", SCORE),
+    ("second_children", STRING_ID),
+    ("first_strings", STRING_ID),
+    ("first_scores", SCORE),
+    ("first_children", STRING_ID),
+    ("prediction_scores", SCORE),
+    ("prediction_children", STRING_ID),
+    ("prediction_tokens", STRING_ID),
+]
+
+def child_items(node):
+    # Everything except the bookkeeping keys is a child.
+    return [(key, value) for key, value in node.items() if key != "score" and isinstance(value, dict)]
+
+def write_columnar(tree, path):
+    """Write a tree as a columnar batch. Child order below the anchors is kept, anchors are sorted."""
+    columns = {name: array(typecode) for name, typecode in COLUMNS}
+    for name in ("string_offsets", "anchor_children", "second_children", "first_children", "prediction_children"):
+        columns[name].append(0)
+
+    string_ids = {}
+    string_bytes = bytearray()
+    def string_id(string):
+        index = string_ids.get(string)
+        if index is None:
+            index = string_ids[string] = len(string_ids)
+            string_bytes.extend(string.encode('utf-8'))
+            columns["string_offsets"].append(len(string_bytes))
+        return index
+
+    for anchor in sorted(key for key, value in tree.items() if isinstance(value, dict)):
+        anchor_dict = tree[anchor]
+        columns["anchor_strings"].append(string_id(anchor))
+        columns["anchor_scores"].append(anchor_dict.get("score", 0))
+
+        for second_clause, second_clause_dict in child_items(anchor_dict):
+            columns["second_strings"].append(string_id(second_clause))
+            columns["second_scores"].append(second_clause_dict.get("score", 0))
+
+            for first_clause, first_clause_dict in child_items(second_clause_dict):
+                columns["first_strings"].append(string_id(first_clause))
+                columns["first_scores"].append(first_clause_dict.get("score", 0))
+
+                for prediction in first_clause_dict.get("predictions", []):
+                    columns["prediction_scores"].append(prediction["score"])
+                    columns["prediction_tokens"].extend(string_id(word) for word in prediction["prediction"])
+                    columns["prediction_children"].append(len(columns["prediction_tokens"]))
+
+                columns["first_children"].append(len(columns["prediction_scores"]))
+            columns["second_children"].append(len(columns["first_strings"]))
+        columns["anchor_children"].append(len(columns["second_strings"]))
+
+    columns["string_bytes"] = array('B', bytes(string_bytes))
+    write_sections(path, COLUMNAR_MAGIC, columns, COLUMNS)
+
+def write_sections(path, magic, columns, column_types):
+    """
+    Write named typed arrays as a memory-mappable file: the magic bytes, a little-endian uint64 header
+    length, a JSON header locating each section, then the sections, each on an 8 byte boundary.
+    """
+    if sys.byteorder != 'little':
+        for column in columns.values():
+            column.byteswap()
+
+    # Lay the sections out after the header, each on an 8 byte boundary.
+    sections = []
+    offset = 0
+    for name, typecode in column_types:
+        offset = (offset + 7) // 8 * 8
+        sections.append([name, typecode, offset, len(columns[name])])
+        offset += len(columns[name]) * columns[name].itemsize
+
+    # The header's length shifts every section and the shifted offsets change the header's length,
+    # so grow the data start until the header fits in front of it.
+    header = {"version": 1, "sections": sections}
+    relative_offsets = [section[2] for section in sections]
+    start = 0
+    while True:
+        for section, relative_offset in zip(sections, relative_offsets):
+            section[2] = start + relative_offset
+        header_bytes = json.dumps(header).encode('utf-8')
+        needed = (len(magic) + 8 + len(header_bytes) + 7) // 8 * 8
+        if needed <= start:
+            break
+        start = needed
+    header_bytes += b" " * (start - len(magic) - 8 - len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, typecode, section_offset, _ in sections:
+            f.write(b"\0" * (section_offset - f.tell()))
+            columns[name].tofile(f)
+
+class MappedSections:
+    """
+    Read-only view of a file written by write_sections. The file is memory-mapped and every section is
+    cast in place, so opening one costs the same however big it is and only the parts that are read get
+    paged in. Processes mapping the same file share its pages.
+    """
+    magic = None
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+        if bytes(self.view[:len(self.magic)]) != self.magic:
+            self.close()
+            raise ValueError(f"{path} is not a {type(self).__name__} file")
+        header_length = struct.unpack_from('<Q', self.map, len(self.magic))[0]
+        header_start = len(self.magic) + 8
+        header = json.loads(bytes(self.view[header_start:header_start + header_length]))
+
+        self.columns = {}
+        for name, typecode, offset, length in header["sections"]:
+            itemsize = array(typecode).itemsize
+            section = self.view[offset:offset + length * itemsize]
+            if sys.byteorder != 'little':
+                # Big-endian hosts have to pay for a copy.
+                section = array(typecode, bytes(section))
+                section.byteswap()
+            elif typecode != 'B':
+                section = section.cast(typecode)
+            self.columns[name] = section
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # Every exported view has to be released before the map can close.
+        for column in getattr(self, "columns", {}).values():
+            if isinstance(column, memoryview):
+                column.release()
+        self.columns = {}
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+    def string(self, string_id):
+        offsets = self.columns["string_offsets"]
+        return bytes(self.columns["string_bytes"][offsets[string_id]:offsets[string_id + 1]]).decode('utf-8')
+
+    def strings(self):
+        """Decode the whole string table at once, for callers about to read most of the file."""
+        offsets = self.columns["string_offsets"].tolist()
+        string_bytes = bytes(self.columns["string_bytes"])
+        return [string_bytes[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+
+    def find_string(self, strings_column, string):
+        """
+        Index of string in a column of string ids sorted by string, by binary search, or None. With no
+        column the string table itself is searched, which has to be sorted, and the index is the string id.
+        utf-8 byte order matches str order, so comparing the encoded bytes is enough.
+        """
+        target = string.encode('utf-8')
+        offsets = self.columns["string_offsets"]
+        column = self.columns[strings_column] if strings_column is not None else range(len(offsets) - 1)
+        string_bytes = self.columns["string_bytes"]
+
+        low, high = 0, len(column)
+        while low < high:
+            middle = (low + high) // 2
+            string_id = column[middle]
+            if bytes(string_bytes[offsets[string_id]:offsets[string_id + 1]]) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(column):
+            string_id = column[low]
+            if bytes(string_bytes[offsets[string_id]:offsets[string_id + 1]]) == target:
+                return low
+        return None
+
+class ColumnarBatch(MappedSections):
+    """Read-only, memory-mapped view of a columnar batch file."""
+    magic = COLUMNAR_MAGIC
+
+    def __len__(self):
+        return len(self.columns["anchor_strings"])
+
+    def anchor(self, index):
+        return self.string(self.columns["anchor_strings"][index])
+
+    def find(self, anchor):
+        """Index of an anchor, or None."""
+        return self.find_string("anchor_strings", anchor)
+
+    def subtree(self, index, strings=None):
+        """Build the nested dict for one anchor, reading only its own slice of each column."""
+        columns = self.columns
+        string = self.string if strings is None else strings.__getitem__
+
+        anchor_dict = {"score": columns["anchor_scores"][index]}
+        for second in range(columns["anchor_children"][index], columns["anchor_children"][index + 1]):
+            second_clause_dict = {"score": columns["second_scores"][second]}
+            for first in range(columns["second_children"][second], columns["second_children"][second + 1]):
+                predictions = []
+                for prediction in range(columns["first_children"][first], columns["first_children"][first + 1]):
+                    start, end = columns["prediction_children"][prediction], columns["prediction_children"][prediction + 1]
+                    predictions.append({
+                        "prediction": [string(token) for token in columns["prediction_tokens"][start:end]],
+                        "score": columns["prediction_scores"][prediction],
+                    })
+                first_clause_dict = {"score": columns["first_scores"][first]}
+                if predictions:
+                    first_clause_dict["predictions"] = predictions
+                second_clause_dict[string(columns["first_strings"][first])] = first_clause_dict
+            anchor_dict[string(columns["second_strings"][second])] = second_clause_dict
+
+        return anchor_dict
+
+    def get(self, anchor, default=None):
+        index = self.find(anchor)
+        return default if index is None else self.subtree(index)
+
+    def items(self):
+        strings = self.strings()
+        anchor_strings = self.columns["anchor_strings"]
+        for index in range(len(self)):
+            yield strings[anchor_strings[index]], self.subtree(index, strings)
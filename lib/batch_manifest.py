@@ -0,0 +1,55 @@
+import hashlib
+import json
+import os
+
+MANIFEST_PATH = 'training/manifest.json'
+
+def file_checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def describe_file(path, checksum=None):
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": checksum or file_checksum(path),
+    }
+
+def load_manifest(path=MANIFEST_PATH):
+    """The batches already folded into training/dictionary.pkl, and the checksum that file had afterwards."""
+    if not os.path.exists(path):
+        return {"batches": {}, "dictionary": None}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def is_folded(manifest, directory, name):
+    """
+    Whether a batch is already in the merged dictionary.
+
+    Name, size and modification time are enough to recognise a batch that hasn't changed, so only new or
+    touched files are checksummed. A touched file is folded again only if its contents actually changed.
+    """
+    recorded = manifest["batches"].get(name)
+    if recorded is None:
+        return False
+
+    path = os.path.join(directory, name)
+    stat = os.stat(path)
+    if stat.st_size != recorded["size"]:
+        return False
+    if stat.st_mtime_ns == recorded["mtime_ns"]:
+        return True
+    return file_checksum(path) == recorded["sha256"]
+
+def record_batches(manifest, directory, names):
+    for name in names:
+        manifest["batches"][name] = describe_file(os.path.join(directory, name))
@@ -0,0 +1,167 @@
+from lib.prune import prune_tree, child_score, prediction_score
+from lib.tokenizer import Tokenizer
+
+def container_bytes(length):
+    """msgpack header of a map or array with length entries."""
+    if length < 16:
+        return 1
+    return 3 if length < 65536 else 5
+
+def int_bytes(value):
+    """msgpack size of a token id."""
+    if value < 128:
+        return 1
+    if value < 256:
+        return 2
+    return 3 if value < 65536 else 5
+
+def str_bytes(string):
+    length = len(string.encode('utf-8'))
+    if length < 32:
+        return 1 + length
+    if length < 256:
+        return 2 + length
+    return (3 if length < 65536 else 5) + length
+
+def index_node(node):
+    """A scored node as (children, predictions), each best first in the order prune_branches keeps them."""
+    # sorted is stable, so a prefix of it is what nlargest keeps, ties included
+    children = sorted((item for item in node.items() if isinstance(item[1], dict)), key=child_score, reverse=True)
+    predictions = sorted((prediction for prediction in node.get("predictions") or () if "prediction" in prediction), key=prediction_score, reverse=True)
+    return [(key, index_node(child)) for key, child in children], [(prediction["score"], prediction["prediction"]) for prediction in predictions]
+
+def prune_to(tree, choice):
+    """Prune a merged tree in place to a choice from SizeModel. A top level score takes one of prune_tree's slots."""
+    anchors = choice["anchors"] + (1 if "score" in tree else 0)
+    return prune_tree(tree, anchors, choice["subbranch_limit"], choice["prediction_limit"])
+
+class SizeModel:
+    """
+    Estimates the bytes of dictionary.msgpack plus tokens.msgpack, and the prediction score they keep,
+    for any anchor count, subbranch limit and prediction count a merged tree could be pruned to, without
+    pruning or encoding it.
+
+    Every map, array, token id and string is costed from msgpack's header sizes, given the ids a copy of
+    the tokenizer hands out when fitted to the whole tree. Each prediction list's bytes, score and words
+    are worked out once for every count that could be kept, so trying a limit pair only walks the
+    contexts it keeps. For one pair the anchors are added best first, as prune_tree keeps them, so each
+    only adds its own subtree and the strings no earlier anchor used: the largest anchor count within a
+    budget falls out of one pass.
+    """
+    def __init__(self, tree, tokenizer, rebuild_vocabulary=False):
+        anchors = sorted((item for item in tree.items() if isinstance(item[1], dict)), key=child_score, reverse=True)
+        self.anchors = [(anchor, index_node(subtree)) for anchor, subtree in anchors]
+
+        # The limits past which pruning keeps everything
+        self.max_subbranches = 1
+        self.max_predictions = 1
+        stack = [node for _, node in self.anchors]
+        while stack:
+            children, predictions = stack.pop()
+            self.max_subbranches = max(self.max_subbranches, len(children))
+            self.max_predictions = max(self.max_predictions, len(predictions))
+            stack.extend(child for _, child in children)
+
+        estimator = Tokenizer(tokenizer.strings, tokenizer.counts)
+        estimator.fit(self.simplified())
+        if rebuild_vocabulary:
+            estimator.rebuild()
+        self.ids = estimator.ids
+        # Bytes each string adds to tokens.msgpack: its id and the string itself
+        self.string_bytes = {}
+        self.costed = [(anchor, self.key_bytes(anchor), self.cost(node)) for anchor, node in self.anchors]
+
+        self.total_mass = self.fit(float('inf'), self.max_subbranches, self.max_predictions)["mass"]
+
+    def key_bytes(self, string):
+        token_bytes = int_bytes(self.ids[string])
+        self.string_bytes[string] = token_bytes + str_bytes(string)
+        return token_bytes
+
+    def cost(self, node):
+        """
+        A node as (children, sizes, masses, words). Children carry their key's bytes. A node with predictions
+        has none, and the others give the bytes, score and set of words of its first n predictions at [n].
+        """
+        children, predictions = node
+        if not predictions:
+            return [(key, self.key_bytes(key), self.cost(child)) for key, child in children], None, None, None
+
+        sizes, masses, words = [container_bytes(0)], [0], [frozenset()]
+        body = 0
+        seen = set()
+        for count, (score, prediction) in enumerate(predictions, 1):
+            body += container_bytes(len(prediction)) + sum(self.key_bytes(word) for word in prediction)
+            seen.update(prediction)
+            sizes.append(container_bytes(count) + body)
+            masses.append(masses[-1] + score)
+            words.append(frozenset(seen))
+        return [], sizes, masses, words
+
+    def simplified(self, choice=None):
+        """
+        The tree as pruning it to choice, everything by default, and remove_scores_and_flatten_predictions
+        would leave it, built from the model rather than a copy of the tree.
+        """
+        if choice is None:
+            choice = {"anchors": len(self.anchors), "subbranch_limit": self.max_subbranches, "prediction_limit": self.max_predictions}
+        subbranch_limit, prediction_limit = choice["subbranch_limit"], choice["prediction_limit"]
+
+        def build(node):
+            children, predictions = node
+            # Simplifying turns a node with predictions into just their array
+            if predictions:
+                return [list(prediction) for _, prediction in predictions[:prediction_limit]]
+            return {key: build(child) for key, child in children[:subbranch_limit]}
+
+        return {anchor: build(node) for anchor, node in self.anchors[:choice["anchors"]]}
+
+    def subtree(self, node, subbranch_limit, prediction_limit, strings):
+        """Encoded bytes and kept score of a costed node once pruned and simplified. Adds the strings it uses to strings."""
+        children, sizes, masses, words = node
+        if sizes is not None:
+            kept = min(prediction_limit, len(sizes) - 1)
+            strings |= words[kept]
+            return sizes[kept], masses[kept]
+
+        kept = children[:subbranch_limit]
+        size = container_bytes(len(kept))
+        mass = 0
+        for key, key_bytes, child in kept:
+            child_size, child_mass = self.subtree(child, subbranch_limit, prediction_limit, strings)
+            size += key_bytes + child_size
+            mass += child_mass
+            strings.add(key)
+        return size, mass
+
+    def fit(self, budget, subbranch_limit, prediction_limit):
+        """The most anchors that fit in budget bytes with these limits, and their estimated bytes and kept score."""
+        string_bytes = self.string_bytes
+        strings = set()
+        dictionary_bytes = 0
+        token_bytes = 0
+        mass = 0
+        best = {"anchors": 0, "subbranch_limit": subbranch_limit, "prediction_limit": prediction_limit, "bytes": 2 * container_bytes(0), "mass": 0}
+        for count, (anchor, anchor_bytes, node) in enumerate(self.costed, 1):
+            used = {anchor}
+            size, anchor_mass = self.subtree(node, subbranch_limit, prediction_limit, used)
+            dictionary_bytes += anchor_bytes + size
+            token_bytes += sum(string_bytes[string] for string in used - strings)
+            strings |= used
+            mass += anchor_mass
+
+            total = container_bytes(count) + dictionary_bytes + container_bytes(len(strings)) + token_bytes
+            if total > budget:
+                break
+            best = dict(best, anchors=count, bytes=total, mass=mass)
+        return best
+
+    def best(self, budget):
+        """The anchor count, subbranch limit and prediction count keeping the most score within budget, fewest bytes on ties."""
+        fits = [self.fit(budget, subbranch_limit, prediction_limit)
+                for subbranch_limit in range(1, self.max_subbranches + 1)
+                for prediction_limit in range(1, self.max_predictions + 1)]
+        choice = max(fits, key=lambda fit: (fit["mass"], -fit["bytes"]))
+        if not choice["anchors"]:
+            raise ValueError(f"A byte budget of {budget:,} can't fit a single anchor")
+        return choice
@@ -0,0 +1,51 @@
+import gc
+import multiprocessing
+import signal
+import time
+
+def run_in_child(write, args):
+    # The training process owns SIGINT and waits for this write to finish before it exits.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    write(*args)
+
+class BackgroundWriter:
+    """
+    Runs checkpoint writes in a forked process while training carries on.
+
+    The child inherits the tree store as it was at the fork, so nothing has to be pickled across and the
+    training process can start filing into a fresh store straight away. The old store is kept referenced
+    until the write finishes: freeing it in the parent while the child still reads it would make both
+    processes copy its pages.
+
+    Only one write is in flight at a time. A second checkpoint waits for the first, which keeps progress
+    files in order and at most two tree stores in memory.
+    """
+    def __init__(self):
+        self.context = multiprocessing.get_context('fork')
+        self.process = None
+        self.pending = None
+
+    def submit(self, write, *args, metrics=None):
+        """Wait for the previous write, then call write(*args) in a child process."""
+        self.wait(metrics)
+        self.pending = args
+        # Collections in the parent would otherwise touch every object the child is reading, copying their pages
+        gc.freeze()
+        self.process = self.context.Process(target=run_in_child, args=(write, args))
+        self.process.start()
+
+    def wait(self, metrics=None):
+        """Block until the write in flight, if any, is done. Raises if it failed."""
+        if self.process is None:
+            return
+        start = time.perf_counter()
+        self.process.join()
+        if metrics is not None:
+            metrics.add_time("checkpoint_wait", time.perf_counter() - start)
+
+        exitcode = self.process.exitcode
+        self.process = None
+        self.pending = None
+        gc.unfreeze()
+        if exitcode != 0:
+            raise RuntimeError(f"Background checkpoint failed with exit code {exitcode}. Progress was not saved past the last successful checkpoint.")
@@ -0,0 +1,211 @@
+import argparse
+import os
+from array import array
+from bisect import bisect_left
+import msgpack
+from lib.batch_files import write_sections, MappedSections
+from lib.predict import Predictor, best_match
+
+COMPILED_PATH = 'dictionary.compiled'
+
+# First bytes of a compiled dictionary. Bumped whenever the layout changes.
+COMPILED_MAGIC = b"TPTDIC02"
+
+# A compiled dictionary is dictionary.msgpack with every token already resolved, laid out as flat arrays
+# (see write_sections in lib.batch_files) that can be used where they are mapped. It's for the server
+# (serve.py) and offline tools, not for pages to download: it runs larger than dictionary.msgpack plus
+# tokens.msgpack, which store small ids in a byte and need no offsets.
+#
+#   string_bytes, string_offsets    every token's string, sorted, so a string's id is its rank and
+#                                   lookups binary search the table itself
+#   string_tokens                   the token each string has in tokens.msgpack
+#   anchor_strings                  string id per anchor, sorted
+#   anchor_children                 offsets into the first level arrays, one more than there are anchors
+#   first_strings, first_children   first level contexts, children pointing into the second level
+#   second_strings, second_children second level contexts, children pointing into prediction_offsets
+#   prediction_offsets              offsets into prediction_words, one more than there are predictions
+#   prediction_words                string id per predicted word
+#
+# Every column but string_bytes is packed as uint16 when all its values fit, uint32 otherwise. The
+# header records which, so readers cast each section to the type it was written with.
+COLUMNS = [
+    "string_bytes",
+    "string_offsets",
+    "string_tokens",
+    "anchor_strings",
+    "anchor_children",
+    "first_strings",
+    "first_children",
+    "second_strings",
+    "second_children",
+    "prediction_offsets",
+    "prediction_words",
+]
+
+def packed(values):
+    """values as uint16 if they all fit, uint32 otherwise."""
+    values = list(values)
+    return array('H' if max(values, default=0) < 1 << 16 else 'I', values)
+
+def compile_dictionary(dictionary, tokens, path=COMPILED_PATH):
+    """Compile a tokenized dictionary. The file is replaced atomically so running servers keep their old mapping."""
+    columns = {name: [] for name in COLUMNS}
+    for name in ("anchor_children", "first_children", "second_children", "prediction_offsets"):
+        columns[name].append(0)
+
+    # A string with several tokens resolves to the last one, like the token index in Predictor
+    token_ids = {string: token for token, string in tokens.items()}
+    strings = sorted(token_ids)
+    string_ids = {string: index for index, string in enumerate(strings)}
+    # Every token's string is in the table, so a token maps straight to its string's id.
+    token_string_ids = {token: string_ids[string] for token, string in tokens.items()}
+
+    string_bytes = bytearray()
+    columns["string_offsets"].append(0)
+    for string in strings:
+        string_bytes.extend(string.encode('utf-8'))
+        columns["string_offsets"].append(len(string_bytes))
+        columns["string_tokens"].append(token_ids[string])
+
+    def context_items(node):
+        # Same rules as Predictor: only maps have children and keys without a token can't be matched
+        if not isinstance(node, dict):
+            return []
+        return [(token_string_ids[token], child) for token, child in node.items() if token in tokens]
+
+    def predictions(node):
+        if isinstance(node, list):
+            # Words without a token would only ever have been joined in as empty strings
+            return [[token_string_ids[token] for token in prediction if token in tokens] for prediction in node]
+        # One level too deep: gather the prediction lists underneath
+        return [prediction for _, child in context_items(node) if isinstance(child, list) for prediction in predictions(child)]
+
+    anchors = sorted(token_string_ids[token] for token in dictionary if token in tokens and token_ids[tokens[token]] == token)
+    anchor_tokens = {token_string_ids[token]: token for token in dictionary if token in tokens}
+    for anchor_string in anchors:
+        columns["anchor_strings"].append(anchor_string)
+
+        for first_level_context, first_level_node in context_items(dictionary[anchor_tokens[anchor_string]]):
+            columns["first_strings"].append(first_level_context)
+
+            for second_level_context, second_level_node in context_items(first_level_node):
+                columns["second_strings"].append(second_level_context)
+                for prediction in predictions(second_level_node):
+                    columns["prediction_words"].extend(prediction)
+                    columns["prediction_offsets"].append(len(columns["prediction_words"]))
+                columns["second_children"].append(len(columns["prediction_offsets"]) - 1)
+
+            columns["first_children"].append(len(columns["second_strings"]))
+        columns["anchor_children"].append(len(columns["first_strings"]))
+
+    columns = {name: packed(values) for name, values in columns.items()}
+    columns["string_bytes"] = array('B', bytes(string_bytes))
+    write_sections(path + '.tmp', COMPILED_MAGIC, columns, [(name, columns[name].typecode) for name in COLUMNS])
+    os.replace(path + '.tmp', path)
+
+def compile_files(dictionary_path='dictionary.msgpack', tokens_path='tokens.msgpack', path=COMPILED_PATH):
+    with open(dictionary_path, 'rb') as f:
+        dictionary = msgpack.unpack(f, strict_map_key=False)
+    with open(tokens_path, 'rb') as f:
+        tokens = msgpack.unpack(f, strict_map_key=False)
+    compile_dictionary(dictionary, tokens, path)
+
+def size_report(path=COMPILED_PATH, dictionary_path='dictionary.msgpack', tokens_path='tokens.msgpack'):
+    """The compiled dictionary's size next to the msgpack files it stands in for on the server."""
+    msgpack_size = os.path.getsize(dictionary_path) + os.path.getsize(tokens_path)
+    compiled_size = os.path.getsize(path)
+    return (f"{dictionary_path} + {tokens_path}: {msgpack_size:,} bytes, "
+            f"{path}: {compiled_size:,} bytes ({compiled_size / msgpack_size:.0%})")
+
+def is_stale(path=COMPILED_PATH, sources=('dictionary.msgpack', 'tokens.msgpack')):
+    """Whether the compiled dictionary is missing, in an older layout or older than the files it was compiled from."""
+    if not os.path.exists(path):
+        return True
+    with open(path, 'rb') as f:
+        if f.read(len(COMPILED_MAGIC)) != COMPILED_MAGIC:
+            return True
+    compiled_at = os.stat(path).st_mtime_ns
+    return any(os.stat(source).st_mtime_ns > compiled_at for source in sources)
+
+class MappedLevel:
+    """A ContextLevel read straight out of a compiled dictionary."""
+    __slots__ = ("dictionary", "strings_column", "children_column", "start", "end")
+
+    def __init__(self, dictionary, strings_column, children_column, start, end):
+        self.dictionary = dictionary
+        self.strings_column = strings_column
+        self.children_column = children_column
+        self.start = start
+        self.end = end
+
+    def contexts(self):
+        string = self.dictionary.string
+        return [string(string_id) for string_id in self.dictionary.columns[self.strings_column][self.start:self.end]]
+
+    def child(self, position):
+        index = self.start + position
+        children = self.dictionary.columns[self.children_column]
+        start, end = children[index], children[index + 1]
+
+        if self.strings_column == "first_strings":
+            return MappedLevel(self.dictionary, "second_strings", "second_children", start, end)
+        string = self.dictionary.string
+        offsets = self.dictionary.columns["prediction_offsets"]
+        words = self.dictionary.columns["prediction_words"]
+        return [" ".join(string(string_id) for string_id in words[offsets[index]:offsets[index + 1]]) for index in range(start, end)]
+
+    def match(self, context):
+        """The closest child and the quality of the match, or (None, 0) if there are no children."""
+        position, quality = best_match(context, self.contexts())
+        if position is None:
+            return None, 0
+        return self.child(position), quality
+
+    def completions(self):
+        # Completions are only ever stored under the second level.
+        return []
+
+class CompiledDictionary(MappedSections):
+    """Read-only, memory-mapped view of a compiled dictionary."""
+    magic = COMPILED_MAGIC
+
+    def __len__(self):
+        return len(self.columns["anchor_strings"])
+
+    def find_anchor(self, anchor):
+        """The anchor's token, or -1, and its first level, or None."""
+        string_id = self.find_string(None, anchor) if anchor else None
+        if string_id is None:
+            return -1, None
+        token = self.columns["string_tokens"][string_id]
+
+        anchor_strings = self.columns["anchor_strings"]
+        index = bisect_left(anchor_strings, string_id)
+        if index == len(anchor_strings) or anchor_strings[index] != string_id:
+            return token, None
+        children = self.columns["anchor_children"]
+        return token, MappedLevel(self, "first_strings", "first_children", children[index], children[index + 1])
+
+class CompiledPredictor(Predictor):
+    """
+    Predictor over a compiled dictionary. Nothing is loaded onto the heap: every process that opens the
+    same file shares the operating system's cached pages of it.
+    """
+    def __init__(self, path=COMPILED_PATH):
+        self.dictionary = CompiledDictionary(path)
+
+    def find_anchor(self, anchor):
+        return self.dictionary.find_anchor(anchor)
+
+    def close(self):
+        self.dictionary.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile dictionary.msgpack and tokens.msgpack into a memory-mappable dictionary.")
+    parser.add_argument('--dictionary', default='dictionary.msgpack')
+    parser.add_argument('--tokens', default='tokens.msgpack')
+    parser.add_argument('--output', default=COMPILED_PATH)
+    args = parser.parse_args()
+
+    compile_files(args.dictionary, args.tokens, args.output)
+    print(size_report(args.output, args.dictionary, args.tokens))
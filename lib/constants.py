@@ -2,11 +2,62 @@
 # RECIPES #
 ###########
 # 1.4MB: ? Target dictionary count ? Prune frequency
+# Or train past the size wanted and let `python -m lib.create_dictionary --byte-budget` pick the counts.
 PRUNE_FREQUENCY = 4 * 1000 * 1000 # Every this many words
 TARGET_DICTIONARY_COUNT = 100
 
+# When training writes its tree store out as a batch. How far a tree grows in PRUNE_FREQUENCY words
+# depends on how repetitive the text is, so by default the flush is triggered by size instead: the
+# tree store's own estimate of its heap size (TreeStore.estimated_bytes), or its total node count.
+# Whichever budget is set and reached first triggers the flush. Budgets are per training process,
+# and writing a batch briefly needs up to about as much memory again.
+FLUSH_MEMORY_BUDGET = 1024 * 1024 * 1024 # Bytes
+FLUSH_NODE_BUDGET = None # Words, anchors, contexts and predictions
+
 # Total number of words in the dataset acc to https://huggingface.co/datasets/oscar-corpus/OSCAR-2201
 TOTAL_WORD_COUNT = 377376402775  
 
 SUBBRANCH_PRUNE_SIZE = 20
-MAX_PREDICTIONS = 3
\ No newline at end of file
+MAX_PREDICTIONS = 3
+
+# Times --byte-budget searches again, with the budget cut by however far the encoded dictionary went over
+# the estimate, before giving up.
+BYTE_BUDGET_ATTEMPTS = 5
+
+# Slots in each Space-Saving summary when training with --heavy-hitters.
+# Memory stays flat at roughly these sizes no matter how long training runs.
+HEAVY_HITTER_ANCHORS = 50 * 1000
+HEAVY_HITTER_CONTEXTS = 500 * 1000
+HEAVY_HITTER_PREDICTIONS = 1000 * 1000
+
+# How batches and merged trees are written: "columnar" (flat typed arrays, memory-mappable) or
+# "sorted_run" (one pickled record per anchor). Both, and legacy pickled trees, can always be read.
+BATCH_FORMAT = "columnar"
+
+# Rough size in bytes of each anchor-hashed dictionary shard, so a page can fetch just the shards for
+# the anchors it sees instead of the whole dictionary.
+DICTIONARY_SHARD_SIZE = 256 * 1024
+
+# Near-duplicate filtering with --dedup. Documents whose word shingles are estimated to be at least
+# DEDUP_THRESHOLD similar (Jaccard) to one seen before are skipped. DEDUP_MAX_DOCUMENTS recent
+# documents are remembered, at roughly 1.3KB each with the default permutations.
+DEDUP_THRESHOLD = 0.8
+DEDUP_MAX_DOCUMENTS = 100 * 1000
+DEDUP_PERMUTATIONS = 64 # MinHash signature slots
+DEDUP_SHINGLE_SIZE = 5 # Words per shingle
+
+# Training files a document this many words at a time, checking for an interrupt in between, so
+# stopping never waits on one enormous document. A saved partial tree records the word it stopped at.
+DOCUMENT_SLICE_WORDS = 50 * 1000
+
+# Training with --converge stops once CONVERGENCE_PATIENCE checkpoints in a row leave the ranked anchors,
+# contexts and predictions of everything trained so far within CONVERGENCE_TOLERANCE of the checkpoint
+# before: top-k overlap and Kendall's tau both at least 1 - CONVERGENCE_TOLERANCE. With
+# --on-convergence sample it carries on filing only CONVERGENCE_SAMPLE_RATE of the chunks instead.
+CONVERGENCE_TOLERANCE = 0.05
+CONVERGENCE_PATIENCE = 3
+CONVERGENCE_SAMPLE_RATE = 0.1
+
+# Chunks of documents (DOCUMENTS_PER_CHUNK each) that training reads ahead in a background thread,
+# so waiting on the network or decompression overlaps with filing.
+PREFETCH_DEPTH = 4
@@ -0,0 +1,147 @@
+import os
+import pickle
+from operator import itemgetter
+from lib.batch_files import load_batch, is_batch_file
+from lib.merge_batches import merge, prune
+from lib.constants import TARGET_DICTIONARY_COUNT, CONVERGENCE_TOLERANCE, CONVERGENCE_PATIENCE
+
+CONVERGENCE_PATH = 'training/convergence.pkl'
+
+LEVELS = ("anchors", "contexts", "predictions")
+
+def rankings(tree):
+    """The anchors, (anchor, second clause, first clause) contexts and predictions of a pruned tree, each ranked by score."""
+    ranked = {level: [] for level in LEVELS}
+    for anchor, subtree in tree.items():
+        if not isinstance(subtree, dict):
+            continue
+        ranked["anchors"].append((subtree.get("score", 0), anchor))
+        for second_clause, second_node in subtree.items():
+            if not isinstance(second_node, dict):
+                continue
+            for first_clause, first_node in second_node.items():
+                if not isinstance(first_node, dict):
+                    continue
+                context = (anchor, second_clause, first_clause)
+                ranked["contexts"].append((first_node.get("score", 0), context))
+                for prediction in first_node.get("predictions", ()):
+                    ranked["predictions"].append((prediction["score"], context + (" ".join(prediction["prediction"]),)))
+
+    # sorted is stable, so ties keep the tree's order
+    return {level: [item for _, item in sorted(items, key=itemgetter(0), reverse=True)] for level, items in ranked.items()}
+
+def top_k_overlap(previous, current, k=None):
+    """Share of the top k items of two rankings they have in common. k defaults to the longer ranking."""
+    k = k or max(len(previous), len(current))
+    if not k:
+        return 1.0
+    return len(set(previous[:k]) & set(current[:k])) / k
+
+def count_inversions(values):
+    """Pairs of values out of order, by bottom-up merge sort."""
+    values = list(values)
+    inversions = 0
+    width = 1
+    while width < len(values):
+        merged = []
+        for low in range(0, len(values), 2 * width):
+            left = values[low:low + width]
+            right = values[low + width:low + 2 * width]
+            i = j = 0
+            while i < len(left) and j < len(right):
+                if left[i] <= right[j]:
+                    merged.append(left[i])
+                    i += 1
+                else:
+                    merged.append(right[j])
+                    j += 1
+                    inversions += len(left) - i
+            merged.extend(left[i:])
+            merged.extend(right[j:])
+        values = merged
+        width *= 2
+    return inversions
+
+def kendall_tau(previous, current):
+    """Kendall's tau between the orders two rankings put their common items in: 1 when they agree, -1 when reversed."""
+    positions = {item: position for position, item in enumerate(current)}
+    order = [positions[item] for item in previous if item in positions]
+    if len(order) < 2:
+        return 1.0
+    return 1 - 4 * count_inversions(order) / (len(order) * (len(order) - 1))
+
+class ConvergenceMonitor:
+    """
+    Tells when more training stops changing the dictionary.
+
+    Each batch is merged into a running snapshot of everything trained so far, pruned the way merging the
+    batches would, and its ranked anchors, contexts and predictions are compared with the last snapshot's.
+    Training has converged once both the top-k overlap and Kendall's tau of every level stay at or above
+    1 - tolerance for patience snapshots in a row. With heavy hitters, the checkpoints are already
+    snapshots of the whole run and go straight to observe().
+    """
+    def __init__(self, tolerance=CONVERGENCE_TOLERANCE, patience=CONVERGENCE_PATIENCE, target_dict_size=TARGET_DICTIONARY_COUNT):
+        self.tolerance = tolerance
+        self.patience = patience
+        self.target_dict_size = target_dict_size
+        self.tree = None
+        self.previous = None
+        # Batch files already merged into the snapshot
+        self.seen = set()
+        # {level: {"overlap": ..., "tau": ...}} for each snapshot after the first
+        self.history = []
+        self.steady = 0
+        self.converged = False
+
+    @classmethod
+    def load(cls, path=CONVERGENCE_PATH, **kwargs):
+        """The monitor saved at path, or a new one if there is none yet. Settings given here replace the saved ones."""
+        if not os.path.exists(path):
+            return cls(**kwargs)
+        with open(path, 'rb') as f:
+            monitor = pickle.load(f)
+        for setting, value in kwargs.items():
+            setattr(monitor, setting, value)
+        return monitor
+
+    def save(self, path=CONVERGENCE_PATH):
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def observe(self, tree):
+        """Compare a snapshot of the whole run so far with the last one. Returns whether training has converged."""
+        current = rankings(tree)
+        if self.previous is not None:
+            measures = {
+                level: {"overlap": top_k_overlap(self.previous[level], current[level]), "tau": kendall_tau(self.previous[level], current[level])}
+                for level in LEVELS
+            }
+            self.history.append(measures)
+            steady = all(value >= 1 - self.tolerance for measure in measures.values() for value in measure.values())
+            self.steady = self.steady + 1 if steady else 0
+            # Once converged it stays that way, so a resumed run doesn't go back to training in full
+            self.converged = self.converged or self.steady >= self.patience
+        self.previous = current
+        return self.converged
+
+    def add_batch(self, batch):
+        """Merge a batch into the running snapshot and observe the result."""
+        self.tree = batch if self.tree is None else prune(merge(self.tree, batch), self.target_dict_size)
+        return self.observe(self.tree)
+
+    def add_batches(self, directory):
+        """Add every batch file in directory that hasn't been added yet, oldest first. Returns whether training has converged."""
+        if os.path.exists(directory):
+            # Batch names start with the time they were written
+            for name in sorted(os.listdir(directory)):
+                if is_batch_file(name) and name not in self.seen:
+                    self.seen.add(name)
+                    self.add_batch(load_batch(os.path.join(directory, name)))
+        return self.converged
+
+    def summary(self):
+        if not self.history:
+            return "Convergence: waiting for a second snapshot"
+        levels = ", ".join(f"{level} overlap {measure['overlap']:.3f} tau {measure['tau']:.3f}" for level, measure in self.history[-1].items())
+        return f"Convergence: {levels} ({min(self.steady, self.patience)}/{self.patience} steady)"
@@ -0,0 +1,312 @@
+import argparse
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import time
+
+# How many documents a source hands over at a time.
+DOCUMENTS_PER_CHUNK = 128
+
+# Size of each bulk read from a local shard.
+READ_SIZE = 16 * 1024 * 1024
+
+class HuggingFaceSource:
+    """
+    Streams a Hugging Face dataset. Needs network access and, for OSCAR, a `huggingface-cli login`.
+    """
+    name = "huggingface"
+
+    def __init__(self, path='oscar-corpus/OSCAR-2201', language='en', chunk_size=DOCUMENTS_PER_CHUNK):
+        # Imported here so local sources work on hosts without datasets installed.
+        import datasets
+
+        datasets.logging.set_verbosity(datasets.logging.WARNING)
+        logging.getLogger('fsspec').setLevel(logging.WARNING)
+        logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+        self.dataset = datasets.load_dataset(path, language=language, split='train', streaming=True, trust_remote_code=True)
+        self.chunk_size = chunk_size
+        self.iterating = self.dataset
+        # Stream state before the last chunk handed out and how many documents after it the chunk began
+        self.chunk_start = None
+        self.chunk_skip = 0
+        # Documents to drop after loading a state
+        self.documents_to_skip = 0
+
+    def skip(self, documents):
+        """
+        Resume from a legacy document position by streaming past it. A bare document count can't be
+        turned into a shard and offset without the shard sizes, so this still downloads everything before it.
+        """
+        self.iterating = self.dataset.skip(documents)
+
+    def state_dict(self, documents=None):
+        """
+        The stream position after the last chunk handed out or, given documents, after that many of its
+        documents. A position inside a chunk is the state the chunk started from plus the documents to drop.
+        """
+        # The dataset being iterated tracks the position, not the one it was derived from.
+        if documents is None or self.chunk_start is None:
+            return self.iterating.state_dict()
+        return {"source": self.name, "state": self.chunk_start, "documents": self.chunk_skip + documents}
+
+    def load_state_dict(self, state_dict):
+        documents = 0
+        # Progress saved before positions inside chunks is the dataset's own state
+        if state_dict.get("source") == self.name:
+            state_dict, documents = state_dict["state"], state_dict["documents"]
+        self.dataset.load_state_dict(state_dict)
+        self.iterating = self.dataset
+        self.documents_to_skip = documents
+
+    def iter_chunks(self):
+        chunk = []
+        self.chunk_start, self.chunk_skip = self.iterating.state_dict(), self.documents_to_skip
+        for entry in self.iterating:
+            if self.documents_to_skip:
+                self.documents_to_skip -= 1
+                continue
+            chunk.append(entry['text'])
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+                self.chunk_start, self.chunk_skip = self.iterating.state_dict(), 0
+        if chunk:
+            yield chunk
+
+class LocalSource:
+    """
+    Reads documents from local shards: plain text and JSONL, optionally gzip or zstd compressed.
+
+    Plain text shards hold one document per line. JSONL shards hold one object per line with the document
+    under "text". Uncompressed shards are memory-mapped, compressed ones are decompressed in large blocks.
+    Shards are read in sorted order and the position is a shard index plus a byte offset into it, which
+    is kept for every document of the last chunk so training can stop, and resume, between any two.
+    """
+    name = "local"
+
+    def __init__(self, paths, chunk_size=DOCUMENTS_PER_CHUNK, read_size=READ_SIZE):
+        self.shards = list_shards(paths)
+        if not self.shards:
+            raise ValueError(f"No corpus shards found in {paths}")
+        self.chunk_size = chunk_size
+        self.read_size = read_size
+        self.shard = 0
+        self.offset = 0
+        self.documents_to_skip = 0
+        # (shard, offset) before the last chunk handed out and after each of its documents
+        self.chunk_positions = []
+        # Lines that couldn't be parsed, over every shard read
+        self.skipped_lines = 0
+
+    def skip(self, documents):
+        """Resume from a legacy document position by reading past it."""
+        self.documents_to_skip = documents
+
+    def state_dict(self, documents=None):
+        """The position after the last chunk handed out or, given documents, after that many of its documents."""
+        shard, offset = self.shard, self.offset
+        if documents is not None and documents < len(self.chunk_positions):
+            shard, offset = self.chunk_positions[documents]
+        return {
+            "source": self.name,
+            "shard": shard,
+            "shard_path": self.shards[shard] if shard < len(self.shards) else None,
+            "offset": offset,
+        }
+
+    def load_state_dict(self, state_dict):
+        if state_dict.get("source") != self.name:
+            raise ValueError("Saved progress does not come from a local corpus source.")
+        if state_dict["shard"] < len(self.shards) and state_dict["shard_path"] != self.shards[state_dict["shard"]]:
+            raise ValueError(f"Saved progress points at {state_dict['shard_path']} but shard {state_dict['shard']} is now {self.shards[state_dict['shard']]}.")
+        self.shard = state_dict["shard"]
+        self.offset = state_dict["offset"]
+
+    def iter_chunks(self):
+        while self.shard < len(self.shards):
+            path = self.shards[self.shard]
+            parse = parse_jsonl if shard_format(path) == "jsonl" else parse_text
+
+            chunk = []
+            positions = [(self.shard, self.offset)]
+            skipped = 0
+            with open_shard(path) as stream:
+                for line, end_offset in iter_lines(stream, self.offset, self.read_size):
+                    text = parse(line)
+                    if text is None:
+                        skipped += 1
+                        self.skipped_lines += 1
+                        continue
+                    if not text:
+                        continue
+                    if self.documents_to_skip:
+                        self.documents_to_skip -= 1
+                        continue
+
+                    chunk.append(text)
+                    positions.append((self.shard, end_offset))
+                    if len(chunk) >= self.chunk_size:
+                        # Position is updated before yielding so state_dict() matches what was handed out.
+                        self.offset = end_offset
+                        self.chunk_positions = positions
+                        yield chunk
+                        chunk = []
+                        positions = [(self.shard, self.offset)]
+
+            if skipped:
+                logging.warning(f"Skipped {skipped:,} malformed lines in {path}.")
+
+            # Chunks never span shards, which keeps the position a simple (shard, offset) pair.
+            self.shard += 1
+            self.offset = 0
+            if chunk:
+                self.chunk_positions = positions
+                yield chunk
+
+COMPRESSION_SUFFIXES = (".gz", ".zst", ".zstd")
+TEXT_SUFFIXES = (".txt", ".jsonl", ".json")
+
+def list_shards(paths):
+    """Expand files and directories into a sorted list of readable shards."""
+    shards = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                shards.extend(os.path.join(root, file) for file in files)
+        else:
+            shards.append(path)
+    return sorted(shard for shard in shards if shard_format(shard))
+
+def shard_format(path):
+    base = path
+    for suffix in COMPRESSION_SUFFIXES:
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+            break
+    if base.endswith(".jsonl") or base.endswith(".json"):
+        return "jsonl"
+    if base.endswith(".txt"):
+        return "text"
+    return None
+
+def open_shard(path):
+    if path.endswith(".gz"):
+        return io.BufferedReader(gzip.open(path, 'rb'), buffer_size=READ_SIZE)
+
+    if path.endswith(".zst") or path.endswith(".zstd"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading .zst shards needs the zstandard package: pip install zstandard")
+        # Stream readers keep their own reference to the file and close it with the reader.
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_size=READ_SIZE, closefd=True)
+
+    return MappedShard(path)
+
+class MappedShard:
+    """A read-only memory map with the subset of the file interface iter_lines needs."""
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # Empty files can't be mapped.
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def seek(self, offset):
+        if self.map is not None:
+            self.map.seek(offset)
+
+    def read(self, size):
+        return self.map.read(size) if self.map is not None else b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+def iter_lines(stream, offset, read_size):
+    """Yield (line, end offset) pairs using large reads, starting at a byte offset in the decompressed stream."""
+    if offset:
+        # gzip and zstd readers seek forward by decompressing, which still skips all the parsing.
+        stream.seek(offset)
+
+    remainder = b""
+    position = offset
+    while True:
+        block = stream.read(read_size)
+        if not block:
+            break
+        lines = (remainder + block).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            position += len(line) + 1
+            yield line, position
+
+    if remainder:
+        yield remainder, position + len(remainder)
+
+def parse_text(line):
+    return line.decode('utf-8', errors='replace').strip()
+
+def parse_jsonl(line):
+    """A line's "text", or None if it isn't a JSON object with a string "text", so one bad line doesn't stop training."""
+    line = line.strip()
+    if not line:
+        return ""
+    try:
+        document = json.loads(line)
+    except ValueError:
+        # Broken JSON or bytes that aren't UTF-8
+        return None
+    if not isinstance(document, dict):
+        return None
+    text = document.get("text", "")
+    return text if isinstance(text, str) else None
+
+SOURCES = {
+    HuggingFaceSource.name: HuggingFaceSource,
+    LocalSource.name: LocalSource,
+}
+
+def open_source(name, paths=None):
+    """Create the named corpus source. Local sources need one or more shard files or directories."""
+    if name == LocalSource.name:
+        if not paths:
+            raise ValueError("The local source needs --corpus paths.")
+        return LocalSource(paths)
+    return SOURCES[name]()
+
+def measure_throughput(source, seconds=30):
+    """Read from a source for up to `seconds` and report how fast documents and words came in."""
+    documents = 0
+    words = 0
+    start = time.perf_counter()
+    for chunk in source.iter_chunks():
+        documents += len(chunk)
+        words += sum(len(text.split()) for text in chunk)
+        if time.perf_counter() - start >= seconds:
+            break
+    elapsed = time.perf_counter() - start
+
+    return {
+        "source": source.name,
+        "documents": documents,
+        "words": words,
+        "seconds": elapsed,
+        "words_per_second": words / elapsed if elapsed else 0,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure how fast a corpus source delivers words.')
+    parser.add_argument('--source', choices=sorted(SOURCES), default=HuggingFaceSource.name, help='Corpus source to read from.')
+    parser.add_argument('--corpus', nargs='*', default=[], help='Shard files or directories for the local source.')
+    parser.add_argument('--seconds', type=float, default=30, help='How long to read for.')
+    args = parser.parse_args()
+
+    print(json.dumps(measure_throughput(open_source(args.source, args.corpus), args.seconds), indent=2))
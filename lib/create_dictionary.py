@@ -1,17 +1,26 @@
 import msgpack
 import copy
 import logging
-import pickle
 import datetime
 import os
-from lib.constants import MAX_PREDICTIONS, SUBBRANCH_PRUNE_SIZE 
+import time
+from lib.prune import prune_tree
+from lib.tree_store import TreeStore
+from lib.batch_files import write_batch, load_batch, BATCH_EXTENSION
+from lib.compiled_dictionary import compile_dictionary, size_report, COMPILED_PATH
+from lib.tokenizer import Tokenizer, VOCABULARY_PATH
+from lib.sharded_dictionary import shard_dictionary, SHARDS_PATH
+from lib.byte_budget import SizeModel, prune_to
+from lib.constants import DICTIONARY_SHARD_SIZE, BYTE_BUDGET_ATTEMPTS
+import argparse
 
 # Setup basic configuration for logging
 logging.basicConfig(level=logging.DEBUG)
 
+# Traversal order tokens for create_token_dict. Dictionary builds use lib.tokenizer.Tokenizer instead.
 next_token = 0 # Will be incremented by 1 on first usage.
-token_dict = {0: "hello"}
-word_dict = {"hello": 0}
+token_dict = {}
+word_dict = {}
 
 def register_string_with_token_dictionary(string):
   global next_token
@@ -54,64 +63,8 @@ def create_token_dict(tree):
     return tokenize_tree(tree)
   
 def create_dictionary(tree_store, target_dict_size):
-    def sort_keys_by_score(tree):
-        # Sorts the tree's top-level keys based on their child score "score", highest first
-        # Keeps the "score" key intact
-        sorted_items = sorted(
-            [(k, v) for k, v in tree.items() if k != "score" and isinstance(v, dict)],
-            key=lambda item: item[1]["score"] if "score" in item[1] else 0, reverse=True
-        )
-        sorted_tree = {"score": tree.get("score", 0)} if "score" in tree else {}  # Preserve "score" score if it exists
-        sorted_tree.update(dict(sorted_items))
-        return sorted_tree
-
-    def prune_top_level_entries_by_limit(tree, limit):
-        pruned_tree = tree
-        keys_to_delete = list(tree.keys())[limit:]
-        for key in keys_to_delete:
-            pruned_tree.pop(key)
-        return pruned_tree
-
-    top_sorted_tree = sort_keys_by_score(tree_store)
-    top_pruned_tree = prune_top_level_entries_by_limit(top_sorted_tree, target_dict_size)
-
-    def prune_and_sort_lower_branches(subtree, limit):
-        if isinstance(subtree, dict):
-            # Directly check for existence rather than getting a False default
-            score_present = "score" in subtree  # Check if 'score' key exists
-            predictions = subtree.get("predictions", False)  # Preserve predictions, if any
-            
-            # Filter out the special keys for sorting and pruning operations
-            filtered_subtree = {k: v for k, v in subtree.items() if k not in ["score", "predictions"]}
-            
-            top_sorted_subtree = sort_keys_by_score(filtered_subtree)
-            pruned_subtree = prune_top_level_entries_by_limit(top_sorted_subtree, limit)
-            
-            # Re-insert the 'score' if it was originally present, using a more reliable check
-            if score_present:
-                pruned_subtree["score"] = subtree["score"]  # Directly use the value from original subtree
-            
-            if predictions:  # Check if there's something to re-insert
-              # This section seems correct; ensure MAX_PREDICTIONS is defined or handled appropriately
-              sorted_predictions = sorted(predictions, key=lambda x: x['score'], reverse=True)[:MAX_PREDICTIONS]
-              pruned_subtree["predictions"] = sorted_predictions
-
-            # Recursively process each child, skipping special keys
-            for k, v in list(pruned_subtree.items()):
-                if k not in ["score", "predictions"] and isinstance(v, dict):
-                    pruned_subtree[k] = prune_and_sort_lower_branches(v, SUBBRANCH_PRUNE_SIZE)
-                    
-            return pruned_subtree
-        else:
-            return subtree
-
-
-    for k in list(top_pruned_tree.keys()):
-        if k != "score":
-            subtree = top_pruned_tree[k]
-            top_pruned_tree[k] = prune_and_sort_lower_branches(subtree, SUBBRANCH_PRUNE_SIZE)
-
-    return top_pruned_tree
+    """Keep the target_dict_size best anchors and prune their branches. Works in place, see lib.prune."""
+    return prune_tree(tree_store, target_dict_size)
 
 def remove_scores_and_flatten_predictions(tree):
     if isinstance(tree, dict):
@@ -137,6 +90,39 @@ def remove_scores_and_flatten_predictions(tree):
             tree[i] = remove_scores_and_flatten_predictions(item)
     return tree
 
+def tokenize_tree(tree, tokenizer, rebuild_vocabulary=False):
+    """Simplify a pruned tree in place and tokenize it with tokenizer, which learns its strings. Returns the tokenized tree and token dict."""
+    simplified = remove_scores_and_flatten_predictions(tree)
+    tokenizer.fit(simplified)
+    if rebuild_vocabulary:
+        tokenizer.rebuild()
+    return tokenizer.tokenize(simplified)
+
+def fit_to_byte_budget(tree, byte_budget, tokenizer, rebuild_vocabulary=False):
+    """
+    Prune a merged tree in place to the anchor count, subbranch limit and prediction count that keep the
+    most prediction score with dictionary.msgpack and tokens.msgpack together within byte_budget.
+
+    Every choice is sized by lib.byte_budget.SizeModel. Only the winner is built and encoded, to check it:
+    ids for strings the vocabulary doesn't know yet depend on what survives pruning, so the estimate can
+    be slightly off. If the winner is over, the search runs again with the budget cut by the overshoot.
+    Returns the choice, with its encoded bytes and the share of the tree's score it keeps.
+    """
+    model = SizeModel(tree, tokenizer, rebuild_vocabulary)
+
+    target = byte_budget
+    for _ in range(BYTE_BUDGET_ATTEMPTS):
+        choice = model.best(target)
+        # Built straight from the model, so only the chosen pruning is ever copied out of the tree
+        tokenized, token_dict = tokenize_tree(model.simplified(choice), Tokenizer(tokenizer.strings, tokenizer.counts), rebuild_vocabulary)
+        choice["encoded_bytes"] = len(msgpack.packb(tokenized)) + len(msgpack.packb(token_dict))
+        choice["mass_kept"] = choice["mass"] / model.total_mass if model.total_mass else 1.0
+        if choice["encoded_bytes"] <= byte_budget:
+            prune_to(tree, choice)
+            return choice
+        target -= choice["encoded_bytes"] - byte_budget
+    raise ValueError(f"Couldn't fit the dictionary in {byte_budget:,} bytes in {BYTE_BUDGET_ATTEMPTS} attempts")
+
 def save_to_dict_files(pruned_tree, token_dict):
     print("Saving dictionaries to files.")
     with open('dictionary.msgpack', 'wb') as dict_file:  # Note the 'wb' mode for binary writing
@@ -184,53 +170,92 @@ def save_test_dict_files():
   with open('tokens-test.msgpack', 'wb') as dict_file:  # Note the 'wb' mode for binary writing
     msgpack.dump(token_dict, dict_file)
   
-async def create_batch(tree_store, target_dict_size):
+async def create_batch(tree_store, target_dict_size, worker_id=None, metrics=None):
     global token_dict
     print("\n")
     print("Creating dictionary and tokenizing")
 
     # First, prune and sort the dictionary based on scores
     print("Pruning")
-    pruned_tree = create_dictionary(tree_store, target_dict_size)
-
-    tree_store.clear()
+    start = time.perf_counter()
+    if isinstance(tree_store, TreeStore):
+        # Only the anchors that survive pruning need to be expanded into nested dicts.
+        tree = tree_store.to_nested_dict(target_dict_size)
+    else:
+        tree = tree_store
+    exported = time.perf_counter()
+    pruned_tree = create_dictionary(tree, target_dict_size)
+    pruned = time.perf_counter()
 
     batches_path = 'training/batches'
     os.makedirs(batches_path, exist_ok=True)
 
-    batch_filename = f"{batches_path}/pruned_tree_batch_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.pkl"
+    # Parallel training workers flush in the same second, so tag their batches to keep the names unique.
+    # Background checkpoints can finish right before the next batch starts, hence the microseconds too.
+    worker_suffix = f"_w{worker_id:02d}" if worker_id is not None else ""
+    batch_filename = f"{batches_path}/pruned_tree_batch_{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}{worker_suffix}{BATCH_EXTENSION}"
     
-    # Saving the pruned tree to a pickle file
-    with open(batch_filename, 'wb') as pickle_file:
-        pickle.dump(pruned_tree, pickle_file)
+    # Saving the pruned tree in the configured batch format
+    write_batch(pruned_tree, batch_filename)
+    written = time.perf_counter()
+
+    # Only once it's written: a plain dict store was pruned in place and is the pruned tree.
+    tree_store.clear()
+
+    if metrics is not None:
+        metrics.add_time("batch_export", exported - start)
+        metrics.add_time("batch_prune", pruned - exported)
+        metrics.add_time("batch_write", written - pruned)
+        metrics.add_time("batch_clear", time.perf_counter() - written)
+        metrics.count("batches_written")
+        metrics.count("batch_bytes", os.path.getsize(batch_filename))
 
     print(f"💾 New batch {batch_filename} Saved.")
 
-def create_dictionary_and_tokenize():
-    global token_dict
+    return batch_filename
+
+def create_dictionary_and_tokenize(vocabulary_path=VOCABULARY_PATH, rebuild_vocabulary=False, shard_size=DICTIONARY_SHARD_SIZE, byte_budget=None):
     print("\n")
     print("Creating dictionary and tokenizing")
 
     print("Getting merged batch file")
-    with open(f'training/dictionary.pkl', 'rb') as f:
-      # Set contents equal to tree_store
-      tree_store = pickle.load(f)
+    tree_store = load_batch('training/dictionary.pkl')
+    tokenizer = Tokenizer.load(vocabulary_path)
 
-    print("Simplifying")
-    # Allow the running program to keep working on the unsimplified and untokenized tree.
-    simplified_pruned_tree = remove_scores_and_flatten_predictions(tree_store)
+    if byte_budget:
+        print(f"Fitting to {byte_budget:,} bytes")
+        choice = fit_to_byte_budget(tree_store, byte_budget, tokenizer, rebuild_vocabulary)
+        print(f"{choice['anchors']} anchors, {choice['subbranch_limit']} subbranches and {choice['prediction_limit']} predictions "
+              f"keep {choice['mass_kept']:.1%} of the score in {choice['encoded_bytes']:,} bytes (estimated {choice['bytes']:,})")
+
+    # Simplify, then tokenize, most frequent strings first. Known strings keep the ids earlier builds gave them.
+    print("Simplifying and tokenizing")
+    tokened_pruned_tree, token_dict = tokenize_tree(tree_store, tokenizer, rebuild_vocabulary)
+    tokenizer.save(vocabulary_path)
 
-    # Then, create a token dictionary and update the tree in-place
-    print("Tokenizing")
-    tokened_pruned_tree = create_token_dict(simplified_pruned_tree)
-    
     # Save to actual files.
     save_to_dict_files(tokened_pruned_tree, token_dict)
 
+    # Flat, binary searchable copy that can be used without deserializing it first.
+    print("Compiling")
+    compile_dictionary(tokened_pruned_tree, token_dict, COMPILED_PATH)
+    print(size_report(COMPILED_PATH))
+
+    if shard_size:
+        index = shard_dictionary(tokened_pruned_tree, token_dict, SHARDS_PATH, shard_size)
+        print(f"Split into {index['shard_count']} shards in {SHARDS_PATH}")
+
     # Save files for testing with wasm and stuff.
     save_test_dict_files()
 
     print("Finished creating dictionary and tokenization")
 
 if __name__ == "__main__":
-    create_dictionary_and_tokenize()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build dictionary.msgpack and tokens.msgpack from training/dictionary.pkl.")
+    parser.add_argument('--vocabulary', default=VOCABULARY_PATH, help='Vocabulary kept between builds so tokens stay stable.')
+    parser.add_argument('--rebuild-vocabulary', action='store_true', help='Reassign every token by frequency, for the smallest files at the cost of stable ids.')
+    parser.add_argument('--shard-size', type=int, default=DICTIONARY_SHARD_SIZE, help=f'Target bytes per shard in {SHARDS_PATH}. 0 skips sharding.')
+    parser.add_argument('--byte-budget', type=int, help='Prune to whatever anchor count, subbranch limit and prediction count keep the most score with dictionary.msgpack and tokens.msgpack within this many bytes.')
+    args = parser.parse_args()
+
+    create_dictionary_and_tokenize(args.vocabulary, args.rebuild_vocabulary, args.shard_size, args.byte_budget)
\ No newline at end of file
@@ -0,0 +1,164 @@
+import hashlib
+import math
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from lib.constants import DEDUP_THRESHOLD, DEDUP_MAX_DOCUMENTS, DEDUP_PERMUTATIONS, DEDUP_SHINGLE_SIZE
+
+MASK_64 = (1 << 64) - 1
+MASK_32 = (1 << 32) - 1
+
+def choose_bands(permutations, threshold):
+    """
+    The (bands, rows) split of a signature whose LSH S-curve turns at the threshold, (1/bands)^(1/rows),
+    that is closest to it. Documents at least that similar almost always share a band.
+    """
+    splits = [(bands, permutations // bands) for bands in range(1, permutations + 1) if permutations % bands == 0]
+    return min(splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold))
+
+class Deduplicator:
+    """
+    Drops repeated and near-repeated documents from the stream before they're filed.
+
+    Exact repeats are caught by a 64-bit blake2b of the document's whitespace-normalised text. Near
+    repeats by MinHash over word shingles, banded for LSH: a document is a candidate when any band of
+    its signature matches one seen before, and a duplicate when the signatures agree on at least
+    `threshold` of their slots, the Jaccard similarity estimate.
+
+    Signatures use one permutation hashing: each shingle is hashed once and only competes for the slot
+    its hash falls in, so a document costs one pass over its shingles rather than one per permutation.
+    Empty slots borrow from the next filled one.
+
+    Memory is bounded by max_documents: past that, the oldest signatures are forgotten first in first out,
+    and the least recently seen exact hashes, so a repeat of a long forgotten document gets through.
+    Shingles go through Python's hash(), which is seeded per process, so the store only means anything
+    within one run and is not saved with checkpoints.
+    """
+    def __init__(self, threshold=DEDUP_THRESHOLD, max_documents=DEDUP_MAX_DOCUMENTS, permutations=DEDUP_PERMUTATIONS, shingle_size=DEDUP_SHINGLE_SIZE):
+        if not 0 < threshold <= 1:
+            raise ValueError("Dedup threshold must be above 0 and at most 1")
+        self.threshold = threshold
+        self.max_documents = max_documents
+        self.permutations = permutations
+        self.shingle_size = shingle_size
+        self.bands, self.rows = choose_bands(permutations, threshold)
+        # Slots that have to agree for a candidate to count as a near duplicate
+        self.required = math.ceil(threshold * permutations)
+
+        self.exact = OrderedDict()
+        # One {band hash: document id} table per band, the signatures they point at, and ids oldest first
+        self.buckets = [{} for _ in range(self.bands)]
+        self.signatures = {}
+        self.order = deque()
+        self.next_id = 0
+
+        self.documents_seen = 0
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.words_skipped = 0
+
+    @property
+    def documents_skipped(self):
+        return self.exact_duplicates + self.near_duplicates
+
+    def counters(self):
+        return {
+            "dedup_documents_seen": self.documents_seen,
+            "dedup_documents_skipped": self.documents_skipped,
+            "dedup_exact_duplicates": self.exact_duplicates,
+            "dedup_near_duplicates": self.near_duplicates,
+            "dedup_words_skipped": self.words_skipped,
+        }
+
+    def signature(self, words):
+        """MinHash signature of the document's word shingles, or None if it has fewer words than a shingle."""
+        size = self.shingle_size
+        if len(words) < size:
+            return None
+        permutations = self.permutations
+        slots = [MASK_64] * permutations
+        for shingle in zip(*(words[offset:] for offset in range(size))):
+            value = hash(shingle) & MASK_64
+            slot = value % permutations
+            value //= permutations
+            if value < slots[slot]:
+                slots[slot] = value
+
+        # Densify: an empty slot takes the next filled slot's value, offset by how far it had to look
+        filled = [slot for slot in range(permutations) if slots[slot] != MASK_64]
+        if len(filled) < permutations:
+            for slot in range(permutations):
+                if slots[slot] == MASK_64:
+                    index = bisect_left(filled, slot)
+                    source = filled[index] if index < len(filled) else filled[0]
+                    slots[slot] = slots[source] + (source - slot) % permutations
+        return array('I', (value & MASK_32 for value in slots))
+
+    def band_keys(self, signature):
+        rows = self.rows
+        return [hash(tuple(signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+
+    def is_near_duplicate(self, signature, keys):
+        checked = set()
+        for band, key in enumerate(keys):
+            candidate = self.buckets[band].get(key)
+            if candidate is None or candidate in checked:
+                continue
+            checked.add(candidate)
+            other = self.signatures[candidate]
+            if sum(a == b for a, b in zip(signature, other)) >= self.required:
+                return True
+        return False
+
+    def remember(self, digest, signature, keys):
+        self.exact[digest] = None
+        if len(self.exact) > self.max_documents:
+            self.exact.popitem(last=False)
+        if signature is None:
+            return
+
+        document_id = self.next_id
+        self.next_id += 1
+        self.signatures[document_id] = signature
+        for band, key in enumerate(keys):
+            self.buckets[band][key] = document_id
+        self.order.append((document_id, keys))
+
+        if len(self.order) > self.max_documents:
+            oldest, oldest_keys = self.order.popleft()
+            del self.signatures[oldest]
+            for band, key in enumerate(oldest_keys):
+                # A later document may have taken the bucket over
+                if self.buckets[band].get(key) == oldest:
+                    del self.buckets[band][key]
+
+    def is_duplicate(self, text, words=None):
+        """Whether text repeats or nearly repeats a document seen before. Documents that don't are remembered."""
+        if words is None:
+            words = text.split()
+        self.documents_seen += 1
+
+        digest = hashlib.blake2b(" ".join(words).encode('utf-8'), digest_size=8).digest()
+        if digest in self.exact:
+            self.exact.move_to_end(digest)
+            self.exact_duplicates += 1
+            self.words_skipped += len(words)
+            return True
+
+        signature = self.signature([word.lower() for word in words])
+        keys = None
+        if signature is not None:
+            keys = self.band_keys(signature)
+            if self.is_near_duplicate(signature, keys):
+                self.near_duplicates += 1
+                self.words_skipped += len(words)
+                return True
+
+        self.remember(digest, signature, keys)
+        return False
+
+    def filter(self, documents):
+        """The documents that aren't duplicates, in order, and how many words were dropped with the rest."""
+        words_skipped = self.words_skipped
+        kept = [text for text in documents if not self.is_duplicate(text)]
+        return kept, self.words_skipped - words_skipped
@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+from lib.corpus_sources import LocalSource
+from lib.featurize_document import ENDING_PUNCTUATION_TABLE
+from lib.predict import Predictor, sanitize_text, apply_ambition_penalties, SECOND_LEVEL_LOOKBACK
+from lib.compiled_dictionary import CompiledPredictor
+from lib.sharded_dictionary import ShardedPredictor, INDEX_NAME
+
+# Words process_input looks at: the anchor, three words of first level context and the lookback before them.
+CONTEXT_WORDS = 4 + SECOND_LEVEL_LOOKBACK
+
+# Suggestions the page shows at once.
+SHOWN_SUGGESTIONS = 3
+
+# Quality is two levels of 0-50 plus an ambition penalty of -5 to 5, bucketed by tens.
+QUALITY_BUCKETS = 11
+
+# Upper bounds of the lookup latency histogram, in microseconds.
+LATENCY_BUCKETS = [2 ** power for power in range(3, 21)]
+
+# Reported with every evaluation: what the numbers describe, next to what the page ships.
+MATCHING = ("lib.predict, matching both context levels like wasm/src/lib.rs, except that quality's max distance "
+            "comes from the best match and the second level lookback never reads past the first level context")
+
+def new_totals():
+    return {
+        "documents": 0,
+        "positions": 0,
+        "covered": 0,
+        "top1": 0,
+        "top3": 0,
+        "keystrokes": 0,
+        "keystrokes_saved": 0,
+        "lookup_seconds": 0.0,
+        # Per quality bucket: top suggestions, how many were right, their summed quality
+        "calibration": [[0, 0, 0] for _ in range(QUALITY_BUCKETS)],
+        # The last bucket counts anything slower than LATENCY_BUCKETS goes
+        "latency": [0] * (len(LATENCY_BUCKETS) + 1),
+    }
+
+def add_totals(totals, other):
+    for key, value in other.items():
+        if key == "calibration":
+            for bucket, counts in zip(totals[key], value):
+                for index, count in enumerate(counts):
+                    bucket[index] += count
+        elif key == "latency":
+            totals[key] = [a + b for a, b in zip(totals[key], value)]
+        else:
+            totals[key] += value
+    return totals
+
+def latency_bucket(microseconds):
+    for bucket, bound in enumerate(LATENCY_BUCKETS):
+        if microseconds <= bound:
+            return bucket
+    return len(LATENCY_BUCKETS)
+
+def evaluate_document(predictor, text, totals):
+    """
+    Replay a held-out document as if it were typed, word by word, and add how the predictions did to totals.
+
+    After each word the predictor sees the text so far, the same as the page would, and its suggestions
+    are ranked the way tinypredict.js ranks them. Predictions come from lib.predict, which matches context
+    the way wasm/src/lib.rs does but for the two deliberate differences in MATCHING: qualities, and so
+    calibration, can differ slightly from the module's, as can predictions for inputs over 24 words. A suggestion is right when its words are the next words of
+    the document, compared without ending punctuation or case, as training stores them. For keystrokes,
+    the typist takes the longest right suggestion on show whenever there is one, saving its characters less
+    the one keystroke to accept it, and carries on after it.
+    """
+    words = text.split()
+    if not words:
+        return totals
+    totals["documents"] += 1
+    totals["keystrokes"] += len(" ".join(words))
+    targets = [word.translate(ENDING_PUNCTUATION_TABLE).lower() for word in words]
+
+    # Characters an accepted suggestion saves at each position, and how many words it covers
+    accepted = [None] * len(words)
+    context = []
+    for position in range(len(words) - 1):
+        token = sanitize_text(words[position])
+        if token:
+            context.append(token)
+            del context[:-CONTEXT_WORDS]
+
+        start = time.perf_counter()
+        suggestions = apply_ambition_penalties(predictor.predict(" ".join(context)))["prediction"]
+        elapsed = time.perf_counter() - start
+        totals["lookup_seconds"] += elapsed
+        totals["latency"][latency_bucket(elapsed * 1e6)] += 1
+
+        totals["positions"] += 1
+        if not suggestions:
+            continue
+        totals["covered"] += 1
+
+        right = []
+        for rank, suggestion in enumerate(suggestions[:SHOWN_SUGGESTIONS]):
+            completion = suggestion["completion"].lower().split()
+            if completion and targets[position + 1:position + 1 + len(completion)] == completion:
+                right.append((rank, suggestion["completion"], len(completion)))
+
+        top = suggestions[0]
+        bucket = totals["calibration"][min(max(top["quality"], 0) // 10, QUALITY_BUCKETS - 1)]
+        bucket[0] += 1
+        bucket[2] += top["quality"]
+        if right:
+            totals["top3"] += 1
+            if right[0][0] == 0:
+                totals["top1"] += 1
+                bucket[1] += 1
+            _, completion, length = max(right, key=lambda item: len(item[1]))
+            accepted[position] = (len(completion) - 1, length)
+
+    position = 0
+    while position < len(words) - 1:
+        if accepted[position] is None:
+            position += 1
+        else:
+            saved, length = accepted[position]
+            totals["keystrokes_saved"] += max(saved, 0)
+            position += length
+    return totals
+
+predictor = None
+
+def open_predictor(dictionary_path='dictionary.msgpack', tokens_path='tokens.msgpack', compiled_path=None, shards_path=None):
+    if compiled_path:
+        return CompiledPredictor(compiled_path)
+    if shards_path:
+        return ShardedPredictor(shards_path)
+    return Predictor.from_files(dictionary_path, tokens_path)
+
+def dictionary_bytes(dictionary_path='dictionary.msgpack', tokens_path='tokens.msgpack', compiled_path=None, shards_path=None):
+    """What the page would download to predict from this dictionary."""
+    if compiled_path:
+        return os.path.getsize(compiled_path)
+    if shards_path:
+        with open(os.path.join(shards_path, INDEX_NAME)) as f:
+            return sum(shard["bytes"] for shard in json.load(f)["shards"])
+    return os.path.getsize(dictionary_path) + os.path.getsize(tokens_path)
+
+def start_worker(paths):
+    global predictor
+    predictor = open_predictor(*paths)
+
+def evaluate_chunk(documents):
+    totals = new_totals()
+    for text in documents:
+        evaluate_document(predictor, text, totals)
+    return totals
+
+def percentile(histogram, fraction):
+    """Upper bound, in microseconds, of the latency bucket the given fraction of lookups fall within."""
+    target = fraction * sum(histogram)
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if count and seen >= target:
+            return LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else None
+    return None
+
+def report(totals):
+    positions = totals["positions"] or 1
+    calibration = []
+    calibration_error = 0.0
+    for bucket, (suggestions, hits, quality) in enumerate(totals["calibration"]):
+        if not suggestions:
+            continue
+        hit_rate = hits / suggestions
+        mean_quality = quality / suggestions
+        calibration.append({"quality": f"{bucket * 10}+" if bucket == QUALITY_BUCKETS - 1 else f"{bucket * 10}-{bucket * 10 + 9}",
+                            "suggestions": suggestions, "mean_quality": round(mean_quality, 2), "top1_hit_rate": round(hit_rate, 4)})
+        # Reading quality as a percentage chance the top suggestion is right
+        calibration_error += suggestions / (totals["covered"] or 1) * abs(hit_rate - min(max(mean_quality, 0), 100) / 100)
+
+    return {
+        "documents": totals["documents"],
+        "positions": totals["positions"],
+        "coverage": round(totals["covered"] / positions, 4),
+        "top1_hit_rate": round(totals["top1"] / positions, 4),
+        "top3_hit_rate": round(totals["top3"] / positions, 4),
+        "top1_hit_rate_when_shown": round(totals["top1"] / (totals["covered"] or 1), 4),
+        "keystrokes": totals["keystrokes"],
+        "keystrokes_saved": totals["keystrokes_saved"],
+        "keystroke_savings": round(totals["keystrokes_saved"] / (totals["keystrokes"] or 1), 4),
+        "calibration": calibration,
+        "expected_calibration_error": round(calibration_error, 4),
+        "latency_us": {
+            "mean": round(totals["lookup_seconds"] / positions * 1e6, 2),
+            "p50": percentile(totals["latency"], 0.5),
+            "p95": percentile(totals["latency"], 0.95),
+            "p99": percentile(totals["latency"], 0.99),
+        },
+    }
+
+def main(held_out, dictionary_path='dictionary.msgpack', tokens_path='tokens.msgpack', compiled_path=None, shards_path=None, workers=1, max_documents=None):
+    """Evaluate a dictionary on held-out shards (anything --source local reads) and return the report."""
+    paths = (dictionary_path, tokens_path, compiled_path, shards_path)
+    source = LocalSource(held_out)
+
+    def chunks():
+        remaining = max_documents
+        for chunk in source.iter_chunks():
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            if chunk:
+                yield chunk
+            if remaining == 0:
+                return
+
+    start = time.perf_counter()
+    totals = new_totals()
+    if workers > 1:
+        # Each process opens the dictionary once and takes a chunk of documents at a time
+        with Pool(workers, initializer=start_worker, initargs=(paths,)) as pool:
+            for chunk_totals in pool.imap_unordered(evaluate_chunk, chunks()):
+                add_totals(totals, chunk_totals)
+    else:
+        start_worker(paths)
+        for chunk in chunks():
+            add_totals(totals, evaluate_chunk(chunk))
+    elapsed = time.perf_counter() - start
+
+    result = {"dictionary": {"path": compiled_path or shards_path or dictionary_path, "bytes": dictionary_bytes(*paths)}, "matching": MATCHING}
+    result.update(report(totals))
+    result["seconds"] = round(elapsed, 3)
+    result["positions_per_second"] = round(totals["positions"] / elapsed) if elapsed else None
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay held-out text through a built dictionary and report how well it predicts.")
+    parser.add_argument('held_out', nargs='+', help='Held-out shard files or directories (.txt, .jsonl, optionally .gz/.zst).')
+    parser.add_argument('--dictionary', default='dictionary.msgpack')
+    parser.add_argument('--tokens', default='tokens.msgpack')
+    parser.add_argument('--compiled', help='Evaluate a compiled dictionary instead of the msgpack files.')
+    parser.add_argument('--shards', help='Evaluate a sharded dictionary directory instead of the msgpack files.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes to split the held-out documents across.')
+    parser.add_argument('--max-documents', type=int, help='Stop after this many held-out documents.')
+    parser.add_argument('--output', help='Also write the report to this JSON file.')
+    args = parser.parse_args()
+
+    result = main(args.held_out, args.dictionary, args.tokens, args.compiled, args.shards, max(args.workers, 1), args.max_documents)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
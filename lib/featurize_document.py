@@ -0,0 +1,47 @@
+from lib.process_context_words import EXTRA_WORDS
+from lib.process_predictive_words import ENDING_PUNCTUATION
+
+# Deletes ending punctuation in one C-level pass per word.
+ENDING_PUNCTUATION_TABLE = {ord(char): None for char in ENDING_PUNCTUATION}
+
+def main(words):
+    """
+    Returns every (anchor, first_clause, second_clause, prediction) window of a tokenized document.
+
+    Gives exactly what process_context_words and process_predictive_words return for each index in
+    range(len(words) - 2), but looks at every word once instead of once per window it falls in.
+    """
+    word_total = len(words)
+
+    # Per-word features, computed once
+    initials = [word[0].lower() if word else "" for word in words]
+    # Initials as they appear in the first clause, where extra words are dropped
+    first_clause_initials = ["" if word.lower() in EXTRA_WORDS else initial for word, initial in zip(words, initials)]
+    cleaned_words = [word.translate(ENDING_PUNCTUATION_TABLE) for word in words]
+    # A word ends a prediction when cleaning removed something from it
+    ends_prediction = [cleaned != word for cleaned, word in zip(cleaned_words, words)]
+
+    windows = []
+    for index in range(word_total - 2):
+        # Second clause: the three words immediately before the anchor
+        if index >= 3:
+            second_clause = initials[index - 3] + initials[index - 2] + initials[index - 1]
+        else:
+            second_clause = "".join(initials[:index])
+
+        # First clause: the three words before those. Shorter documents leave it empty.
+        if index >= 6:
+            first_clause = first_clause_initials[index - 6] + first_clause_initials[index - 5] + first_clause_initials[index - 4]
+        else:
+            first_clause = ""
+
+        # Prediction: up to three words, stopping after the first one with ending punctuation
+        prediction = [cleaned_words[index + 1]]
+        if not ends_prediction[index + 1]:
+            prediction.append(cleaned_words[index + 2])
+            if not ends_prediction[index + 2] and index + 3 < word_total:
+                prediction.append(cleaned_words[index + 3])
+
+        windows.append((words[index], first_clause, second_clause, prediction))
+
+    return windows
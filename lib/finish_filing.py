@@ -2,6 +2,9 @@ def main(tree_store, context_words, predictive_words):
     first_clause, second_clause = context_words.get("context_window", ["", ""])
     anchor = context_words.get("anchor", "")
 
+    return file_entry(tree_store, anchor, first_clause, second_clause, predictive_words)
+
+def file_entry(tree_store, anchor, first_clause, second_clause, predictive_words):
     anchor_dict = tree_store.setdefault(anchor, {"score": 0})
     anchor_dict["score"] += 1
 
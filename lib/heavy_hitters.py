@@ -0,0 +1,154 @@
+import heapq
+from lib.tree_store import RESERVED_KEYS
+
+# Rough heap cost of one monitored key in each summary: its count, error and heap entry plus the key itself.
+BYTES_PER_MONITORED_KEY = {"anchors": 180, "contexts": 250, "predictions": 350}
+
+class SpaceSaving:
+    """
+    Space-Saving summary of the most frequent keys in a stream, in a fixed number of slots.
+
+    Once every slot is taken, a new key replaces the key with the smallest count and inherits that count
+    as its error. A reported count is never below the true count and overestimates it by at most
+    error(key), which is itself at most total / capacity. Any key seen more than total / capacity times
+    is guaranteed to be monitored.
+    """
+    __slots__ = ("capacity", "counts", "errors", "heap", "total", "sequence")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # One (count, sequence, key) entry per monitored key. Counts in here may lag behind self.counts,
+        # they're refreshed lazily when an entry reaches the top.
+        self.heap = []
+        self.total = 0
+        # Breaks ties in the heap so keys themselves are never compared
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __getitem__(self, key):
+        return self.counts[key]
+
+    def add(self, key, count=1):
+        """Count key. Returns the key that was evicted to make room, if any."""
+        self.total += count
+        counts = self.counts
+
+        if key in counts:
+            counts[key] += count
+            return None
+
+        evicted = None
+        error = 0
+        if len(counts) >= self.capacity:
+            evicted, error = self._pop_minimum()
+
+        counts[key] = error + count
+        self.errors[key] = error
+        self.sequence += 1
+        heapq.heappush(self.heap, (error + count, self.sequence, key))
+        return evicted
+
+    def _pop_minimum(self):
+        heap = self.heap
+        counts = self.counts
+        while True:
+            count, _, key = heap[0]
+            current = counts[key]
+            if current == count:
+                heapq.heappop(heap)
+                del counts[key]
+                del self.errors[key]
+                return key, count
+            self.sequence += 1
+            heapq.heapreplace(heap, (current, self.sequence, key))
+
+    def error(self, key):
+        return self.errors[key]
+
+    def error_bound(self):
+        """No reported count is more than this above the true count."""
+        return self.total // self.capacity if len(self.counts) >= self.capacity else 0
+
+    def guaranteed(self, key):
+        """Lowest the true count of a monitored key can be."""
+        return self.counts[key] - self.errors[key]
+
+    def top(self, limit):
+        """The `limit` keys with the highest counts, ties going to the key added first."""
+        return heapq.nlargest(limit, self.counts, key=self.counts.__getitem__)
+
+class HeavyHitterStore:
+    """
+    Fixed-size stand-in for the tree store, for training runs that should never flush.
+
+    Anchors, (anchor, second clause, first clause) contexts and context predictions each get a Space-Saving
+    summary, so memory stays flat however long training runs. Pruning happens on counts accumulated over
+    the whole run instead of whatever happened to be frequent since the last flush.
+    """
+    __slots__ = ("anchors", "contexts", "predictions")
+
+    def __init__(self, anchor_capacity, context_capacity, prediction_capacity):
+        self.anchors = SpaceSaving(anchor_capacity)
+        self.contexts = SpaceSaving(context_capacity)
+        self.predictions = SpaceSaving(prediction_capacity)
+
+    def __len__(self):
+        return len(self.anchors)
+
+    def add(self, anchor, first_clause, second_clause, predictive_words):
+        context = (anchor, second_clause, first_clause)
+        self.anchors.add(anchor)
+        self.contexts.add(context)
+        self.predictions.add(context + (tuple(predictive_words),))
+
+    def node_counts(self):
+        return {"anchors": len(self.anchors), "contexts": len(self.contexts), "predictions": len(self.predictions)}
+
+    def estimated_bytes(self):
+        return sum(count * BYTES_PER_MONITORED_KEY[kind] for kind, count in self.node_counts().items())
+
+    def usage(self):
+        return dict(self.node_counts(), estimated_bytes=self.estimated_bytes())
+
+    def error_bounds(self):
+        return {
+            "anchors": self.anchors.error_bound(),
+            "contexts": self.contexts.error_bound(),
+            "predictions": self.predictions.error_bound(),
+        }
+
+    def to_nested_dict(self, anchor_limit=None):
+        """Export the monitored counts in the nested dict format, keeping only the top anchors if asked."""
+        if anchor_limit is None:
+            anchors = list(self.anchors.counts)
+        else:
+            anchors = self.anchors.top(anchor_limit)
+
+        anchor_dicts = {anchor: {"score": self.anchors[anchor]} for anchor in anchors}
+
+        for context, score in self.contexts.counts.items():
+            anchor, second_clause, first_clause = context
+            anchor_dict = anchor_dicts.get(anchor)
+            if anchor_dict is None:
+                continue
+            second_clause_dict = anchor_dict.setdefault(second_clause, {"score": 0})
+            second_clause_dict["score"] += score
+            second_clause_dict[first_clause] = {"score": score, "predictions": []}
+
+        for key, score in self.predictions.counts.items():
+            anchor, second_clause, first_clause, prediction = key
+            anchor_dict = anchor_dicts.get(anchor)
+            if anchor_dict is None or second_clause not in anchor_dict or first_clause not in anchor_dict[second_clause]:
+                # The context itself was evicted.
+                continue
+            anchor_dict[second_clause][first_clause]["predictions"].append({"prediction": list(prediction), "score": score})
+
+        # Same escaping TreeStore applies to anchors that clash with the format's own keys.
+        return {("\\s" + anchor if anchor in RESERVED_KEYS else anchor): anchor_dict for anchor, anchor_dict in anchor_dicts.items()}
@@ -2,8 +2,15 @@ import os
 import shutil
 import pickle
 import threading
+import heapq
+import itertools
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from .constants import TARGET_DICTIONARY_COUNT, MAX_PREDICTIONS, SUBBRANCH_PRUNE_SIZE
 from .create_dictionary import create_dictionary_and_tokenize
+from .batch_files import load_batch, write_batch, iter_batch, is_batch_file, merged_batch_name
+from .prune import prune_tree, prune_branches
+from .batch_manifest import load_manifest, save_manifest, is_folded, record_batches, file_checksum, MANIFEST_PATH
 import asyncio
 # PRUNE_FREQUENCY = 4 * 1000 * 1000 # Every this many words
 # TARGET_DICTIONARY_COUNT = 100
@@ -75,8 +82,9 @@ def merge(tree1, tree2):
     # Initialize a new tree to hold the merge result
     merged_tree = {}
 
-    # Get all unique keys from both trees
-    all_keys = set(tree1.keys()) | set(tree2.keys())
+    # Get all unique keys from both trees. Kept in insertion order rather than set order so ties in
+    # prune() don't depend on string hashing, which differs between processes.
+    all_keys = list(tree1) + [key for key in tree2 if key not in tree1]
 
     for key in all_keys:
         if key in tree1 and key in tree2:
@@ -106,62 +114,105 @@ def merge(tree1, tree2):
     return merged_tree
   
 def prune(merged_content, target_dict_size=TARGET_DICTIONARY_COUNT):
-    def sort_keys_by_score(tree):
-          # Sorts the tree's top-level keys based on their child score "score", highest first
-          # Keeps the "score" key intact
-          sorted_items = sorted(
-              [(k, v) for k, v in tree.items() if k != "score" and isinstance(v, dict)],
-              key=lambda item: item[1]["score"] if "score" in item[1] else 0, reverse=True
-          )
-          sorted_tree = {"score": tree.get("score", 0)} if "score" in tree else {}  # Preserve "score" score if it exists
-          sorted_tree.update(dict(sorted_items))
-          return sorted_tree
-
-    def prune_top_level_entries_by_limit(tree, target_dict_size):
-          pruned_tree = tree
-          keys_to_delete = list(tree.keys())[target_dict_size:]
-          for key in keys_to_delete:
-              pruned_tree.pop(key)
-          return pruned_tree
-
-    top_sorted_tree = sort_keys_by_score(merged_content)
-    top_pruned_tree = prune_top_level_entries_by_limit(top_sorted_tree, target_dict_size)
-
-    def prune_and_sort_lower_branches(subtree, limit):
-        if isinstance(subtree, dict):
-            # Directly check for existence rather than getting a False default
-            score_present = "score" in subtree  # Check if 'score' key exists
-            predictions = subtree.get("predictions", False)  # Preserve predictions, if any
-            
-            # Filter out the special keys for sorting and pruning operations
-            filtered_subtree = {k: v for k, v in subtree.items() if k not in ["score", "predictions"]}
-            
-            top_sorted_subtree = sort_keys_by_score(filtered_subtree)
-            pruned_subtree = prune_top_level_entries_by_limit(top_sorted_subtree, limit)
-            
-            # Re-insert the 'score' if it was originally present, using a more reliable check
-            if score_present:
-                pruned_subtree["score"] = subtree["score"]  # Directly use the value from original subtree
-            
-            if predictions:  
-              sorted_predictions = sorted(predictions, key=lambda x: x['score'], reverse=True)[:MAX_PREDICTIONS]
-              pruned_subtree["predictions"] = sorted_predictions
-
-            # Recursively process each child, skipping special keys
-            for k, v in list(pruned_subtree.items()):
-                if k not in ["score", "predictions"] and isinstance(v, dict):
-                    pruned_subtree[k] = prune_and_sort_lower_branches(v, SUBBRANCH_PRUNE_SIZE)
-                    
-            return pruned_subtree
+    """Keep the target_dict_size best anchors and prune their branches. Works in place, see lib.prune."""
+    return prune_tree(merged_content, target_dict_size)
+
+def merge_subtrees(subtree1, subtree2):
+    """
+    Merge two subtrees of the same anchor, summing the anchor score the way merge() does one level up.
+    """
+    merged_subtree = merge(subtree1, subtree2)
+    merged_subtree['score'] = subtree1.get('score', 0) + subtree2.get('score', 0)
+    return merged_subtree
+
+def kway_merge(paths, target_dict_size=TARGET_DICTIONARY_COUNT):
+    """
+    Merge any number of batches in a single pass and return the pruned result.
+
+    Every batch is streamed in anchor order, so only the current anchor's subtree from each input is in
+    memory, plus the best target_dict_size anchors so far. Subtrees of the same anchor are folded together
+    with merge(), pruned once complete, and kept only if they make the running top-k.
+    """
+    # Nothing can make an empty top-k, the same as prune() keeping nothing
+    if target_dict_size <= 0:
+        return {}
+
+    streams = [
+        ((anchor, subtree) for anchor, subtree in iter_batch(path) if isinstance(subtree, dict))
+        for path in paths
+    ]
+    # heapq.merge is stable, so equal anchors come out in input order and the result is deterministic.
+    records = heapq.merge(*streams, key=lambda record: record[0])
+
+    top_anchors = []  # Min-heap of (score, -sequence, anchor, subtree)
+    for sequence, (anchor, group) in enumerate(itertools.groupby(records, key=lambda record: record[0])):
+        subtrees = [subtree for _, subtree in group]
+        merged_subtree = subtrees[0]
+        for subtree in subtrees[1:]:
+            merged_subtree = merge_subtrees(merged_subtree, subtree)
+
+        # Ties go to the anchor that sorts first, which is what the final stable sort would keep.
+        rank = (merged_subtree.get('score', 0), -sequence)
+        if len(top_anchors) >= target_dict_size and rank <= top_anchors[0][:2]:
+            continue
+
+        # The anchor is complete, so its lower branches can be cut down to size before it's kept.
+        entry = rank + (anchor, prune_branches(merged_subtree))
+        if len(top_anchors) < target_dict_size:
+            heapq.heappush(top_anchors, entry)
         else:
-            return subtree
+            heapq.heapreplace(top_anchors, entry)
+
+    merged_content = {anchor: subtree for _, _, anchor, subtree in sorted(top_anchors, key=lambda entry: entry[2])}
+    return prune(merged_content, target_dict_size)
+
+def merge_pair(file1_path, file2_path, merged_path, target_dict_size=TARGET_DICTIONARY_COUNT):
+    """Merge and prune two batch files into merged_path. Returns None if either can't be unpickled."""
+    try:
+        content1 = load_batch(file1_path)
+        content2 = load_batch(file2_path)
+    except pickle.UnpicklingError as e:
+        print(f"Error unpickling the files: {e}")
+        return None
+
+    write_batch(prune(merge(content1, content2), target_dict_size), merged_path)
+    return merged_path
+
+def parallel_merge(paths, merged_directory, workers=None, target_dict_size=TARGET_DICTIONARY_COUNT):
+    """
+    Reduce batches pairwise as a tree, merging the pairs of each round on a process pool.
+
+    Pairs, file names and ordering follow merge_and_prune_files exactly: each round pairs up the files
+    sorted by name, names each result after its first file with a _merged suffix, and carries an odd file
+    over as is. So the result is the same as the serial merge however many workers run it.
+    Returns the path of the final batch.
+    """
+    current = sorted(paths, key=os.path.basename)
+    intermediate = []
 
-    for k in list(top_pruned_tree.keys()):
-        if k != "score":
-            subtree = top_pruned_tree[k]
-            top_pruned_tree[k] = prune_and_sort_lower_branches(subtree, SUBBRANCH_PRUNE_SIZE)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while len(current) > 1:
+            futures = []
+            for index in range(0, len(current) - 1, 2):
+                file1_path, file2_path = current[index], current[index + 1]
+                merged_path = os.path.join(merged_directory, merged_batch_name(file1_path))
+                futures.append(executor.submit(merge_pair, file1_path, file2_path, merged_path, target_dict_size))
 
-    return top_pruned_tree 
+            next_round = [future.result() for future in futures]
+            next_round = [path for path in next_round if path]
+            intermediate.extend(next_round)
+            if len(current) % 2:
+                next_round.append(current[-1])
+
+            current = sorted(next_round, key=os.path.basename)
+            print(f"Merge round done, {len(current)} batches left.")
+
+    final_path = current[0] if current else None
+    for path in intermediate:
+        if path != final_path and os.path.exists(path):
+            os.remove(path)
+
+    return final_path
 
 def perform_file_operation(src, dst, operation='move'):
     try:
@@ -179,9 +230,8 @@ def merge_and_prune_files(files, threads):
 
     # Get the contents of each file
     try:
-        with open(file1_path, 'rb') as f1, open(file2_path, 'rb') as f2:
-            content1 = pickle.load(f1)
-            content2 = pickle.load(f2)
+        content1 = load_batch(file1_path)
+        content2 = load_batch(file2_path)
     except pickle.UnpicklingError as e:
         print(f"Error unpickling the files: {e}")
         thread6 = threading.Thread(target=perform_file_operation, args=(file1_path, f'training/processed_batches/{os.path.basename(file1_path)}', 'move'))
@@ -199,9 +249,8 @@ def merge_and_prune_files(files, threads):
     pruned_content = prune(merged_content)
 
     # Save the result in training/merged_batches
-    merged_filename = os.path.basename(file1_path).replace('.pkl', '') + '_merged.pkl'
-    with open(f'training/merged_batches/{merged_filename}', 'wb') as f:
-        pickle.dump(pruned_content, f)
+    merged_filename = merged_batch_name(file1_path)
+    write_batch(pruned_content, f'training/merged_batches/{merged_filename}')
 
     # Move the two files into training/processed_batches
     thread1 = threading.Thread(target=perform_file_operation, args=(file1_path, f'training/processed_batches/{os.path.basename(file1_path)}', 'move'))
@@ -242,16 +291,19 @@ def merge_and_prune_files(files, threads):
             thread4 = threading.Thread(target=perform_file_operation, args=(f'training/batches_to_process/{remaining_files[0]}', f'training/merged_batches/{remaining_files[0]}', 'move'))
             threads.append(thread4)
             thread4.start()
+            # The odd file has to be in merged_batches before it's listed, or it would miss the next round.
+            thread4.join()
 
             for file in os.listdir('training/merged_batches'):
                 thread5 = threading.Thread(target=perform_file_operation, args=(f'training/merged_batches/{file}', f'training/batches_to_process/{file}', 'move'))
                 threads.append(thread5)
                 thread5.start()
-            batches_files = sorted(os.listdir('training/batches_to_process'))
 
             for thread in threads:
                 thread.join()
 
+            batches_files = sorted(os.listdir('training/batches_to_process'))
+
             if len(batches_files) > 1:
                 merge_and_prune_files(batches_files, threads)
             else:
@@ -282,6 +334,99 @@ def finish_merge():
     shutil.rmtree('training/copy_of_batches_being_processed_in_this_round', ignore_errors=True)
     shutil.copy('training/dictionary.pkl', 'training/batches')
 
+def kway_main(target_dict_size=TARGET_DICTIONARY_COUNT):
+    """Merge everything in training/batches in one streaming pass and build the dictionary from it."""
+    batches_files = sorted(file for file in os.listdir('training/batches') if is_batch_file(file))
+    if not batches_files:
+        print("No batches to merge.")
+        return
+
+    batch_paths = [f'training/batches/{file}' for file in batches_files]
+    merged_content = kway_merge(batch_paths, target_dict_size)
+    print(f"Merged {len(batch_paths)} batches in one pass.")
+
+    write_batch(merged_content, 'training/merged_dictionary.pkl')
+    publish_merged_dictionary('training/merged_dictionary.pkl', batch_paths)
+
+def parallel_main(workers=None, target_dict_size=TARGET_DICTIONARY_COUNT):
+    """Merge everything in training/batches as a tree reduction on a process pool and build the dictionary."""
+    batches_files = sorted(file for file in os.listdir('training/batches') if is_batch_file(file))
+    if not batches_files:
+        print("No batches to merge.")
+        return
+
+    batch_paths = [f'training/batches/{file}' for file in batches_files]
+    merged_path = parallel_merge(batch_paths, 'training/merged_batches', workers, target_dict_size)
+    if merged_path is None:
+        print("None of the batches could be loaded.")
+        return
+    print(f"Merged {len(batch_paths)} batches.")
+
+    publish_merged_dictionary(merged_path, batch_paths)
+
+def publish_merged_dictionary(merged_path, batch_paths):
+    """Make merged_path the new training/dictionary.pkl, drop the batches it came from and build the dictionary."""
+    if merged_path in batch_paths:
+        # A single batch is its own merge result.
+        shutil.copy(merged_path, 'training/merged_dictionary.pkl')
+        merged_path = 'training/merged_dictionary.pkl'
+
+    # Copy the merged file to backup just in case.
+    shutil.copy(merged_path, 'backup/dictionary.pkl')
+    if os.path.exists('training/processing_progress.txt'):
+        shutil.copy('training/processing_progress.txt', 'backup/processing_progress.txt')
+
+    # Only the batches that were merged are removed; training may have written new ones meanwhile.
+    for path in batch_paths:
+        os.remove(path)
+    shutil.move(merged_path, 'training/dictionary.pkl')
+
+    create_dictionary_and_tokenize()
+
+    # Carry the merged result into the next round, like finish_merge does.
+    shutil.copy('training/dictionary.pkl', 'training/batches')
+
+def incremental_main(rebuild=False, target_dict_size=TARGET_DICTIONARY_COUNT):
+    """
+    Fold only the batches that aren't in training/dictionary.pkl yet into it, then build the dictionary.
+
+    training/manifest.json records every batch already folded in, so each run costs the new batches plus
+    the (already pruned) merged dictionary. Batches are left in training/batches so --rebuild can start over.
+    """
+    manifest = {"batches": {}, "dictionary": None} if rebuild else load_manifest()
+    dictionary_path = 'training/dictionary.pkl'
+
+    has_dictionary = not rebuild and os.path.exists(dictionary_path)
+    if has_dictionary and manifest["dictionary"] != file_checksum(dictionary_path):
+        print(f"{dictionary_path} doesn't match {MANIFEST_PATH}, so it's unclear which batches it holds. Run again with --rebuild.")
+        return
+
+    # Other strategies leave a copy of the merged dictionary in batches; it's not a batch of its own.
+    batches_files = sorted(file for file in os.listdir('training/batches') if is_batch_file(file) and file != 'dictionary.pkl')
+    new_files = [file for file in batches_files if not is_folded(manifest, 'training/batches', file)]
+    if not new_files:
+        print("No new batches to merge.")
+        return
+
+    input_paths = [f'training/batches/{file}' for file in new_files]
+    if has_dictionary:
+        input_paths.append(dictionary_path)
+
+    merged_content = kway_merge(input_paths, target_dict_size)
+    print(f"Merged {len(new_files)} new batches into the dictionary.")
+
+    write_batch(merged_content, 'training/merged_dictionary.pkl')
+    shutil.copy('training/merged_dictionary.pkl', 'backup/dictionary.pkl')
+    if os.path.exists('training/processing_progress.txt'):
+        shutil.copy('training/processing_progress.txt', 'backup/processing_progress.txt')
+
+    record_batches(manifest, 'training/batches', new_files)
+    manifest["dictionary"] = file_checksum('training/merged_dictionary.pkl')
+    os.replace('training/merged_dictionary.pkl', dictionary_path)
+    save_manifest(manifest)
+
+    create_dictionary_and_tokenize()
+
 async def main():
     # If training/batches has more than one file, run the function with the first two files
     os.makedirs('training/copy_of_batches_being_processed_in_this_round', exist_ok=True)
@@ -289,7 +434,7 @@ async def main():
     os.makedirs('training/batches_to_process', exist_ok=True)
     threads = []
 
-    for file in os.listdir('training/batches'):
+    for file in filter(is_batch_file, os.listdir('training/batches')):
         thread = threading.Thread(target=perform_file_operation, args=(f'training/batches/{file}', f'training/copy_of_batches_being_processed_in_this_round/{file}', 'move'))
         threads.append(thread)
         thread.start()
@@ -314,4 +459,17 @@ async def main():
         finish_merge()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='Merge training batches and build the dictionary.')
+    parser.add_argument('--strategy', choices=['pairwise', 'kway', 'parallel', 'incremental'], default='pairwise', help='pairwise merges batches two at a time, kway streams them all in one pass, parallel runs the pairwise rounds on a process pool, incremental folds only new batches into the existing dictionary.')
+    parser.add_argument('--workers', type=int, default=None, help='Processes for --strategy parallel. Defaults to the number of CPUs.')
+    parser.add_argument('--rebuild', action='store_true', help='For --strategy incremental, forget the manifest and merge every batch from scratch.')
+    args = parser.parse_args()
+
+    if args.strategy == 'incremental':
+        incremental_main(args.rebuild)
+    elif args.strategy == 'kway':
+        kway_main()
+    elif args.strategy == 'parallel':
+        parallel_main(args.workers)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,130 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# Prefix of every exported Prometheus metric.
+PROMETHEUS_PREFIX = "tiny_predictive_text"
+
+def peak_rss_bytes():
+    """Peak resident memory of this process, or None where there's no resource module (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux reports ru_maxrss in kilobytes, macOS in bytes.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+class Metrics:
+    """
+    Cumulative stage timings, counters and gauges for the training loop.
+
+    Stages are timed with plain perf_counter pairs around work that takes at least a document's worth of
+    time, so keeping them on costs well under 1%. Everything is exported to `path` at most once every
+    `interval` seconds: Prometheus text format if the path ends in .prom, JSON otherwise. Files are
+    replaced atomically so a scraper never sees half a file.
+    """
+    def __init__(self, path=None, interval=30.0):
+        self.path = path
+        self.interval = interval
+        self.started = time.time()
+        self.last_export = time.monotonic()
+        # stage -> [seconds, calls]
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def add_time(self, stage, seconds, calls=1):
+        totals = self.stages.get(stage)
+        if totals is None:
+            self.stages[stage] = [seconds, calls]
+        else:
+            totals[0] += seconds
+            totals[1] += calls
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed_iter(self, stage, iterable):
+        """Yield from iterable, counting the time spent waiting for each item towards stage."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe_usage(self, usage, prefix="tree_store"):
+        """Record a tree store's node counts and estimated size, as returned by its usage()."""
+        for kind, value in usage.items():
+            self.gauges[f"{prefix}_{kind}"] = value
+
+    def snapshot(self):
+        elapsed = time.time() - self.started
+        gauges = dict(self.gauges)
+        peak_rss = peak_rss_bytes()
+        if peak_rss is not None:
+            gauges["peak_rss_bytes"] = peak_rss
+        if "words_read" in self.counters and elapsed > 0:
+            gauges["words_per_second"] = round(self.counters["words_read"] / elapsed, 1)
+
+        return {
+            "timestamp": time.time(),
+            "elapsed_seconds": round(elapsed, 3),
+            "stages": {
+                stage: {"seconds": round(seconds, 6), "calls": calls, "share": round(seconds / elapsed, 4) if elapsed > 0 else 0}
+                for stage, (seconds, calls) in self.stages.items()
+            },
+            "counters": dict(self.counters),
+            "gauges": gauges,
+        }
+
+    def maybe_export(self):
+        if self.path and time.monotonic() - self.last_export >= self.interval:
+            self.export()
+
+    def export(self):
+        if not self.path:
+            return
+        snapshot = self.snapshot()
+        content = to_prometheus(snapshot) if self.path.endswith(".prom") else json.dumps(snapshot, indent=2)
+
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(content)
+        os.replace(self.path + '.tmp', self.path)
+        self.last_export = time.monotonic()
+
+def to_prometheus(snapshot):
+    lines = []
+    def metric(name, kind, samples):
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{labels} {value}")
+
+    stages = snapshot["stages"]
+    metric("stage_seconds_total", "counter", [(f'{{stage="{stage}"}}', totals["seconds"]) for stage, totals in stages.items()])
+    metric("stage_calls_total", "counter", [(f'{{stage="{stage}"}}', totals["calls"]) for stage, totals in stages.items()])
+    for counter, value in snapshot["counters"].items():
+        metric(f"{counter}_total", "counter", [("", value)])
+    for gauge, value in snapshot["gauges"].items():
+        metric(gauge, "gauge", [("", value)])
+    metric("elapsed_seconds", "gauge", [("", snapshot["elapsed_seconds"])])
+
+    return "\n".join(lines) + "\n"
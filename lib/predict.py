@@ -0,0 +1,250 @@
+import argparse
+import json
+import sys
+from functools import lru_cache
+import msgpack
+
+# ⚠️ Make sure this matches the parallel implementation in lib.rs.
+EXCLUDED_WORDS = frozenset([
+    "and", "or", "but", "if", "of", "at", "by", "for", "with", "to", "in", "on",
+    "am", "is", "are", "was", "were", "be", "been", "being",
+    "have", "has", "had", "having",
+    "the", "a", "an",
+])
+
+# How far before the first level context the second level context may look.
+SECOND_LEVEL_LOOKBACK = 20
+
+# Quality adjustment by number of words in a completion, from tinypredict.js
+AMBITION_PENALTIES = {1: 5, 2: -1, 3: -5}
+
+def sanitize_text(text):
+    """Drops everything but letters, digits and whitespace and lowercases the rest, like sanitize_text in lib.rs."""
+    return "".join(char for char in text if char.isalnum() or char.isspace()).lower()
+
+def acronymize_context(words):
+    return "".join(word[0] for word in words if word).lower()
+
+def process_input(text):
+    """Split an input into its anchor and the two context acronyms the dictionary is keyed on."""
+    words = sanitize_text(text).split()
+    if not words:
+        return "", "", ""
+
+    anchor = words[-1]
+    # The up to three words right before the anchor
+    first_level_context = acronymize_context(words[-4:-1])
+
+    second_level_context = ""
+    if len(words) > 3:
+        # Up to SECOND_LEVEL_LOOKBACK words before the first level context, minus filler words, last three kept
+        end = len(words) - 4
+        start = max(0, end - SECOND_LEVEL_LOOKBACK)
+        significant_words = [word for word in words[start:end] if word not in EXCLUDED_WORDS]
+        second_level_context = acronymize_context(significant_words[-3:])
+
+    return anchor, first_level_context, second_level_context
+
+@lru_cache(maxsize=1 << 16)
+def levenshtein(a, b):
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return len(a)
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        distance = i
+        for j, char_b in enumerate(b):
+            # Insertion, substitution and deletion, without the overhead of calling min
+            distance += 1
+            substitution = previous[j] + (char_a != char_b)
+            if substitution < distance:
+                distance = substitution
+            deletion = previous[j + 1] + 1
+            if deletion < distance:
+                distance = deletion
+            current.append(distance)
+        previous = current
+    return previous[-1]
+
+def calculate_quality(best_distance, max_distance):
+    # Scaled to 0-50 so two levels of context add up to 100. Nothing to compare is no match at all.
+    if max_distance == 0:
+        return 0
+    return int(100 * min(1.0, max(0.0, 1 - best_distance / max_distance)) / 2)
+
+def best_match(context, contexts, index=None):
+    """
+    Position of the context closest to `context`, first one winning ties, and the match quality.
+    (None, 0) if there are none. `index` maps contexts to their first position, if the caller has one.
+    """
+    position = index.get(context) if index is not None else (contexts.index(context) if context in contexts else None)
+    if position is not None:
+        return position, calculate_quality(0, len(context.encode('utf-8')))
+
+    best_position = None
+    best_distance = None
+    for position, key in enumerate(contexts):
+        # Length difference is a lower bound on the distance
+        if best_distance is not None and abs(len(key) - len(context)) >= best_distance:
+            continue
+        distance = levenshtein(context, key)
+        if best_distance is None or distance < best_distance:
+            best_position = position
+            best_distance = distance
+            # Only an exact match could do better, and there isn't one
+            if distance == 1:
+                break
+
+    if best_position is None:
+        return None, 0
+    max_distance = max(len(context.encode('utf-8')), len(contexts[best_position].encode('utf-8')))
+    return best_position, calculate_quality(best_distance, max_distance)
+
+class ContextLevel:
+    """
+    The children of one dictionary node, keyed by their context string.
+
+    Contexts are resolved to strings once when the dictionary is loaded, so matching never has to search
+    the token dictionary. An exact match short-circuits the Levenshtein scan.
+    """
+    __slots__ = ("contexts", "children", "index")
+
+    def __init__(self, contexts, children):
+        self.contexts = contexts
+        self.children = children
+        self.index = {}
+        for position, context in enumerate(contexts):
+            self.index.setdefault(context, position)
+
+    def match(self, context):
+        """The closest child and the quality of the match, or (None, 0) if there are no children."""
+        position, quality = best_match(context, self.contexts, self.index)
+        if position is None:
+            return None, 0
+        return self.children[position], quality
+
+    def completions(self):
+        """Every completion in the prediction lists directly underneath."""
+        return [completion for child in self.children if isinstance(child, list) for completion in child]
+
+class Predictor:
+    """
+    Python port of get_predictive_text in lib.rs, for serving predictions outside the browser.
+
+    Like lib.rs, both context levels are matched against the first level context; second_level_context
+    is only reported. It differs on purpose in two ways: the match quality's max distance comes from the
+    best match rather than whichever key lib.rs's HashMap visited last, and the second level context only
+    looks at words before the first level context, where lib.rs reads past them in inputs over 24 words.
+
+    The dictionary is indexed once up front: anchors by their string, each context level as a ContextLevel,
+    and every prediction already joined into its completion text.
+    """
+    def __init__(self, dictionary, tokens):
+        self.tokens = tokens
+        # Later tokens win, as they do when lib.rs inverts the token dictionary
+        self.token_ids = {string: token for token, string in tokens.items()}
+        self.anchors = {token: self._index(node) for token, node in dictionary.items()}
+
+    @classmethod
+    def from_files(cls, dictionary_path='dictionary.msgpack', tokens_path='tokens.msgpack'):
+        with open(dictionary_path, 'rb') as f:
+            dictionary = msgpack.unpack(f, strict_map_key=False)
+        with open(tokens_path, 'rb') as f:
+            tokens = msgpack.unpack(f, strict_map_key=False)
+        return cls(dictionary, tokens)
+
+    def _index(self, node):
+        if isinstance(node, dict):
+            contexts = []
+            children = []
+            for token, child in node.items():
+                # Keys missing from the token dictionary can never be matched
+                if token in self.tokens:
+                    contexts.append(self.tokens[token])
+                    children.append(self._index(child))
+            return ContextLevel(contexts, children)
+        if isinstance(node, list):
+            return [" ".join(self.tokens.get(token, "") for token in prediction) for prediction in node]
+        return None
+
+    def find_anchor(self, anchor):
+        """The anchor's token and its context level, or (-1, None)."""
+        anchor_token = self.token_ids.get(anchor, -1) if anchor else -1
+        return anchor_token, self.anchors.get(anchor_token)
+
+    def predict(self, text):
+        """Same fields get_predictive_text returns: anchor, contexts, quality and the list of completions."""
+        anchor, first_level_context, second_level_context = process_input(text)
+        anchor_token, anchor_level = self.find_anchor(anchor)
+        result = {
+            "anchor": anchor,
+            "anchor_token": anchor_token,
+            "first_level_context": first_level_context,
+            "second_level_context": second_level_context,
+            "quality": 0,
+            "prediction": [],
+        }
+
+        # Levels have a match method, leaves are lists of completions
+        if anchor_level is None or isinstance(anchor_level, list):
+            return result
+
+        first_level, quality = anchor_level.match(first_level_context)
+        result["quality"] = quality
+        if first_level is None or isinstance(first_level, list):
+            return result
+
+        # lib.rs matches the first level context again here, not second_level_context, and so does this port
+        second_level, second_level_quality = first_level.match(first_level_context)
+        result["quality"] += second_level_quality
+        if isinstance(second_level, list):
+            result["prediction"] = list(second_level)
+        elif second_level is not None:
+            # One level too deep: gather the prediction lists underneath
+            result["prediction"] = second_level.completions()
+        return result
+
+    def predict_many(self, texts):
+        """Predict for every text in a batch. Repeated inputs are only matched once."""
+        results = {}
+        predictions = []
+        for text in texts:
+            result = results.get(text)
+            if result is None:
+                result = results[text] = self.predict(text)
+                predictions.append(result)
+            else:
+                # Callers may rank or rewrite their own results, so repeats don't share them
+                predictions.append(dict(result, prediction=list(result["prediction"])))
+        return predictions
+
+def apply_ambition_penalties(suggestions):
+    """
+    Port of apply_ambition_penalties in tinypredict.js: scores each completion from the context quality,
+    favouring single words over longer guesses, and sorts the best first. Returns a new suggestions dict.
+    """
+    quality = suggestions["quality"]
+    predictions = []
+    for completion in suggestions["prediction"]:
+        penalty = AMBITION_PENALTIES.get(len(completion.split(" ")), 0)
+        predictions.append({"completion": completion, "quality": quality + (penalty if quality > 0 else 0)})
+    predictions.sort(key=lambda prediction: -prediction["quality"])
+    return dict(suggestions, prediction=predictions)
+
+def main(texts, dictionary_path='dictionary.msgpack', tokens_path='tokens.msgpack'):
+    return Predictor.from_files(dictionary_path, tokens_path).predict_many(texts)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print predictions for each line of standard input as JSON.")
+    parser.add_argument('--dictionary', default='dictionary.msgpack')
+    parser.add_argument('--tokens', default='tokens.msgpack')
+    args = parser.parse_args()
+
+    texts = [line.rstrip("\n") for line in sys.stdin]
+    for result in main(texts, args.dictionary, args.tokens):
+        print(json.dumps(result))
@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+from lib.constants import PREFETCH_DEPTH
+
+# How often a blocked producer checks whether the consumer has gone away.
+POLL_SECONDS = 0.1
+
+class Prefetcher:
+    """
+    Reads a corpus source's chunks in a background thread, up to depth chunks ahead of training.
+
+    Network reads, decompression and mmap page faults release the GIL, so they overlap with filing on the
+    main thread. Parsing still shares the GIL with filing, which is why documents are split on the main
+    thread: moving str.split over would take turns with filing rather than run alongside it.
+
+    The source runs ahead, so its own position is no use for checkpoints. Each chunk is queued with the
+    source's position after each of its documents, and state_dict() answers from the chunk training is on.
+    Time the producer spends blocked on a full queue is counted in producer_wait: training is the
+    bottleneck when that grows, reading is when training waits on an empty queue instead.
+    """
+    def __init__(self, dataset, depth=PREFETCH_DEPTH):
+        self.dataset = dataset
+        self.name = dataset.name
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopping = threading.Event()
+        self.thread = None
+        # Source positions after each document of the chunk being trained on, the first being before it
+        self.positions = None
+        self.read_seconds = 0.0
+        self.producer_wait = 0.0
+        # The totals as of the last record()
+        self.recorded = (0.0, 0.0)
+
+    def skip(self, documents):
+        self.dataset.skip(documents)
+
+    def load_state_dict(self, state_dict):
+        self.dataset.load_state_dict(state_dict)
+
+    def state_dict(self, documents=None):
+        """The position after the chunk training is on or, given documents, after that many of its documents."""
+        if self.positions is None:
+            return self.dataset.state_dict()
+        return self.positions[-1 if documents is None else documents]
+
+    def record(self, metrics):
+        """Add the producer's reading and waiting since the last call to metrics, from the training thread."""
+        read_seconds, producer_wait = self.read_seconds, self.producer_wait
+        metrics.add_time("prefetch_read", read_seconds - self.recorded[0])
+        metrics.add_time("prefetch_producer_wait", producer_wait - self.recorded[1])
+        metrics.gauge("prefetch_queue_depth", self.queue.qsize())
+        self.recorded = (read_seconds, producer_wait)
+
+    def put(self, item):
+        """Queue item, waiting while the queue is full. False if training stopped reading in the meantime."""
+        start = time.perf_counter()
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self.queue.put(item, timeout=POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            self.producer_wait += time.perf_counter() - start
+
+    def produce(self):
+        try:
+            chunks = self.dataset.iter_chunks()
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    positions = [self.dataset.state_dict(documents) for documents in range(len(chunk))]
+                    positions.append(self.dataset.state_dict())
+                self.read_seconds += time.perf_counter() - start
+
+                if chunk is None:
+                    self.put(None)
+                    return
+                if not self.put((chunk, positions)):
+                    return
+        except BaseException as error:
+            # Raised again on the training side
+            self.put(error)
+
+    def iter_chunks(self):
+        self.thread = threading.Thread(target=self.produce, name="prefetch", daemon=True)
+        self.thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                chunk, self.positions = item
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the producer. Anything it already read is dropped."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
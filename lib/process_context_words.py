@@ -3,16 +3,15 @@ PREPOSITIONS = ["and", "or", "but", "if", "of", "at", "by", "for", "with", "to",
 TO_BE = ["am", "is", "are", "was", "were", "be", "been", "being"]
 TO_HAVE = ["have", "has", "had", "having"]
 ARTICLES = ["the", "a", "an"]
+EXTRA_WORDS = set(PREPOSITIONS + TO_BE + TO_HAVE + ARTICLES)
 
 def get_acronym_for_words(words):
     # Get the first letter of each word and convert to uppercase to form the acronym
     return ''.join(word[0].lower() for word in words if word)
 
 def remove_extra_words(words):
-    # Define a list of words to remove
-    extra_words = set(PREPOSITIONS + TO_BE + TO_HAVE + ARTICLES)
     # Return a list of words not in the extra_words set
-    return [word for word in words if word.lower() not in extra_words]
+    return [word for word in words if word.lower() not in EXTRA_WORDS]
 
 def main(words, index):
     # Assuming words is a list of strings and index is the index to find the anchor
@@ -0,0 +1,41 @@
+import time
+from lib.featurize_document import main as featurize_document
+
+# Words before a window and after it that the window is built from
+CONTEXT_BEFORE = 6
+CONTEXT_AFTER = 3
+
+def main(tree_store, words, metrics=None, start=0, stop=None):
+    """
+    Files every shifting window of one document into a TreeStore and returns the number of words counted.
+    With metrics, featurizing and filing are timed as separate stages.
+
+    start and stop limit it to the windows anchored on words[start:stop], exactly as filing the whole
+    document would give them, so a long document can be filed in pieces or picked up part way through.
+    """
+    if metrics is not None:
+        started = time.perf_counter()
+
+    # Process words three at a time with a shifting window
+    if start or stop is not None:
+        # Only the words those windows see, from the start of the first one's clauses
+        first = max(start - CONTEXT_BEFORE, 0)
+        windows = featurize_document(words[first:None if stop is None else stop + CONTEXT_AFTER])[start - first:]
+        if stop is not None:
+            windows = windows[:stop - start]
+    else:
+        windows = featurize_document(words)
+
+    if metrics is not None:
+        featurized = time.perf_counter()
+        metrics.add_time("featurize", featurized - started)
+
+    add = tree_store.add
+    for anchor, first_clause, second_clause, predictive_words in windows:
+        # File the words
+        add(anchor, first_clause, second_clause, predictive_words)
+
+    if metrics is not None:
+        metrics.add_time("file", time.perf_counter() - featurized)
+
+    return len(windows)
@@ -0,0 +1,64 @@
+from heapq import nlargest
+from lib.constants import MAX_PREDICTIONS, SUBBRANCH_PRUNE_SIZE
+
+def child_score(item):
+    return item[1].get("score", 0)
+
+def prediction_score(prediction):
+    return prediction["score"]
+
+def prune_branches(subtree, subbranch_limit=SUBBRANCH_PRUNE_SIZE, prediction_limit=MAX_PREDICTIONS):
+    """
+    Cut every level of an anchor's subtree down to its subbranch_limit best branches and
+    prediction_limit best predictions, in place. Returns the subtree.
+
+    Walks the tree with an explicit stack. Each node keeps its best children, highest score first,
+    followed by its score and then its predictions, the same order full sorting left them in.
+    nlargest breaks ties by position like a stable sort, so equal scores keep their original order.
+    Values that aren't dicts, apart from score and predictions, are dropped.
+    """
+    if not isinstance(subtree, dict):
+        return subtree
+
+    stack = [subtree]
+    while stack:
+        node = stack.pop()
+        has_score = "score" in node
+        score = node.pop("score", None)
+        predictions = node.pop("predictions", None)
+
+        children = nlargest(subbranch_limit, [item for item in node.items() if isinstance(item[1], dict)], key=child_score)
+
+        node.clear()
+        node.update(children)
+        if has_score:
+            node["score"] = score
+        if predictions:
+            node["predictions"] = nlargest(prediction_limit, predictions, key=prediction_score)
+
+        stack.extend(child for _, child in children)
+
+    return subtree
+
+def prune_tree(tree, target_dict_size, subbranch_limit=SUBBRANCH_PRUNE_SIZE, prediction_limit=MAX_PREDICTIONS):
+    """
+    Keep the target_dict_size highest scoring anchors of a tree and prune each of their subtrees with
+    prune_branches. Works in place and returns the tree.
+
+    A top level score key is kept first and, as it always has, takes up one of the target_dict_size slots.
+    """
+    has_score = "score" in tree
+    score = tree.pop("score", None)
+
+    limit = target_dict_size - 1 if has_score else target_dict_size
+    anchors = nlargest(max(limit, 0), [item for item in tree.items() if isinstance(item[1], dict)], key=child_score)
+
+    tree.clear()
+    if has_score and target_dict_size > 0:
+        tree["score"] = score
+    tree.update(anchors)
+
+    for _, subtree in anchors:
+        prune_branches(subtree, subbranch_limit, prediction_limit)
+
+    return tree
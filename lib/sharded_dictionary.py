@@ -0,0 +1,117 @@
+import argparse
+import glob
+import json
+import os
+import msgpack
+from lib.constants import DICTIONARY_SHARD_SIZE
+from lib.predict import Predictor
+
+SHARDS_PATH = 'dictionary-shards'
+INDEX_NAME = 'index.json'
+
+FNV_OFFSET = 0x811c9dc5
+FNV_PRIME = 0x01000193
+
+def shard_hash(string):
+    """32-bit FNV-1a of the string's utf-8 bytes. Simple enough to repeat in JavaScript or Rust."""
+    value = FNV_OFFSET
+    for byte in string.encode('utf-8'):
+        value = ((value ^ byte) * FNV_PRIME) & 0xffffffff
+    return value
+
+def shard_of(string, shard_count):
+    return shard_hash(string) % shard_count
+
+def used_tokens(node, used):
+    """Add every key and prediction token under node to used."""
+    if isinstance(node, dict):
+        for token, child in node.items():
+            used.add(token)
+            used_tokens(child, used)
+    elif isinstance(node, list):
+        for prediction in node:
+            used.update(prediction)
+    return used
+
+def shard_dictionary(dictionary, tokens, directory=SHARDS_PATH, shard_size=DICTIONARY_SHARD_SIZE):
+    """
+    Split a tokenized dictionary into anchor-hashed shards of about shard_size bytes each, plus an index.
+
+    Each shard is a msgpack [dictionary, tokens] pair holding the anchors whose string hashes to it, the
+    tokens their subtrees use, and every token whose string hashes to it, so a shard alone answers any
+    lookup for the anchors that land in it. Returns the index.
+    """
+    shard_count = max(1, -(-(len(msgpack.packb(dictionary)) + len(msgpack.packb(tokens))) // shard_size))
+    shard_anchors = [[] for _ in range(shard_count)]
+    shard_tokens = [set() for _ in range(shard_count)]
+
+    for token, string in tokens.items():
+        shard_tokens[shard_of(string, shard_count)].add(token)
+    for token, node in dictionary.items():
+        # Anchors without a token could never be looked up
+        if token in tokens:
+            shard = shard_of(tokens[token], shard_count)
+            shard_anchors[shard].append(token)
+            used_tokens(node, shard_tokens[shard])
+
+    os.makedirs(directory, exist_ok=True)
+    # Keep the token dictionary's order: when a string has several tokens, the last one wins
+    positions = {token: position for position, token in enumerate(tokens)}
+    shards = []
+    for shard in range(shard_count):
+        path = f"shard_{shard:04d}_of_{shard_count:04d}.msgpack"
+        shard_dict = {token: dictionary[token] for token in shard_anchors[shard]}
+        shard_token_dict = {token: tokens[token] for token in sorted(shard_tokens[shard] & positions.keys(), key=positions.__getitem__)}
+        with open(os.path.join(directory, path), 'wb') as f:
+            msgpack.pack([shard_dict, shard_token_dict], f)
+        shards.append({"path": path, "anchors": len(shard_dict), "bytes": os.path.getsize(os.path.join(directory, path))})
+
+    index = {"version": 1, "hash": "fnv1a32", "shard_count": shard_count, "shards": shards}
+    index_path = os.path.join(directory, INDEX_NAME)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(index_path + '.tmp', index_path)
+
+    # Shards from builds with a different count, now that the index no longer points at them
+    current = {shard["path"] for shard in shards}
+    for path in glob.glob(os.path.join(directory, "shard_*.msgpack")):
+        if os.path.basename(path) not in current:
+            os.remove(path)
+
+    return index
+
+class ShardedPredictor(Predictor):
+    """Predictor over a sharded dictionary. A shard is only read the first time one of its anchors comes up."""
+    def __init__(self, directory=SHARDS_PATH):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.shards = {}
+
+    def shard(self, shard):
+        predictor = self.shards.get(shard)
+        if predictor is None:
+            with open(os.path.join(self.directory, self.index["shards"][shard]["path"]), 'rb') as f:
+                dictionary, tokens = msgpack.unpack(f, strict_map_key=False)
+            predictor = self.shards[shard] = Predictor(dictionary, tokens)
+        return predictor
+
+    def find_anchor(self, anchor):
+        if not anchor:
+            return -1, None
+        return self.shard(shard_of(anchor, self.index["shard_count"])).find_anchor(anchor)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split dictionary.msgpack and tokens.msgpack into anchor-hashed shards with an index.")
+    parser.add_argument('--dictionary', default='dictionary.msgpack')
+    parser.add_argument('--tokens', default='tokens.msgpack')
+    parser.add_argument('--output', default=SHARDS_PATH)
+    parser.add_argument('--shard-size', type=int, default=DICTIONARY_SHARD_SIZE, help='Target bytes per shard.')
+    args = parser.parse_args()
+
+    with open(args.dictionary, 'rb') as f:
+        dictionary = msgpack.unpack(f, strict_map_key=False)
+    with open(args.tokens, 'rb') as f:
+        tokens = msgpack.unpack(f, strict_map_key=False)
+    index = shard_dictionary(dictionary, tokens, args.output, args.shard_size)
+    print(f"Wrote {index['shard_count']} shards to {args.output}")
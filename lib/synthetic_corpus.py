@@ -0,0 +1,90 @@
+import argparse
+import itertools
+import os
+import random
+from lib.process_context_words import PREPOSITIONS, TO_BE, TO_HAVE, ARTICLES
+
+# The most frequent words of real English text are mostly filler words, which the first clause drops,
+# so the top ranks of the synthetic vocabulary are those.
+COMMON_WORDS = ARTICLES + PREPOSITIONS + TO_BE + TO_HAVE + ["i", "you", "it", "that", "this", "we", "they", "not"]
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "be", "da", "fi", "go", "hu", "je", "po", "ze"]
+
+# Punctuation a word may end with, and how often. Ending punctuation cuts predictions short.
+ENDINGS = [("", 0.88), (",", 0.06), (".", 0.05), ("?", 0.01)]
+
+def make_vocabulary(size):
+    """`size` distinct words, the common filler words first, then pronounceable made up ones."""
+    vocabulary = COMMON_WORDS[:size]
+    seen = set(vocabulary)
+    for length in itertools.count(1):
+        for syllables in itertools.product(SYLLABLES, repeat=length):
+            if len(vocabulary) >= size:
+                return vocabulary
+            word = "".join(syllables)
+            if word not in seen:
+                seen.add(word)
+                vocabulary.append(word)
+
+class ZipfCorpus:
+    """
+    Reproducible stream of synthetic documents whose word frequencies follow Zipf's law.
+
+    The word at rank r turns up in proportion to 1 / r ** exponent, which is roughly how words are spread
+    in natural text, so trees grown from it have a realistic mix of a few huge anchors and a long tail.
+    The same seed always gives the same documents.
+    """
+    def __init__(self, vocabulary_size=50000, exponent=1.1, seed=0, document_words=(50, 400)):
+        self.vocabulary = make_vocabulary(vocabulary_size)
+        self.exponent = exponent
+        self.seed = seed
+        self.document_words = document_words
+
+        # Cumulative weights let random.choices draw every word of a document in one call
+        self.cumulative_weights = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, vocabulary_size + 1)))
+        self.endings = [ending for ending, _ in ENDINGS]
+        self.ending_weights = list(itertools.accumulate(weight for _, weight in ENDINGS))
+
+    def documents(self, word_count):
+        """Yield document texts until about word_count words have been generated."""
+        rng = random.Random(self.seed)
+        generated = 0
+        while generated < word_count:
+            length = min(rng.randint(*self.document_words), word_count - generated)
+            words = rng.choices(self.vocabulary, cum_weights=self.cumulative_weights, k=length)
+            endings = rng.choices(self.endings, cum_weights=self.ending_weights, k=length)
+            generated += length
+            yield " ".join(word + ending for word, ending in zip(words, endings))
+
+    def write(self, directory, word_count, shard_words=1000 * 1000):
+        """Write word_count words as plain text shards of about shard_words words, one document per line."""
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        shard = None
+        shard_word_count = 0
+        try:
+            for document in self.documents(word_count):
+                if shard is None or shard_word_count >= shard_words:
+                    if shard is not None:
+                        shard.close()
+                    paths.append(os.path.join(directory, f"synthetic_{len(paths):05d}.txt"))
+                    shard = open(paths[-1], 'w', encoding='utf-8')
+                    shard_word_count = 0
+                shard.write(document + "\n")
+                shard_word_count += document.count(" ") + 1
+        finally:
+            if shard is not None:
+                shard.close()
+        return paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a reproducible Zipf-distributed synthetic corpus for --source local.")
+    parser.add_argument('directory')
+    parser.add_argument('--words', type=int, default=10 * 1000 * 1000)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--exponent', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = ZipfCorpus(args.vocabulary, args.exponent, args.seed).write(args.directory, args.words)
+    print(f"Wrote {args.words} words to {len(paths)} shards in {args.directory}")
@@ -0,0 +1,91 @@
+import os
+from collections import Counter
+import msgpack
+
+VOCABULARY_PATH = 'vocabulary.msgpack'
+
+def count_strings(tree):
+    """How often each key and prediction word turns up in a simplified tree, in the order they're first seen."""
+    counts = Counter()
+    def visit(node):
+        if isinstance(node, dict):
+            for key, child in node.items():
+                counts[key] += 1
+                visit(child)
+        elif isinstance(node, list):
+            for prediction in node:
+                counts.update(prediction)
+    visit(tree)
+    return counts
+
+class Tokenizer:
+    """
+    Assigns token ids to the strings of a simplified dictionary tree, most frequent first.
+
+    msgpack stores ints below 128 in one byte and below 65536 in three, so giving the most common
+    strings the smallest ids keeps dictionary.msgpack small. The vocabulary is saved between builds with
+    how often each string turned up in the last one: strings keep their ids, so dictionaries can be
+    rebuilt without reshuffling every token, and new strings are appended by frequency. rebuild()
+    reassigns every id by those counts when the order has drifted.
+    """
+    def __init__(self, strings=(), counts=()):
+        self.strings = list(strings)
+        self.counts = list(counts)
+        self.ids = {string: token for token, string in enumerate(self.strings)}
+
+    def __len__(self):
+        return len(self.strings)
+
+    @classmethod
+    def load(cls, path=VOCABULARY_PATH):
+        """The saved vocabulary, or an empty one if there is none yet."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'rb') as f:
+            entries = msgpack.unpack(f)
+        return cls([string for string, _ in entries], [count for _, count in entries])
+
+    def save(self, path=VOCABULARY_PATH):
+        with open(path + '.tmp', 'wb') as f:
+            msgpack.pack([[string, count] for string, count in zip(self.strings, self.counts)], f)
+        os.replace(path + '.tmp', path)
+
+    def fit(self, tree):
+        """Count the tree's strings in place of the last build's, giving new ones ids by descending frequency."""
+        counts = count_strings(tree)
+        # Replaced rather than added to, so building from the same merged tree twice doesn't double them
+        # and strings that dropped out of the dictionary sink to the end on rebuild()
+        self.counts = [counts.get(string, 0) for string in self.strings]
+        # sorted is stable, so equally frequent strings keep the order they were first seen in
+        for string in sorted((string for string in counts if string not in self.ids), key=counts.__getitem__, reverse=True):
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+            self.counts.append(counts[string])
+
+    def rebuild(self):
+        """Reassign every id by descending count in the last build."""
+        order = sorted(range(len(self.strings)), key=self.counts.__getitem__, reverse=True)
+        self.__init__([self.strings[token] for token in order], [self.counts[token] for token in order])
+
+    def tokenize(self, tree):
+        """Return the tree with every key and prediction word replaced by its token, and the {token: string} map it uses."""
+        ids = self.ids
+        used = set()
+        def encode(node):
+            if isinstance(node, dict):
+                encoded = {}
+                for key, child in node.items():
+                    token = ids[key]
+                    used.add(token)
+                    encoded[token] = encode(child)
+                return encoded
+            if isinstance(node, list):
+                predictions = [[ids[word] for word in prediction] for prediction in node]
+                for prediction in predictions:
+                    used.update(prediction)
+                return predictions
+            return node
+
+        tokenized = encode(tree)
+        # Only the tokens this dictionary uses go into tokens.msgpack
+        return tokenized, {token: self.strings[token] for token in sorted(used)}
@@ -0,0 +1,137 @@
+import asyncio
+import multiprocessing
+import queue
+import signal
+from lib.create_dictionary import create_batch
+from lib.process_document import main as process_document
+from lib.constants import TARGET_DICTIONARY_COUNT
+from lib.tree_store import TreeStore
+from lib.metrics import Metrics
+
+# How many tasks may wait in each worker's queue before the reader blocks.
+TASK_QUEUE_DEPTH = 4
+
+FLUSH = "flush"
+STOP = "stop"
+PROGRESS = "progress"
+
+def worker_main(worker_id, task_queue, result_queue, instrument=False):
+    """
+    Files documents into a worker-local tree store until told to stop.
+
+    Every progress message carries the tree store's usage, so the parent can tell when it is over budget.
+    With instrument set, it also carries the stage timings since the last one for the parent's metrics.
+    """
+    # The parent process owns SIGINT so the whole pool winds down together.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    tree_store = TreeStore()
+    metrics = Metrics() if instrument else None
+
+    while True:
+        task = task_queue.get()
+
+        if task == STOP:
+            break
+
+        if task == FLUSH:
+            batch_filename = None
+            if tree_store:
+                batch_filename = asyncio.run(create_batch(tree_store, TARGET_DICTIONARY_COUNT, worker_id=worker_id, metrics=metrics))
+            # The emptied store's usage, so the parent's view of it doesn't stay at the size it flushed at
+            result_queue.put((FLUSH, worker_id, batch_filename, tree_store.usage()))
+            continue
+
+        word_total = 0
+        word_count = 0
+        for text in task:
+            words = text.split()
+            word_total += len(words)
+            word_count += process_document(tree_store, words, metrics)
+
+        stats = None
+        if metrics is not None:
+            stats = {"stages": metrics.stages, "counters": metrics.counters}
+            metrics.stages = {}
+            metrics.counters = {}
+        result_queue.put((PROGRESS, worker_id, word_total, word_count, tree_store.usage(), stats))
+
+class WorkerPool:
+    """
+    A fixed set of training processes, each with its own tree store.
+
+    Documents are dealt out round robin. Every message a worker sends back goes through one result queue
+    so the parent can keep the progress bar and word count in step with the work that was actually done.
+    """
+    def __init__(self, workers, instrument=False):
+        context = multiprocessing.get_context()
+        self.result_queue = context.Queue()
+        self.task_queues = [context.Queue(maxsize=TASK_QUEUE_DEPTH) for _ in range(workers)]
+        self.processes = [
+            context.Process(target=worker_main, args=(worker_id, task_queue, self.result_queue, instrument), daemon=True)
+            for worker_id, task_queue in enumerate(self.task_queues)
+        ]
+        self.next_worker = 0
+
+        for process in self.processes:
+            process.start()
+
+    def submit(self, documents):
+        """Hand a list of document texts to the next worker, blocking if its queue is full."""
+        self.task_queues[self.next_worker].put(documents)
+        self.next_worker = (self.next_worker + 1) % len(self.task_queues)
+
+    def _handle(self, message, progress, batch_filenames):
+        if message[0] == PROGRESS:
+            progress.append(message[1:])
+        elif message[0] == FLUSH:
+            batch_filenames.append(message[2])
+            progress.append((message[1], 0, 0, message[3], None))
+
+    def poll(self):
+        """Return the (worker id, words read, words counted, tree store usage, stats) reported since the last call."""
+        progress = []
+        batch_filenames = []
+        while True:
+            try:
+                message = self.result_queue.get_nowait()
+            except queue.Empty:
+                return progress
+            self._handle(message, progress, batch_filenames)
+
+    def flush(self):
+        """
+        Have every worker write its tree store out as a batch once its queued documents are filed.
+
+        Returns the progress reported while waiting, ending with each worker's usage once flushed, and the
+        batch filenames that were written. When this returns every submitted document is on disk, so the
+        dataset position can be saved safely.
+        """
+        for task_queue in self.task_queues:
+            task_queue.put(FLUSH)
+
+        progress = []
+        batch_filenames = []
+        flushed = 0
+        while flushed < len(self.task_queues):
+            message = self.result_queue.get()
+            self._handle(message, progress, batch_filenames)
+            if message[0] == FLUSH:
+                flushed += 1
+
+        return progress, [filename for filename in batch_filenames if filename]
+
+    def close(self):
+        """Stop the workers without flushing. Unflushed tree stores are dropped like in single-process mode."""
+        for task_queue, process in zip(self.task_queues, self.processes):
+            try:
+                task_queue.put_nowait(STOP)
+            except queue.Full:
+                # Its backlog would be thrown away anyway.
+                process.terminate()
+
+        for process in self.processes:
+            while process.is_alive():
+                # Keep draining so a worker blocked on a full result pipe can exit.
+                self.poll()
+                process.join(timeout=0.1)
@@ -0,0 +1,156 @@
+import heapq
+
+# Keys the nested dict format uses for its own bookkeeping.
+RESERVED_KEYS = ("score", "predictions")
+
+# Rough heap cost of each kind of entry, measured with tracemalloc on synthetic corpora. A context
+# includes its leaf dict, a prediction its id tuple and slot in that dict.
+BYTES_PER_WORD = 90
+BYTES_PER_ANCHOR = 48
+BYTES_PER_CONTEXT = 336
+BYTES_PER_PREDICTION = 62
+
+class TreeStore:
+    """
+    Compact replacement for the nested dict tree_store that training files words into.
+
+    Every word is interned to an int once. Leaves are keyed by (anchor, second clause, first clause) id
+    tuples and hold a {prediction id tuple: count} dict, so filing a window is a handful of O(1) dict
+    updates. Context and leaf scores are the sums of the counts below them, so only anchor scores are
+    stored separately, which is all that's needed to pick the top anchors at flush time.
+
+    to_nested_dict() exports the layout create_dictionary and merge_batches work with.
+    """
+    __slots__ = ("words", "word_ids", "anchor_scores", "leaves", "prediction_count")
+
+    def __init__(self):
+        self.words = []
+        self.word_ids = {}
+        self.anchor_scores = {}
+        self.leaves = {}
+        # Distinct (context, prediction) pairs, kept up to date so sizing the store never walks it
+        self.prediction_count = 0
+
+    def __len__(self):
+        return len(self.anchor_scores)
+
+    def intern(self, word):
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            word_id = len(self.words)
+            self.words.append(word)
+            self.word_ids[word] = word_id
+        return word_id
+
+    def add(self, anchor, first_clause, second_clause, predictive_words):
+        intern = self.intern
+        anchor_id = intern(anchor)
+        leaf_key = (anchor_id, intern(second_clause), intern(first_clause))
+        prediction = tuple([intern(word) for word in predictive_words])
+
+        anchor_scores = self.anchor_scores
+        anchor_scores[anchor_id] = anchor_scores.get(anchor_id, 0) + 1
+
+        leaf = self.leaves.get(leaf_key)
+        if leaf is None:
+            leaf = self.leaves[leaf_key] = {}
+        count = leaf.get(prediction)
+        if count is None:
+            self.prediction_count += 1
+            leaf[prediction] = 1
+        else:
+            leaf[prediction] = count + 1
+
+    def clear(self):
+        self.words = []
+        self.word_ids = {}
+        self.anchor_scores = {}
+        self.leaves = {}
+        self.prediction_count = 0
+
+    def node_counts(self):
+        return {
+            "words": len(self.words),
+            "anchors": len(self.anchor_scores),
+            "contexts": len(self.leaves),
+            "predictions": self.prediction_count,
+        }
+
+    def estimated_bytes(self):
+        """Approximate heap size, in O(1). Within a few percent of tracemalloc on Zipf-like text."""
+        return (len(self.words) * BYTES_PER_WORD + len(self.anchor_scores) * BYTES_PER_ANCHOR
+                + len(self.leaves) * BYTES_PER_CONTEXT + self.prediction_count * BYTES_PER_PREDICTION)
+
+    def usage(self):
+        """Node counts and estimated size in one dict, as training and its metrics report them."""
+        return dict(self.node_counts(), estimated_bytes=self.estimated_bytes())
+
+    def top_anchors(self, limit):
+        """Anchor ids with the highest scores, ties going to the anchor filed first, like create_dictionary."""
+        return heapq.nlargest(limit, self.anchor_scores, key=self.anchor_scores.__getitem__)
+
+    def to_nested_dict(self, anchor_limit=None):
+        """
+        Export to the nested dict format finish_filing produces, in the same key order.
+
+        With anchor_limit only the highest scoring anchors are exported. create_dictionary would drop the
+        rest anyway, and skipping them avoids building the bulk of the tree just to throw it away.
+        """
+        words = self.words
+
+        if anchor_limit is None:
+            anchor_ids = self.anchor_scores
+        else:
+            anchor_ids = set(self.top_anchors(anchor_limit))
+
+        anchor_dicts = {}
+        tree = {}
+        for anchor_id in self.anchor_scores:
+            if anchor_id in anchor_ids:
+                anchor = words[anchor_id]
+                if anchor in RESERVED_KEYS:
+                    # Same escaping training used to apply to every word.
+                    anchor = "\\s" + anchor
+                anchor_dicts[anchor_id] = tree[anchor] = {"score": self.anchor_scores[anchor_id]}
+
+        for (anchor_id, second_id, first_id), leaf in self.leaves.items():
+            anchor_dict = anchor_dicts.get(anchor_id)
+            if anchor_dict is None:
+                continue
+
+            leaf_score = sum(leaf.values())
+
+            second_clause_dict = anchor_dict.get(words[second_id])
+            if second_clause_dict is None:
+                second_clause_dict = anchor_dict[words[second_id]] = {"score": 0}
+            second_clause_dict["score"] += leaf_score
+
+            second_clause_dict[words[first_id]] = {
+                "score": leaf_score,
+                "predictions": [
+                    {"prediction": [words[word_id] for word_id in prediction], "score": score}
+                    for prediction, score in leaf.items()
+                ],
+            }
+
+        return tree
+
+class FlushBudget:
+    """
+    Decides when a growing tree store should be written out as a batch.
+
+    Any budget that is set can trigger the flush: estimated bytes, nodes (every entry node_counts reports)
+    or words filed since the last flush. Sizes come from usage(), which the store keeps up to date as
+    windows are filed, so checking costs the same however big the tree has grown.
+    """
+    def __init__(self, memory=None, nodes=None, words=None):
+        self.memory = memory
+        self.nodes = nodes
+        self.words = words
+
+    def reached(self, usage, words_since_flush):
+        if self.memory is not None and usage["estimated_bytes"] >= self.memory:
+            return True
+        if self.nodes is not None and sum(count for kind, count in usage.items() if kind != "estimated_bytes") >= self.nodes:
+            return True
+        return self.words is not None and words_since_flush >= self.words
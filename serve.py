@@ -0,0 +1,273 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+from urllib.parse import urlsplit, parse_qs
+from lib.compiled_dictionary import CompiledPredictor, compile_files, is_stale, COMPILED_PATH
+from lib.predict import apply_ambition_penalties
+import argparse  # Import argparse for command-line parsing
+
+# Largest request body accepted, in bytes.
+MAX_BODY_SIZE = 1024 * 1024
+
+# Most inputs one POST may ask for.
+MAX_TEXTS_PER_REQUEST = 256
+
+STATUS_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+}
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class PredictionBatcher:
+    """
+    Collects the predictions every open connection asks for and runs them through predict_many together.
+
+    Whatever is queued when the batch task wakes up goes into one batch, up to batch_size. With a batch_wait
+    it also waits that long for more before predicting, trading a little latency for bigger batches.
+    """
+    def __init__(self, predictor, batch_size=64, batch_wait=0.0):
+        self.predictor = predictor
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.predictions = 0
+
+    async def predict(self, text):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    def _drain(self, batch):
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Let connections that are ready to read queue their requests first
+            await asyncio.sleep(self.batch_wait)
+            self._drain(batch)
+
+            texts = [text for text, _ in batch]
+            try:
+                results = self.predictor.predict_many(texts)
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            self.batches += 1
+            self.predictions += len(batch)
+            for (_, future), result in zip(batch, results):
+                # The client may have gone away in the meantime
+                if not future.done():
+                    future.set_result(apply_ambition_penalties(result))
+
+async def read_request(reader):
+    """Read one HTTP/1.x request. Returns None when the client closed the connection between requests."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise RequestError(400, "Malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise RequestError(400, "Malformed Content-Length")
+    if length > MAX_BODY_SIZE:
+        raise RequestError(413, "Request body too large")
+    body = await reader.readexactly(length) if length else b""
+
+    return method, target, version, headers, body
+
+async def respond(method, target, body, batcher, limit):
+    url = urlsplit(target)
+
+    if url.path == "/health":
+        return {"status": "ok", "pid": os.getpid(), "batches": batcher.batches, "predictions": batcher.predictions}
+
+    if url.path != "/predict":
+        raise RequestError(404, f"No route for {url.path}")
+
+    if method == "GET":
+        texts = parse_qs(url.query).get("text")
+        if not texts:
+            raise RequestError(400, "Missing text parameter")
+        single = True
+        texts = texts[:1]
+    elif method == "POST":
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            raise RequestError(400, "Body is not valid JSON")
+        if isinstance(payload, dict) and isinstance(payload.get("text"), str):
+            single = True
+            texts = [payload["text"]]
+        elif isinstance(payload, dict) and isinstance(payload.get("texts"), list) and all(isinstance(text, str) for text in payload["texts"]):
+            single = False
+            texts = payload["texts"]
+        else:
+            raise RequestError(400, 'Expected {"text": "..."} or {"texts": ["...", ...]}')
+        if len(texts) > MAX_TEXTS_PER_REQUEST:
+            raise RequestError(413, f"At most {MAX_TEXTS_PER_REQUEST} texts per request")
+    else:
+        raise RequestError(405, f"{method} not allowed")
+
+    # Requests past the limit wait here instead of piling more work onto the batch queue
+    async with limit:
+        suggestions = await asyncio.gather(*(batcher.predict(text) for text in texts))
+    return suggestions[0] if single else suggestions
+
+async def handle_connection(reader, writer, batcher, limit):
+    try:
+        while True:
+            keep_alive = False
+            try:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, version, headers, body = request
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                status, payload = 200, await respond(method, target, body, batcher, limit)
+            except RequestError as error:
+                status, payload = error.status, {"error": str(error)}
+
+            content = json.dumps(payload).encode('utf-8')
+            writer.write(
+                f"HTTP/1.1 {status} {STATUS_REASONS[status]}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(content)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + content
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(listening_socket, compiled_path, max_concurrency, batch_size, batch_wait, started=None):
+    """Serve predictions on an already listening socket until cancelled."""
+    predictor = CompiledPredictor(compiled_path)
+    batcher = PredictionBatcher(predictor, batch_size, batch_wait)
+    limit = asyncio.Semaphore(max_concurrency)
+    batch_task = asyncio.create_task(batcher.run())
+
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(reader, writer, batcher, limit), sock=listening_socket)
+    if started is not None:
+        started.set()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+        predictor.close()
+
+def run_worker(listening_socket, compiled_path, max_concurrency, batch_size, batch_wait):
+    # The parent owns SIGINT and passes it on as SIGTERM so the whole set winds down together.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    async def main():
+        task = asyncio.create_task(serve(listening_socket, compiled_path, max_concurrency, batch_size, batch_wait))
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+
+def main(host='127.0.0.1', port=8000, workers=1, compiled_path=COMPILED_PATH, dictionary_path='dictionary.msgpack', tokens_path='tokens.msgpack', max_concurrency=256, batch_size=64, batch_wait=0.0):
+    if is_stale(compiled_path, (dictionary_path, tokens_path)):
+        print(f"Compiling {dictionary_path} and {tokens_path} into {compiled_path}")
+        compile_files(dictionary_path, tokens_path, compiled_path)
+
+    listening_socket = socket.create_server((host, port), backlog=1024)
+    print(f"Serving predictions on http://{host}:{listening_socket.getsockname()[1]}/predict with {workers} worker(s)")
+
+    if workers == 1:
+        run_worker(listening_socket, compiled_path, max_concurrency, batch_size, batch_wait)
+        return
+
+    # Pre-fork: every worker accepts on the same socket and maps the same compiled dictionary, so the
+    # dictionary's pages are shared through the page cache instead of loaded into each process.
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(listening_socket, compiled_path, max_concurrency, batch_size, batch_wait)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    listening_socket.close()
+
+    def stop(sig, frame):
+        print("Graceful exit request received.")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for pid in children:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                break
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve predictions over HTTP from a compiled, memory-mapped dictionary.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1, help='Number of pre-forked server processes sharing the listening socket.')
+    parser.add_argument('--dictionary', default='dictionary.msgpack')
+    parser.add_argument('--tokens', default='tokens.msgpack')
+    parser.add_argument('--compiled', default=COMPILED_PATH, help='Compiled dictionary, rebuilt when older than --dictionary or --tokens.')
+    parser.add_argument('--max-concurrency', type=int, default=256, help='Requests each worker predicts for at once. The rest wait.')
+    parser.add_argument('--batch-size', type=int, default=64, help='Most inputs predicted in one batch.')
+    parser.add_argument('--batch-wait', type=float, default=0.0, help='Seconds to wait for a batch to fill before predicting.')
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.max_concurrency < 1 or args.batch_size < 1:
+        parser.error('--max-concurrency and --batch-size must be at least 1')
+    if args.workers > 1 and not hasattr(os, 'fork'):
+        parser.error('--workers needs a platform with os.fork')
+
+    main(host=args.host, port=args.port, workers=args.workers, compiled_path=args.compiled, dictionary_path=args.dictionary, tokens_path=args.tokens,
+         max_concurrency=args.max_concurrency, batch_size=args.batch_size, batch_wait=args.batch_wait)
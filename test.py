@@ -1,8 +1,44 @@
 import unittest
 
 from lib.finish_filing import main as finish_filing
-from lib.create_dictionary import create_dictionary, create_token_dict, remove_scores_and_flatten_predictions
-from lib.merge_batches import merge, prune
+from lib.tree_store import TreeStore, FlushBudget
+from lib.heavy_hitters import SpaceSaving, HeavyHitterStore
+from lib.featurize_document import main as featurize_document
+from lib.process_context_words import main as process_context_words
+from lib.process_predictive_words import main as process_predictive_words
+from lib.create_dictionary import create_dictionary, create_token_dict, remove_scores_and_flatten_predictions, tokenize_tree, fit_to_byte_budget
+from lib.byte_budget import SizeModel, prune_to
+from lib.merge_batches import merge, prune, kway_merge, parallel_merge, merge_and_prune_files
+from lib.train_workers import WorkerPool
+from lib.constants import TARGET_DICTIONARY_COUNT
+from lib.batch_files import write_batch, load_batch, ColumnarBatch, is_batch_file
+from lib.batch_manifest import is_folded, record_batches
+import copy
+import pickle
+from lib.corpus_sources import LocalSource
+from lib.prefetch import Prefetcher
+from lib.predict import Predictor, ContextLevel, process_input, apply_ambition_penalties
+from lib.evaluate import evaluate_document, new_totals, add_totals, report
+from lib.compiled_dictionary import compile_dictionary, CompiledPredictor, CompiledDictionary, is_stale
+from serve import serve
+from lib.synthetic_corpus import ZipfCorpus, make_vocabulary
+from benchmark import compare
+from lib.metrics import Metrics
+from lib.tokenizer import Tokenizer
+from lib.prune import prune_tree
+from lib.dedup import Deduplicator
+from lib.convergence import ConvergenceMonitor, kendall_tau, top_k_overlap, rankings
+from lib.sharded_dictionary import shard_dictionary, ShardedPredictor, shard_hash
+import msgpack
+from lib.checkpoint_writer import BackgroundWriter
+from lib.process_document import main as process_document
+import asyncio
+import socket
+import gzip
+import json
+import os
+import sys
+import tempfile
 
 class TestFiling(unittest.TestCase):
     def test_basic_input(self):
@@ -14,12 +50,260 @@ class TestFiling(unittest.TestCase):
 
         self.assertEqual(actual, expected)
 
+class TestTreeStore(unittest.TestCase):
+    def file_both(self, windows):
+        tree_store = {}
+        compact_store = TreeStore()
+        for anchor, first_clause, second_clause, predictive_words in windows:
+            finish_filing(tree_store, { "anchor": anchor, "context_window": [first_clause, second_clause] }, predictive_words)
+            compact_store.add(anchor, first_clause, second_clause, predictive_words)
+        return tree_store, compact_store
+
+    def test_exports_nested_dict(self):
+        words = "the cat sat on the mat and the cat sat on the hat so the cat sat down.".split()
+        tree_store, compact_store = self.file_both(featurize_document(words))
+
+        self.assertEqual(compact_store.to_nested_dict(), tree_store)
+        self.assertEqual(list(compact_store.to_nested_dict()), list(tree_store))
+
+    def test_anchor_limit_matches_create_dictionary(self):
+        words = "a b a c a b d e b a f a g a b h".split()
+        tree_store, compact_store = self.file_both(featurize_document(words))
+
+        expected = create_dictionary(tree_store, 2)
+        actual = create_dictionary(compact_store.to_nested_dict(2), 2)
+
+        self.assertEqual(actual, expected)
+        self.assertEqual(list(actual), list(expected))
+
+    def test_node_counts(self):
+        _, compact_store = self.file_both([("a", "b", "c", ["x", "y"]), ("a", "b", "d", ["x", "y"]), ("e", "b", "c", ["z"])])
+
+        self.assertEqual(compact_store.node_counts(), {"words": 8, "anchors": 2, "contexts": 3, "predictions": 3})
+        self.assertGreater(compact_store.estimated_bytes(), 0)
+
+        compact_store.clear()
+        self.assertEqual(compact_store.node_counts(), {"words": 0, "anchors": 0, "contexts": 0, "predictions": 0})
+
+    def test_flush_budget(self):
+        _, compact_store = self.file_both([("a", "b", "c", ["x", "y"]), ("a", "b", "d", ["x", "y"]), ("e", "b", "c", ["z"])])
+        usage = compact_store.usage()
+
+        self.assertFalse(FlushBudget().reached(usage, 100))
+        self.assertTrue(FlushBudget(memory=usage["estimated_bytes"]).reached(usage, 0))
+        self.assertFalse(FlushBudget(memory=usage["estimated_bytes"] + 1).reached(usage, 0))
+        self.assertTrue(FlushBudget(nodes=16).reached(usage, 0))
+        self.assertFalse(FlushBudget(nodes=17).reached(usage, 0))
+        self.assertTrue(FlushBudget(memory=10 ** 9, words=5).reached(usage, 5))
+
+class TestBackgroundWriter(unittest.TestCase):
+    def test_writes_in_order(self):
+        def write(path, tree_store):
+            with open(path, 'a') as f:
+                f.write(f"{len(tree_store)}\n")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "checkpoints.txt")
+            writer = BackgroundWriter()
+            for size in range(1, 4):
+                tree_store = TreeStore()
+                for index in range(size):
+                    tree_store.add(f"anchor{index}", "a", "b", ["c"])
+                writer.submit(write, path, tree_store)
+            writer.wait()
+
+            with open(path) as f:
+                self.assertEqual(f.read(), "1\n2\n3\n")
+
+    def test_raises_when_a_write_fails(self):
+        writer = BackgroundWriter()
+        writer.submit(os._exit, 3)
+        with self.assertRaises(RuntimeError):
+            writer.wait()
+        # Nothing left in flight
+        writer.wait()
+
+class TestWorkerPool(unittest.TestCase):
+    def entries(self, tree):
+        """Every score and prediction of a tree with the path to it, whatever order they're stored in."""
+        found = set()
+        stack = [((), tree)]
+        while stack:
+            path, node = stack.pop()
+            for key, value in node.items():
+                if key == "score":
+                    found.add(path + (value,))
+                elif key == "predictions":
+                    found.update(path + (tuple(prediction["prediction"]), prediction["score"]) for prediction in value)
+                elif isinstance(value, dict):
+                    stack.append((path + (key,), value))
+        return found
+
+    def test_matches_a_single_process(self):
+        repeated = "the same words turn up in two chunks here"
+        documents = [f"doc{index} " + " ".join(f"w{index}x{word}" for word in range(8)) for index in range(4)]
+        documents[1] = documents[3] = repeated
+
+        working_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                with open("corpus.txt", "w") as f:
+                    f.write("\n\n".join(documents + ["left for the next run"]) + "\n")
+
+                source = LocalSource(["corpus.txt"], chunk_size=2)
+                chunks = source.iter_chunks()
+                pool = WorkerPool(2)
+                try:
+                    for _ in range(2):
+                        pool.submit(next(chunks))
+                    progress, batch_filenames = pool.flush()
+                finally:
+                    pool.close()
+                batches = [load_batch(filename) for filename in batch_filenames]
+                batch_files = sorted(os.listdir("training/batches"))
+
+                # The position saved after a flush picks up right after the flushed documents
+                resumed = LocalSource(["corpus.txt"], chunk_size=2)
+                resumed.load_state_dict(source.state_dict())
+                remaining = list(resumed.iter_chunks())
+            finally:
+                os.chdir(working_directory)
+
+        tree_store = TreeStore()
+        word_count = sum(process_document(tree_store, text.split()) for text in documents)
+        expected = create_dictionary(tree_store.to_nested_dict(), TARGET_DICTIONARY_COUNT)
+
+        # A batch from each worker, and nothing else written
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batch_files, sorted(os.path.basename(filename) for filename in batch_filenames))
+        self.assertTrue(all(name.endswith(".batch") for name in batch_files))
+        self.assertEqual(self.entries(merge(*batches)), self.entries(expected))
+        self.assertEqual(sum(counted for _, _, counted, _, _ in progress), word_count)
+        self.assertEqual(sum(read for _, read, _, _, _ in progress), sum(len(text.split()) for text in documents))
+        # The last progress from each worker is its emptied tree store
+        last_usage = {worker_id: usage for worker_id, _, _, usage, _ in progress}
+        self.assertEqual([usage["anchors"] for usage in last_usage.values()], [0, 0])
+        self.assertEqual(remaining, [["left for the next run"]])
+
+class TestMetrics(unittest.TestCase):
+    def test_times_document_stages(self):
+        metrics = Metrics()
+        tree_store = TreeStore()
+        process_document(tree_store, "the cat sat on the mat and the cat sat on the hat.".split(), metrics)
+        metrics.observe_usage(tree_store.usage())
+
+        self.assertEqual(metrics.stages["featurize"][1], 1)
+        self.assertEqual(metrics.stages["file"][1], 1)
+        self.assertEqual(metrics.gauges["tree_store_anchors"], tree_store.node_counts()["anchors"])
+
+    def test_exports(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ("metrics.json", "metrics.prom"):
+                metrics = Metrics(os.path.join(directory, name))
+                for _ in metrics.timed_iter("read", [1, 2]):
+                    metrics.count("words_read", 5)
+                metrics.export()
+
+                with open(metrics.path) as f:
+                    content = f.read()
+                if name.endswith(".json"):
+                    snapshot = json.loads(content)
+                    self.assertEqual(snapshot["stages"]["read"]["calls"], 3)
+                    self.assertEqual(snapshot["counters"]["words_read"], 10)
+                else:
+                    self.assertIn('tiny_predictive_text_stage_calls_total{stage="read"} 3', content)
+                    self.assertIn('tiny_predictive_text_words_read_total 10', content)
+
+    def test_snapshot_without_resource_module(self):
+        self.assertIn("peak_rss_bytes", Metrics().snapshot()["gauges"])
+
+        # Windows has no resource module, so a None entry stands in for it
+        saved = sys.modules.get("resource")
+        sys.modules["resource"] = None
+        try:
+            snapshot = Metrics().snapshot()
+        finally:
+            if saved is None:
+                del sys.modules["resource"]
+            else:
+                sys.modules["resource"] = saved
+        self.assertNotIn("peak_rss_bytes", snapshot["gauges"])
+
+class TestHeavyHitters(unittest.TestCase):
+    def test_exact_below_capacity(self):
+        summary = SpaceSaving(10)
+        for key in "abracadabra":
+            summary.add(key)
+
+        self.assertEqual(summary.counts, {"a": 5, "b": 2, "r": 2, "c": 1, "d": 1})
+        self.assertEqual(summary.error_bound(), 0)
+        self.assertEqual(summary.top(2), ["a", "b"])
+
+    def test_keeps_spread_out_heavy_hitter(self):
+        summary = SpaceSaving(8)
+        stream = []
+        for index in range(200):
+            stream.append(f"noise{index}")
+            if index % 4 == 0:
+                stream.append("frequent")
+        for key in stream:
+            summary.add(key)
+
+        self.assertIn("frequent", summary)
+        self.assertEqual(summary.top(1), ["frequent"])
+        for key in summary.counts:
+            true_count = stream.count(key)
+            self.assertGreaterEqual(summary[key], true_count)
+            self.assertLessEqual(summary[key] - true_count, summary.error_bound())
+
+    def test_exports_nested_dict(self):
+        words = "the cat sat on the mat and the cat sat on the hat so the cat sat down.".split()
+        tree_store = {}
+        summary_store = HeavyHitterStore(100, 100, 100)
+        for anchor, first_clause, second_clause, predictive_words in featurize_document(words):
+            finish_filing(tree_store, { "anchor": anchor, "context_window": [first_clause, second_clause] }, predictive_words)
+            summary_store.add(anchor, first_clause, second_clause, predictive_words)
+
+        self.assertEqual(summary_store.to_nested_dict(), tree_store)
+
+class TestFeaturizeDocument(unittest.TestCase):
+    def test_matches_per_index_extraction(self):
+        words = "The cat, who had been sitting on the mat for an hour, finally said “hello” to A dog — it's re-done. Of course and is".split()
+        expected = []
+        for index in range(len(words) - 2):
+            context_words = process_context_words(words, index)
+            first_clause, second_clause = context_words["context_window"]
+            expected.append((context_words["anchor"], first_clause, second_clause, process_predictive_words(words, index)))
+
+        self.assertEqual(featurize_document(words), expected)
+
+    def test_short_documents(self):
+        self.assertEqual(featurize_document([]), [])
+        self.assertEqual(featurize_document(["one", "two"]), [])
+        self.assertEqual(featurize_document(["one", "two", "three"]), [("one", "", "", ["two", "three"])])
+
+    def test_files_a_document_in_pieces(self):
+        words = "The cat, who had been sitting on the mat for an hour, finally said hello to A dog. Of course and is".split()
+        whole = TreeStore()
+        counted = process_document(whole, words)
+
+        for size in (1, 4, 7):
+            pieces = TreeStore()
+            self.assertEqual(sum(process_document(pieces, words, None, start, start + size) for start in range(0, len(words), size)), counted)
+            self.assertEqual(pieces.to_nested_dict(), whole.to_nested_dict())
+
+        resumed = TreeStore()
+        self.assertEqual(process_document(resumed, words, None, 9), counted - 9)
+
 class TestCreateDictionary(unittest.TestCase):
     def test_basic_input(self):
       tree = { "anchor": { "score": 1, "second": { "score": 1, "first": { "score": 1, "predictions": [ {"prediction": ["a", "a2", "a3"], "score": 1}, {"prediction": ["b", "b2", "b3"], "score": 1}, {"prediction": ["c", "c2", "c3"], "score": 1} ] } } } }
+      # create_dictionary prunes in place, so compare against the tree as it was before
+      expected_pruned_tree = copy.deepcopy(tree)
       pruned_tree = create_dictionary(tree, 1000)
 
-      self.assertEqual(pruned_tree, tree)
+      self.assertEqual(pruned_tree, expected_pruned_tree)
 
     def test_pruning_input(self):
       tree = { "anchor": { "score": 2, "second": { "score": 1, "first": { "score": 1, "predictions": [ {"prediction": ["a", "a2", "a3"], "score": 1}, {"prediction": ["b", "b2", "b3"], "score": 1}, {"prediction": ["c", "c2", "c3"], "score": 1} ] } } }, 
@@ -64,6 +348,19 @@ class TestCreateDictionary(unittest.TestCase):
 
       self.assertEqual(pruned_tree, expected_pruned_tree)
 
+    def test_prunes_in_place_keeping_ties_in_order(self):
+      predictions = [{"prediction": [word], "score": score} for word, score in [("a", 1), ("b", 2), ("c", 2), ("d", 1)]]
+      subtree = {"score": 4, "x": {"score": 1, "predictions": predictions}, "y": {"score": 3}, "z": {"score": 3}, "w": {"score": 1}}
+      tree = {"anchor": subtree, "other": {"score": 1}}
+
+      pruned_tree = prune_tree(tree, 1, subbranch_limit=3, prediction_limit=2)
+
+      self.assertIs(pruned_tree, tree)
+      self.assertIs(pruned_tree["anchor"], subtree)
+      self.assertEqual(list(pruned_tree), ["anchor"])
+      self.assertEqual(list(subtree), ["y", "z", "x", "score"])
+      self.assertEqual([prediction["prediction"] for prediction in subtree["x"]["predictions"]], [["b"], ["c"]])
+
     def test_token_dict(self):
       tree = {"anchor": {"score": 1, "second": {"score": 1, "first": {"score": 1, "predictions": [{ "prediction": ["a", "a2", "a3"], "score": 1}, { "prediction": ["b", "b2", "b3"], "score": 1 }, { "prediction": ["c", "c2", "c3"], "score": 1 } ]}}}} 
       expected_tokenized_tree = {1: {2: {12: [[3,4,5], [6,7,8], [9,10,11]]}}} 
@@ -72,6 +369,89 @@ class TestCreateDictionary(unittest.TestCase):
 
       self.assertEqual(actual_tokenized_tree, expected_tokenized_tree)
 
+class TestTokenizer(unittest.TestCase):
+    tree = {"anchor": {"second": {"first": [["a", "the", "cat"], ["the", "dog"], ["the", "cat"]]}}}
+
+    def test_most_frequent_first(self):
+        tokenizer = Tokenizer()
+        tokenizer.fit(self.tree)
+        tokenized, tokens = tokenizer.tokenize(self.tree)
+
+        self.assertEqual(tokens, {0: "the", 1: "cat", 2: "anchor", 3: "second", 4: "first", 5: "a", 6: "dog"})
+        self.assertEqual(tokenized, {2: {3: {4: [[5, 0, 1], [0, 6], [0, 1]]}}})
+
+        legacy = copy.deepcopy(self.tree)
+        self.assertLessEqual(len(msgpack.packb(tokenized)), len(msgpack.packb(create_token_dict(legacy))))
+
+    def test_keeps_ids_between_builds(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "vocabulary.msgpack")
+            tokenizer = Tokenizer.load(path)
+            tokenizer.fit(self.tree)
+            tokenizer.save(path)
+
+            tokenizer = Tokenizer.load(path)
+            tokenizer.fit({"anchor": {"new": {"first": [["dog", "dog"]]}}})
+            tokenized, tokens = tokenizer.tokenize({"anchor": {"new": {"first": [["dog", "dog"]]}}})
+            self.assertEqual(tokenized, {2: {7: {4: [[6, 6]]}}})
+            self.assertEqual(tokens, {2: "anchor", 4: "first", 6: "dog", 7: "new"})
+
+            # Counts are the last build's, so dog comes first and the strings it no longer uses sink to the end
+            tokenizer.rebuild()
+            self.assertEqual(tokenizer.strings, ["dog", "anchor", "first", "new", "the", "cat", "second", "a"])
+
+            # Fitting the same tree again leaves the counts as they were
+            tokenizer.fit({"anchor": {"new": {"first": [["dog", "dog"]]}}})
+            self.assertEqual(tokenizer.counts, [2, 1, 1, 1, 0, 0, 0, 0])
+
+class TestByteBudget(unittest.TestCase):
+    # Enough strings for ids past one and two byte msgpack ints, and scores that aren't all tied
+    tree = {
+        f"anchor{a}": dict({"score": 40 - a}, **{
+            f"second{a}_{s}": {"score": 20 - s, f"first{s}": {"score": 20 - s, "predictions": [
+                {"prediction": [f"word{(a * s + p) % 300}", "a" * (p * 20)], "score": 5 - p} for p in range(4)
+            ]}} for s in range(8)
+        }) for a in range(30)
+    }
+
+    def encoded_bytes(self, tree):
+        tokenized, tokens = tokenize_tree(copy.deepcopy(tree), Tokenizer())
+        return len(msgpack.packb(tokenized)) + len(msgpack.packb(tokens))
+
+    def test_estimates_encoded_size(self):
+        model = SizeModel(self.tree, Tokenizer())
+        self.assertEqual((model.max_subbranches, model.max_predictions), (8, 4))
+        self.assertEqual(model.simplified(), remove_scores_and_flatten_predictions(copy.deepcopy(self.tree)))
+
+        everything = model.fit(float('inf'), 8, 4)
+        self.assertEqual(everything["anchors"], 30)
+        self.assertEqual(everything["bytes"], self.encoded_bytes(self.tree))
+        self.assertEqual(everything["mass"], model.total_mass)
+
+        # One byte short of the last anchor leaves it out
+        self.assertEqual(model.fit(everything["bytes"] - 1, 8, 4)["anchors"], 29)
+
+        # With ids from the whole tree, a pruned tree is estimated at or a little over what it encodes to
+        some = model.fit(float('inf'), 3, 2)
+        pruned = prune_to(copy.deepcopy(self.tree), some)
+        self.assertLessEqual(self.encoded_bytes(pruned), some["bytes"])
+        self.assertEqual(model.simplified(some), remove_scores_and_flatten_predictions(pruned))
+
+    def test_fits_budget(self):
+        previous = None
+        for budget in (3000, 6000, 12000):
+            tree = copy.deepcopy(self.tree)
+            choice = fit_to_byte_budget(tree, budget, Tokenizer())
+            self.assertEqual(len(tree), choice["anchors"])
+            self.assertEqual(self.encoded_bytes(tree), choice["encoded_bytes"])
+            self.assertLessEqual(choice["encoded_bytes"], budget)
+            if previous:
+                self.assertGreater(choice["mass"], previous["mass"])
+            previous = choice
+
+        with self.assertRaises(ValueError):
+            fit_to_byte_budget(copy.deepcopy(self.tree), 10, Tokenizer())
+
 class TestMergingAndPruningEpochs(unittest.TestCase):      
     def test_merging_batches(self):
         tree_1 = {
@@ -107,5 +487,467 @@ class TestMergingAndPruningEpochs(unittest.TestCase):
         
         self.assertEqual(actual_pruned_tree, expected_pruned_tree)
 
+class TestPredict(unittest.TestCase):
+    # The quick brown fox wants to jump over the lazy anchor. Both levels are keyed by what lib.rs matches them against.
+    dictionary = {0: {1: {1: [[3, 4, 5], [6, 7, 8]], 9: [[3]]}}}
+    tokens = {0: "anchor", 1: "otl", 2: "fwj", 3: "I", 4: "love", 5: "you", 6: "how's", 7: "it", 8: "hanging?", 9: "bfl"}
+
+    def test_contexts(self):
+        self.assertEqual(process_input("Apple banana carrot orange"), ("orange", "abc", ""))
+        self.assertEqual(process_input("carrot orange"), ("orange", "c", ""))
+        self.assertEqual(process_input("sweater if you think you need"), ("need", "yty", "s"))
+        self.assertEqual(process_input("Xylophone Yacht is Zebra Apple banana carrot orange")[2], "xyz")
+        self.assertEqual(process_input("orange"), ("orange", "", ""))
+        self.assertEqual(process_input(""), ("", "", ""))
+
+    def test_close_match(self):
+        level = ContextLevel(["apple", "banana"], [10, 20])
+        self.assertEqual(level.match("pplea")[0], 10)
+        self.assertEqual(level.match("banana"), (20, 50))
+        self.assertEqual(ContextLevel([], []).match("apple"), (None, 0))
+
+    def test_predicts(self):
+        predictor = Predictor(self.dictionary, self.tokens)
+        result = predictor.predict("The quick brown fox wants to jump over the lazy Anchor!")
+        self.assertEqual(result["anchor_token"], 0)
+        self.assertEqual((result["first_level_context"], result["second_level_context"]), ("otl", "fwj"))
+        self.assertEqual(result["quality"], 100)
+        self.assertEqual(result["prediction"], ["I love you", "how's it hanging?"])
+
+        # Like lib.rs, the second level is matched against the first level context too: a key equal to the
+        # second level context doesn't win over one equal to the first
+        result = predictor.predict("The quick brown fox leaps over the lazy anchor")
+        self.assertEqual(result["second_level_context"], "bfl")
+        self.assertEqual(result["quality"], 100)
+        self.assertEqual(result["prediction"], ["I love you", "how's it hanging?"])
+
+        # Closest first level context still wins, at both levels
+        result = predictor.predict("The quick brown fox leaps over a lazy anchor")
+        self.assertEqual(result["quality"], 33 + 33)
+        self.assertEqual(result["prediction"], ["I love you", "how's it hanging?"])
+
+        self.assertEqual(predictor.predict("no such word")["prediction"], [])
+
+    def test_predict_many(self):
+        predictor = Predictor(self.dictionary, self.tokens)
+        texts = ["jump over the lazy anchor", "nothing", "jump over the lazy anchor"]
+        results = predictor.predict_many(texts)
+        self.assertEqual(results, [predictor.predict(text) for text in texts])
+        self.assertIsNot(results[0]["prediction"], results[2]["prediction"])
+
+    def test_ambition_penalties(self):
+        suggestions = apply_ambition_penalties({"quality": 50, "prediction": ["how's it hanging?", "I", "I love"]})
+        self.assertEqual(suggestions["prediction"], [
+            {"completion": "I", "quality": 55},
+            {"completion": "I love", "quality": 49},
+            {"completion": "how's it hanging?", "quality": 45},
+        ])
+        self.assertEqual(apply_ambition_penalties({"quality": 0, "prediction": ["I"]})["prediction"], [{"completion": "I", "quality": 0}])
+
+class TestEvaluate(unittest.TestCase):
+    def test_replays_held_out_text(self):
+        predictor = Predictor(TestPredict.dictionary, TestPredict.tokens)
+        text = "The quick brown fox wants to jump over the lazy anchor I love you."
+        totals = evaluate_document(predictor, text, new_totals())
+
+        self.assertEqual((totals["positions"], totals["covered"], totals["top1"], totals["top3"]), (13, 1, 1, 1))
+        # Accepting "I love you" saves typing it, less the keystroke to accept it
+        self.assertEqual((totals["keystrokes"], totals["keystrokes_saved"]), (len(text), len("I love you") - 1))
+
+        # Totals from separate processes add up
+        result = report(add_totals(add_totals(new_totals(), totals), evaluate_document(predictor, "the lazy anchor how's it going", new_totals())))
+        self.assertEqual((result["documents"], result["positions"], result["top3_hit_rate"]), (2, 18, round(1 / 18, 4)))
+        self.assertEqual([bucket["suggestions"] for bucket in result["calibration"]], [1, 1])
+
+class TestCompiledDictionary(unittest.TestCase):
+    texts = [
+        "The quick brown fox wants to jump over the lazy anchor",
+        "The quick brown fox leaps over a lazy anchor",
+        "lazy anchor",
+        "I love",
+        "",
+    ]
+
+    def test_matches_predictor(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dictionary.compiled")
+            compile_dictionary(TestPredict.dictionary, TestPredict.tokens, path)
+            predictor = CompiledPredictor(path)
+            try:
+                expected = Predictor(TestPredict.dictionary, TestPredict.tokens).predict_many(self.texts)
+                self.assertEqual(predictor.predict_many(self.texts), expected)
+                # Known word that isn't an anchor
+                self.assertEqual(predictor.predict("I love")["anchor_token"], 4)
+            finally:
+                predictor.close()
+
+    def test_packs_columns(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dictionary.compiled")
+            tokens = {**TestPredict.tokens, 70000: "zzz"}
+            compile_dictionary(TestPredict.dictionary, tokens, path)
+            with CompiledDictionary(path) as dictionary:
+                self.assertEqual(dictionary.columns["prediction_words"].format, 'H')
+                self.assertEqual(dictionary.columns["string_tokens"].format, 'I')
+                strings = dictionary.strings()
+                self.assertEqual(strings, sorted(strings))
+            self.assertFalse(is_stale(path, ()))
+
+            # Files in an older layout are recompiled
+            with open(path, 'r+b') as f:
+                f.write(b"TPTDIC01")
+            self.assertTrue(is_stale(path, ()))
+
+    def test_serves_predictions(self):
+        async def request(port, raw):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(raw)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            head, _, body = response.partition(b"\r\n\r\n")
+            return head.split(b" ")[1], json.loads(body)
+
+        async def run(path):
+            listening_socket = socket.create_server(("127.0.0.1", 0))
+            port = listening_socket.getsockname()[1]
+            started = asyncio.Event()
+            server = asyncio.create_task(serve(listening_socket, path, max_concurrency=2, batch_size=8, batch_wait=0.01, started=started))
+            await started.wait()
+            try:
+                body = json.dumps({"texts": self.texts}).encode()
+                responses = await asyncio.gather(
+                    request(port, b"POST /predict HTTP/1.0\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body),
+                    request(port, b"GET /predict?text=jump+over+the+lazy+anchor HTTP/1.0\r\n\r\n"),
+                    request(port, b"GET /elsewhere HTTP/1.0\r\n\r\n"),
+                )
+            finally:
+                server.cancel()
+            return responses
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dictionary.compiled")
+            compile_dictionary(TestPredict.dictionary, TestPredict.tokens, path)
+            (batch_status, batch), (single_status, single), (missing_status, _) = asyncio.run(run(path))
+
+        predictor = Predictor(TestPredict.dictionary, TestPredict.tokens)
+        self.assertEqual(batch_status, b"200")
+        self.assertEqual(batch, [apply_ambition_penalties(result) for result in predictor.predict_many(self.texts)])
+        self.assertEqual(single_status, b"200")
+        self.assertEqual(single["prediction"][0], {"completion": "I love you", "quality": 95})
+        self.assertEqual(missing_status, b"404")
+
+class TestShardedDictionary(unittest.TestCase):
+    def test_matches_monolithic_lookups(self):
+        # Spread the anchors out so several shards have some
+        dictionary = {token + 100: node for token, node in TestPredict.dictionary.items()}
+        for offset in range(1, 30):
+            dictionary[200 + offset] = {1: {2: [[3, 4]]}}
+        tokens = dict(TestPredict.tokens)
+        tokens.update({token + 100: tokens[token] + "!" for token in TestPredict.dictionary})
+        tokens.update({200 + offset: f"word{offset}" for offset in range(1, 30)})
+        tokens[0] = "anchor"
+
+        texts = TestCompiledDictionary.texts + ["The quick brown fox anchor!"] + [f"the lazy fox word{offset}" for offset in range(1, 32)]
+        expected = Predictor(dictionary, tokens).predict_many(texts)
+
+        with tempfile.TemporaryDirectory() as directory:
+            index = shard_dictionary(dictionary, tokens, directory, shard_size=64)
+            self.assertGreater(index["shard_count"], 1)
+
+            predictor = ShardedPredictor(directory)
+            predictor.predict("the lazy fox word1")
+            self.assertEqual(len(predictor.shards), 1)
+            self.assertEqual(predictor.predict_many(texts), expected)
+
+            # A rebuild with fewer shards clears out the old ones
+            shard_dictionary(dictionary, tokens, directory, shard_size=1024 * 1024)
+            self.assertEqual(sorted(os.listdir(directory)), ["index.json", "shard_0000_of_0001.msgpack"])
+
+    def test_stable_hash(self):
+        self.assertEqual(shard_hash(""), 0x811c9dc5)
+        self.assertEqual(shard_hash("a"), 0xe40c292c)
+
+class TestSyntheticCorpus(unittest.TestCase):
+    def test_reproducible_zipf_corpus(self):
+        corpus = ZipfCorpus(vocabulary_size=500, seed=3)
+        documents = list(corpus.documents(20000))
+        self.assertEqual(documents, list(ZipfCorpus(vocabulary_size=500, seed=3).documents(20000)))
+        self.assertNotEqual(documents, list(ZipfCorpus(vocabulary_size=500, seed=4).documents(20000)))
+
+        words = [word.rstrip(",.?") for document in documents for word in document.split()]
+        self.assertEqual(len(words), 20000)
+        self.assertEqual(len(set(make_vocabulary(500))), 500)
+        # The top ranked word is far more common than one further down
+        self.assertGreater(words.count(corpus.vocabulary[0]), 10 * words.count(corpus.vocabulary[100]))
+
+    def test_flags_regressions(self):
+        baseline = {"results": [{"stage": "file", "words": 10, "seconds": 1.0}, {"stage": "end_to_end", "words": 10, "prune_frequency": 5, "seconds": 2.0}]}
+        results = [{"stage": "file", "words": 10, "seconds": 1.1}, {"stage": "end_to_end", "words": 10, "prune_frequency": 5, "seconds": 3.0}, {"stage": "merge", "words": 10, "seconds": 9.0}]
+        self.assertEqual([(regression["stage"], regression["slowdown"]) for regression in compare(results, baseline, 0.2)], [("end_to_end", 1.5)])
+
+class TestConvergence(unittest.TestCase):
+    def make_batch(self, scores):
+        return {
+            anchor: {"score": score, "ab": {"score": score, "cd": {"score": score, "predictions": [{"prediction": [anchor, "next"], "score": score}]}}}
+            for anchor, score in scores.items()
+        }
+
+    def test_rank_measures(self):
+        self.assertEqual(kendall_tau(list("abcd"), list("abcd")), 1)
+        self.assertEqual(kendall_tau(list("abcd"), list("dcba")), -1)
+        # One of six pairs swapped, e only in one ranking
+        self.assertAlmostEqual(kendall_tau(list("abcde"), list("abdc")), 1 - 2 / 6)
+        self.assertEqual(top_k_overlap(list("abcd"), list("abce")), 0.75)
+        self.assertEqual(top_k_overlap(list("abcd"), list("bax"), k=2), 1)
+
+        ranked = rankings(self.make_batch({"x": 1, "y": 3}))
+        self.assertEqual(ranked["anchors"], ["y", "x"])
+        self.assertEqual(ranked["predictions"], [("y", "ab", "cd", "y next"), ("x", "ab", "cd", "x next")])
+
+    def test_converges_once_batches_stop_changing_the_ranking(self):
+        monitor = ConvergenceMonitor(tolerance=0.05, patience=2, target_dict_size=3)
+        self.assertFalse(monitor.add_batch(self.make_batch({"a": 5, "b": 1})))
+        # A new anchor takes the lead
+        self.assertFalse(monitor.add_batch(self.make_batch({"c": 9, "b": 1})))
+        self.assertEqual(monitor.steady, 0)
+        self.assertFalse(monitor.add_batch(self.make_batch({"c": 9, "a": 5, "b": 1})))
+        self.assertTrue(monitor.add_batch(self.make_batch({"c": 9, "a": 5, "b": 1})))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "convergence.pkl")
+            monitor.save(path)
+            self.assertTrue(ConvergenceMonitor.load(path, patience=5).converged)
+
+class TestDeduplicator(unittest.TestCase):
+    def test_skips_exact_and_near_duplicates(self):
+        documents = list(ZipfCorpus(vocabulary_size=2000, seed=5, document_words=(200, 200)).documents(4000))
+        original = documents[0].split()
+        near = " ".join(original[:100] + ["changed"] + original[101:])
+        dedup = Deduplicator(threshold=0.8)
+
+        kept, words_skipped = dedup.filter(documents + ["  " + documents[1].replace(" ", "\n")] + [near] + ["too short", "too  short"])
+
+        self.assertEqual(kept, documents + ["too short"])
+        self.assertEqual((dedup.exact_duplicates, dedup.near_duplicates), (2, 1))
+        self.assertEqual(words_skipped, len(documents[1].split()) + len(original) + 2)
+        self.assertEqual(dedup.counters()["dedup_documents_skipped"], 3)
+
+    def test_forgets_oldest_documents(self):
+        documents = list(ZipfCorpus(vocabulary_size=2000, seed=6, document_words=(50, 50)).documents(200))
+        dedup = Deduplicator(max_documents=2)
+        dedup.filter(documents)
+
+        self.assertEqual(len(dedup.signatures), 2)
+        self.assertEqual(len(dedup.exact), 2)
+        self.assertEqual(dedup.filter([documents[0], documents[-1]])[0], [documents[0]])
+
+class TestLocalCorpusSource(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.directory.name, "a.txt"), "w") as f:
+            f.write("one two three\n\nfour five six\n")
+        with gzip.open(os.path.join(self.directory.name, "b.jsonl.gz"), "wt") as f:
+            f.write(json.dumps({"text": "seven eight"}) + "\n" + json.dumps({"text": "nine ten"}) + "\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_reads_all_formats_in_order(self):
+        source = LocalSource([self.directory.name], chunk_size=2)
+        chunks = list(source.iter_chunks())
+
+        self.assertEqual(chunks, [["one two three", "four five six"], ["seven eight", "nine ten"]])
+
+    def test_resumes_from_state_dict(self):
+        source = LocalSource([self.directory.name], chunk_size=1)
+        chunks = source.iter_chunks()
+        next(chunks)
+        next(chunks)
+        state_dict = source.state_dict()
+
+        resumed = LocalSource([self.directory.name], chunk_size=1)
+        resumed.load_state_dict(state_dict)
+
+        self.assertEqual(list(resumed.iter_chunks()), [["seven eight"], ["nine ten"]])
+
+    def test_resumes_inside_a_chunk(self):
+        source = LocalSource([self.directory.name], chunk_size=3)
+        chunks = source.iter_chunks()
+        next(chunks)
+
+        for documents, expected in ((0, ["one two three", "four five six"]), (1, ["four five six"]), (2, ["seven eight", "nine ten"])):
+            resumed = LocalSource([self.directory.name], chunk_size=3)
+            resumed.load_state_dict(source.state_dict(documents))
+            self.assertEqual(next(resumed.iter_chunks()), expected)
+
+    def test_prefetches_with_the_position_training_is_at(self):
+        prefetcher = Prefetcher(LocalSource([self.directory.name], chunk_size=1), depth=2)
+        chunks = prefetcher.iter_chunks()
+        self.assertEqual(next(chunks), ["one two three"])
+        # However far ahead the reader is, the position is the chunk handed out
+        resumed = LocalSource([self.directory.name], chunk_size=1)
+        resumed.load_state_dict(prefetcher.state_dict())
+        self.assertEqual(next(resumed.iter_chunks()), ["four five six"])
+        resumed.load_state_dict(prefetcher.state_dict(0))
+        self.assertEqual(next(resumed.iter_chunks()), ["one two three"])
+
+        self.assertEqual(list(chunks), [["four five six"], ["seven eight"], ["nine ten"]])
+        self.assertFalse(prefetcher.thread.is_alive())
+
+    def test_prefetch_raises_read_errors(self):
+        with open(os.path.join(self.directory.name, "c.txt.gz"), "wb") as f:
+            f.write(b"not gzip\n")
+        with self.assertRaises(gzip.BadGzipFile):
+            list(Prefetcher(LocalSource([self.directory.name], chunk_size=1)).iter_chunks())
+
+    def test_skips_malformed_json_lines(self):
+        with open(os.path.join(self.directory.name, "c.jsonl"), "wb") as f:
+            f.write(b'not json\n"a string"\n[1, 2]\n{"text": 3}\n\xff\xfe\n{"text": "eleven"}\n')
+        source = LocalSource([self.directory.name], chunk_size=2)
+        with self.assertLogs(level="WARNING") as logs:
+            chunks = list(source.iter_chunks())
+
+        self.assertEqual(chunks[-1], ["eleven"])
+        self.assertEqual(source.skipped_lines, 5)
+        self.assertIn("Skipped 5 malformed lines", logs.output[0])
+
+class TestKwayMerge(unittest.TestCase):
+    def make_tree(self, anchors):
+        return {
+            anchor: {"score": score, "x": {"score": score, "y": {"score": score, "predictions": [{"prediction": [anchor, "next"], "score": score}]}}}
+            for anchor, score in anchors.items()
+        }
+
+    def test_matches_merging_everything_in_memory(self):
+        trees = [
+            self.make_tree({"a": 3, "b": 1}),
+            self.make_tree({"b": 2, "c": 5}),
+            self.make_tree({"a": 1, "c": 1, "d": 2}),
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for index, tree in enumerate(trees):
+                path = os.path.join(directory, f"batch_{index}.pkl" if index == 0 else f"batch_{index}.batch")
+                if index == 0:
+                    # Legacy pickled tree
+                    with open(path, "wb") as f:
+                        pickle.dump(tree, f)
+                else:
+                    write_batch(tree, path, "columnar" if index == 1 else "sorted_run")
+                paths.append(path)
+
+            self.assertEqual(load_batch(paths[1]), trees[1])
+
+            expected = prune(merge(merge(copy.deepcopy(trees[0]), copy.deepcopy(trees[1])), copy.deepcopy(trees[2])), 3)
+            actual = kway_merge(paths, 3)
+            self.assertEqual(kway_merge(paths, 0), prune(copy.deepcopy(trees[0]), 0))
+
+        self.assertEqual(actual, expected)
+        self.assertEqual(list(actual), ["c", "a", "b"])
+
+class TestBatchFileNames(unittest.TestCase):
+    def test_lists_every_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, batch_format in [("a.batch", "columnar"), ("b.batch", "sorted_run")]:
+                write_batch({"x": {"score": 1}}, os.path.join(directory, name), batch_format)
+            # Legacy pickled tree
+            with open(os.path.join(directory, "c.pkl"), "wb") as f:
+                pickle.dump({"x": {"score": 1}}, f)
+            with open(os.path.join(directory, "notes.txt"), "w") as f:
+                f.write("not a batch")
+
+            names = sorted(filter(is_batch_file, os.listdir(directory)))
+            self.assertEqual(names, ["a.batch", "b.batch", "c.pkl"])
+            for name in names:
+                self.assertEqual(load_batch(os.path.join(directory, name)), {"x": {"score": 1}})
+
+class TestColumnarBatch(unittest.TestCase):
+    tree = {
+        "zebra": {"score": 2, "abc": {"score": 2, "de": {"score": 2, "predictions": [{"prediction": ["over", "the"], "score": 2}]}}},
+        "\\sscore": {"score": 1, "xyz": {"score": 1, "": {"score": 1}}},
+        "café": {"score": 7, "abc": {"score": 4, "fg": {"score": 3, "predictions": [{"prediction": ["au", "lait"], "score": 3}, {"prediction": ["zebra"], "score": 1}]}, "hi": {"score": 1, "predictions": []}}, "x": {"score": 3, "": {"score": 3, "predictions": [{"prediction": ["noir"], "score": 3}]}}},
+    }
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "batch.batch")
+            write_batch(self.tree, path, "columnar")
+            loaded = load_batch(path)
+
+        # Empty prediction lists aren't stored
+        expected = copy.deepcopy(self.tree)
+        del expected["café"]["abc"]["hi"]["predictions"]
+        self.assertEqual(loaded, expected)
+        self.assertEqual(list(loaded), sorted(self.tree))
+        self.assertEqual(list(loaded["café"]), ["score", "abc", "x"])
+
+    def test_lookup_without_loading(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "batch.batch")
+            write_batch(self.tree, path, "columnar")
+            with ColumnarBatch(path) as batch:
+                self.assertEqual(len(batch), 3)
+                self.assertEqual(batch.get("zebra"), self.tree["zebra"])
+                self.assertEqual(batch.get("café")["x"], self.tree["café"]["x"])
+                self.assertIsNone(batch.get("aardvark"))
+                self.assertIsNone(batch.get("zzz"))
+
+class TestParallelMerge(unittest.TestCase):
+    def test_matches_serial_merge(self):
+        trees = []
+        for index in range(5):
+            trees.append({
+                f"anchor{(index + offset) % 7}": {"score": 1 + (index * offset) % 3, "x": {"score": 1, "y": {"score": 1, "predictions": [{"prediction": [f"p{index}"], "score": 1}]}}}
+                for offset in range(4)
+            })
+
+        working_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                for folder in ["batches_to_process", "merged_batches", "processed_batches", "parallel"]:
+                    os.makedirs(f"training/{folder}")
+                for index, tree in enumerate(trees):
+                    write_batch(tree, f"training/batches_to_process/batch_{index}.batch")
+                    write_batch(tree, f"training/parallel/batch_{index}.batch")
+
+                threads = []
+                merge_and_prune_files(sorted(os.listdir("training/batches_to_process")), threads)
+                for thread in threads:
+                    thread.join()
+                serial_files = os.listdir("training/batches_to_process")
+                serial = load_batch(f"training/batches_to_process/{serial_files[0]}")
+
+                parallel_path = parallel_merge([f"training/parallel/batch_{index}.batch" for index in range(5)], "training/parallel", workers=2)
+                parallel = load_batch(parallel_path)
+            finally:
+                os.chdir(working_directory)
+
+        self.assertEqual(len(serial_files), 1)
+        self.assertEqual(os.path.basename(parallel_path), serial_files[0])
+        self.assertEqual(serial_files[0], "batch_0_merged_merged_merged.batch")
+        self.assertEqual(parallel, serial)
+        self.assertEqual(list(parallel), list(serial))
+
+class TestBatchManifest(unittest.TestCase):
+    def test_recognises_folded_batches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ["one.pkl", "two.pkl"]:
+                with open(os.path.join(directory, name), "wb") as f:
+                    f.write(name.encode())
+            manifest = {"batches": {}, "dictionary": None}
+            record_batches(manifest, directory, ["one.pkl"])
+
+            self.assertTrue(is_folded(manifest, directory, "one.pkl"))
+            self.assertFalse(is_folded(manifest, directory, "two.pkl"))
+
+            # Touched but unchanged is still folded, changed contents are not.
+            os.utime(os.path.join(directory, "one.pkl"), ns=(0, 0))
+            self.assertTrue(is_folded(manifest, directory, "one.pkl"))
+            with open(os.path.join(directory, "one.pkl"), "wb") as f:
+                f.write(b"eno.pkl")
+            self.assertFalse(is_folded(manifest, directory, "one.pkl"))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -4,16 +4,26 @@ import gc
 import shutil
 from tqdm import tqdm
 import signal
-import datasets
-import logging
 import sys
+import time
 import asyncio
-from lib.process_predictive_words import main as process_predictive_words
-from lib.process_context_words import main as process_context_words
-from lib.finish_filing import main as finish_filing
-from lib.create_dictionary import create_batch
+from contextlib import nullcontext
+from functools import partial
+from lib.process_document import main as process_document
+from lib.create_dictionary import create_batch, create_dictionary
+from lib.train_workers import WorkerPool
+from lib.corpus_sources import open_source, SOURCES
+from lib.tree_store import TreeStore, FlushBudget
+from lib.heavy_hitters import HeavyHitterStore
+from lib.batch_files import write_batch, load_batch
+from lib.metrics import Metrics
+from lib.checkpoint_writer import BackgroundWriter
+from lib.dedup import Deduplicator
+from lib.convergence import ConvergenceMonitor
+from lib.prefetch import Prefetcher
 from lib.merge_batches import main as merge_batches
-from lib.constants import PRUNE_FREQUENCY, TARGET_DICTIONARY_COUNT, TOTAL_WORD_COUNT
+from lib.constants import PRUNE_FREQUENCY, TARGET_DICTIONARY_COUNT, TOTAL_WORD_COUNT, HEAVY_HITTER_ANCHORS, HEAVY_HITTER_CONTEXTS, HEAVY_HITTER_PREDICTIONS, FLUSH_MEMORY_BUDGET, FLUSH_NODE_BUDGET, DEDUP_THRESHOLD, DEDUP_MAX_DOCUMENTS, DOCUMENT_SLICE_WORDS, \
+    CONVERGENCE_TOLERANCE, CONVERGENCE_PATIENCE, CONVERGENCE_SAMPLE_RATE, PREFETCH_DEPTH
 import argparse  # Import argparse for command-line parsing
 
 # Global flag for graceful exit
@@ -27,7 +37,10 @@ def signal_handler(sig, frame):
 # Signal handler for graceful exit
 signal.signal(signal.SIGINT, signal_handler)
 
-DEFAULT_TREE_STORE = {}
+DEFAULT_TREE_STORE = TreeStore()
+
+HEAVY_HITTERS_FILE = 'training/heavy_hitters.pkl'
+PARTIAL_TREE_FILE = 'training/partial_tree.pkl'
 
 async def load_progress(progress_file):
     """Try to load progress using the new method (state_dict) or fall back to the old method."""
@@ -48,19 +61,258 @@ async def load_progress(progress_file):
             return start_position, word_count
     return None, 0  # No progress file found
 
-async def save_position(progress_file, dataset, word_count, tree_store):
+def save_progress(progress_file, dataset, word_count):
     """Always save progress using the new state_dict method."""
     # Always create the state_dict, even if resuming from an old format
-    state_dict = dataset.state_dict()
-    with open(progress_file, 'wb') as f:
+    write_progress(progress_file, dataset.state_dict(), word_count)
+
+def write_progress(progress_file, state_dict, word_count):
+    # Replaced atomically so a crash mid-write leaves the previous position rather than a torn file.
+    with open(progress_file + '.tmp', 'wb') as f:
         pickle.dump((state_dict, word_count), f)
+    os.replace(progress_file + '.tmp', progress_file)
     print(f"Saved state_dict and word count {word_count}")
-    await create_batch(tree_store, TARGET_DICTIONARY_COUNT)
+
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+def parse_size(size):
+    """Bytes from a size like 512M or 2G. A plain number is taken as bytes."""
+    size = size.strip().upper().rstrip("B")
+    multiplier = SIZE_SUFFIXES.get(size[-1:], 1)
+    if size[-1:] in SIZE_SUFFIXES:
+        size = size[:-1]
+    return int(float(size) * multiplier)
+
+def timed(metrics, stage):
+    """Time a block as a stage when metrics are on."""
+    return metrics.time(stage) if metrics is not None else nullcontext()
+
+def count_duplicates(dedup, before, metrics):
+    """Add what the deduplicator skipped since its counters() were before to the metrics."""
+    for counter, value in dedup.counters().items():
+        metrics.count(counter, value - before[counter])
+
+def filter_duplicates(dedup, documents, pbar, metrics=None):
+    """Drop the chunk's duplicate documents. Their words still count as read on the progress bar."""
+    before = dedup.counters()
+    with timed(metrics, "dedup"):
+        documents, words_skipped = dedup.filter(documents)
+    pbar.update(words_skipped)
+    if metrics is not None:
+        count_duplicates(dedup, before, metrics)
+    return documents
+
+def file_document(tree_store, words, start=0, metrics=None):
+    """
+    File a document from word start on, DOCUMENT_SLICE_WORDS at a time so an interrupt doesn't wait for a
+    huge one to finish. Returns the words counted and the word it was interrupted at, or None if it's all filed.
+    """
+    counted = 0
+    while True:
+        stop = start + DOCUMENT_SLICE_WORDS
+        # Every word but the last two anchors a window
+        if stop >= len(words) - 2:
+            return counted + process_document(tree_store, words, metrics, start), None
+        counted += process_document(tree_store, words, metrics, start, stop)
+        start = stop
+        if interrupted:
+            return counted, start
+
+def save_partial_tree(dataset, document, word, word_count, tree_store):
+    """
+    Keep the tree filed since the last batch along with the exact position it runs up to: word of the
+    document-th document of the chunk being filed. --retain picks it back up instead of refiling from the batch.
+    """
+    with open(PARTIAL_TREE_FILE + '.tmp', 'wb') as f:
+        pickle.dump((dataset.state_dict(document), word, word_count, tree_store), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(PARTIAL_TREE_FILE + '.tmp', PARTIAL_TREE_FILE)
+    print(f"Saved the partial tree with word count {word_count}")
+
+def report_duplicates(dedup):
+    if dedup is not None:
+        print(f"Skipped {dedup.documents_skipped} of {dedup.documents_seen} documents as duplicates ({dedup.exact_duplicates} exact, "
+              f"{dedup.near_duplicates} near), {dedup.words_skipped} words")
+
+async def save_position(progress_file, dataset, word_count, tree_store, metrics=None):
+    with timed(metrics, "save_progress"):
+        save_progress(progress_file, dataset, word_count)
+    await create_batch(tree_store, TARGET_DICTIONARY_COUNT, metrics=metrics)
 
     return DEFAULT_TREE_STORE
 
-async def main(retain=False):
+def write_checkpoint(progress_file, state_dict, word_count, tree_store):
+    """Write the batch, then the position it covers, so a saved position never runs ahead of the batches on disk."""
+    asyncio.run(create_batch(tree_store, TARGET_DICTIONARY_COUNT))
+    write_progress(progress_file, state_dict, word_count)
+
+async def save_position_in_background(writer, progress_file, dataset, word_count, tree_store, metrics=None):
+    """Hand the full tree store to a background process to prune and write, and carry on with an empty one."""
+    # Taken now, while it matches exactly what is in tree_store. It is only written once the batch is.
+    state_dict = dataset.state_dict()
+    writer.submit(write_checkpoint, progress_file, state_dict, word_count, tree_store, metrics=metrics)
+
+    return TreeStore()
+
+async def save_heavy_hitters(progress_file, dataset, word_count, tree_store, metrics=None):
+    """Snapshot the heavy hitter summaries and write the dictionary their global counts give."""
+    # The summaries and the dataset state share one file so they can't disagree after a crash.
+    with open(HEAVY_HITTERS_FILE + '.tmp', 'wb') as f:
+        pickle.dump((dataset.state_dict(), word_count, tree_store), f)
+    os.replace(HEAVY_HITTERS_FILE + '.tmp', HEAVY_HITTERS_FILE)
+    save_progress(progress_file, dataset, word_count)
+
+    # Counts cover the whole run, so this replaces the merged dictionary instead of adding another batch.
+    with timed(metrics, "batch_prune"):
+        pruned_tree = create_dictionary(tree_store.to_nested_dict(TARGET_DICTIONARY_COUNT), TARGET_DICTIONARY_COUNT)
+    with timed(metrics, "batch_write"):
+        write_batch(pruned_tree, 'training/dictionary.pkl')
+    print(f"💾 Heavy hitter dictionary saved. Count error bounds: {tree_store.error_bounds()}")
+
+    return tree_store
+
+def check_convergence(monitor, heavy_hitters, metrics=None):
+    """Show the monitor the checkpoints written since it last looked and save it. Returns whether training has converged."""
+    with timed(metrics, "convergence"):
+        if heavy_hitters:
+            # Heavy hitter checkpoints already cover the whole run
+            converged = monitor.observe(load_batch('training/dictionary.pkl'))
+        else:
+            converged = monitor.add_batches('training/batches')
+        monitor.save()
+    print(monitor.summary())
+
+    if metrics is not None and monitor.history:
+        for level, measures in monitor.history[-1].items():
+            for measure, value in measures.items():
+                metrics.gauge(f"convergence_{level}_{measure}", value)
+        metrics.gauge("convergence_steady_checks", monitor.steady)
+    return converged
+
+def sampling_interval(monitor, on_convergence):
+    """Every chunk is filed until training converges. After that, with sampling, one in this many."""
+    if monitor is not None and monitor.converged and on_convergence == 'sample':
+        return round(1 / CONVERGENCE_SAMPLE_RATE)
+    return 1
+
+def report_convergence(monitor, on_convergence):
+    if on_convergence == 'stop':
+        print("Rankings have converged. Stopping.")
+    else:
+        print(f"Rankings have converged. Filing one chunk in {sampling_interval(monitor, on_convergence)} from here on.")
+
+async def train_with_workers(dataset, word_count, pbar, workers, budget, metrics=None, dedup=None, monitor=None, on_convergence='stop'):
+    """Split the document stream across a pool of processes, each filing into its own tree store."""
+    pool = WorkerPool(workers, instrument=metrics is not None)
+
+    # Size budgets apply to each worker's tree store, same as a single process. Each worker holds
+    # roughly a word budget's worth of words between flushes, so the pool flushes every workers times that.
+    if budget.words is not None:
+        budget = FlushBudget(budget.memory, budget.nodes, budget.words * workers)
+    # Words handed to the pool since the last flush. Workers report words filed chunks later, too late to go by.
+    words_submitted = 0
+    # Latest usage each worker reported, kept between flushes since a flush reports the emptied stores.
+    # Queued documents are filed after this, so flushes can come a few chunks late.
+    usages = {}
+
+    def record(progress):
+        nonlocal word_count
+        for worker_id, word_total, counted, usage, stats in progress:
+            pbar.update(word_total)
+            word_count += counted
+            usages[worker_id] = usage
+            if metrics is not None:
+                metrics.observe_usage(usage, f"worker_{worker_id}_tree_store")
+            if stats is not None:
+                # Worker stage times add up across processes, so they can exceed wall time.
+                for stage, (seconds, calls) in stats["stages"].items():
+                    metrics.add_time(f"worker_{stage}", seconds, calls)
+                for counter, value in stats["counters"].items():
+                    metrics.count(counter, value)
+            if metrics is not None:
+                metrics.count("words_read", word_total)
+                metrics.count("words_counted", counted)
+
+    chunks = dataset.iter_chunks()
+    if metrics is not None:
+        chunks = metrics.timed_iter("read", chunks)
+
+    chunk_number = 0
+    sample_every = sampling_interval(monitor, on_convergence)
+
+    try:
+        for documents in chunks:
+            if interrupted:
+                print("Script will terminate when done.")
+                sys.exit(0)
+
+            # The first chunk after starting or resuming is always filed, so sampling never skips the chunk a run resumes in
+            sampled_out = chunk_number % sample_every
+            chunk_number += 1
+            if sampled_out:
+                if metrics is not None:
+                    metrics.count("chunks_sampled_out")
+                continue
+
+            # Deduplicated here rather than in the workers, so a repeat is caught whichever worker saw the original
+            if dedup is not None:
+                documents = filter_duplicates(dedup, documents, pbar, metrics)
+
+            # Blocks while the next worker's queue is full, so time here means the workers are behind
+            words_submitted += sum(len(text.split()) for text in documents)
+            with timed(metrics, "submit"):
+                pool.submit(documents)
+            record(pool.poll())
+
+            if metrics is not None:
+                metrics.count("chunks")
+                metrics.count("documents", len(documents))
+                if isinstance(dataset, Prefetcher):
+                    dataset.record(metrics)
+                metrics.maybe_export()
+
+            # Save position and prune once a word budget's worth of words has been handed out, or any worker's
+            # tree store is over a size budget
+            words_reached = budget.words is not None and words_submitted >= budget.words
+            if words_reached or any(budget.reached(usage, 0) for usage in usages.values()):
+                # Flushing waits for every submitted document, so the saved state matches the batches on disk.
+                with timed(metrics, "flush"):
+                    progress, _ = pool.flush()
+                record(progress)
+                with timed(metrics, "save_progress"):
+                    save_progress('training/processing_progress.txt', dataset, word_count)
+                words_submitted = 0
+                with timed(metrics, "gc"):
+                    gc.collect()
+
+                # The flush waited for every worker's batch, so they can all be read
+                if monitor is not None and not monitor.converged and check_convergence(monitor, False, metrics):
+                    report_convergence(monitor, on_convergence)
+                    if on_convergence == 'stop':
+                        break
+                    sample_every = sampling_interval(monitor, on_convergence)
+
+        # Final batch creation after processing is complete
+        with timed(metrics, "flush"):
+            progress, _ = pool.flush()
+        record(progress)
+    finally:
+        pool.close()
+        if metrics is not None:
+            metrics.export()
+
+async def main(retain=False, workers=1, source='huggingface', corpus=None, heavy_hitters=False, prune_frequency=None, metrics_path=None, metrics_interval=30.0,
+               memory_budget=FLUSH_MEMORY_BUDGET, node_budget=FLUSH_NODE_BUDGET, background_checkpoints=False,
+               dedup_threshold=None, dedup_documents=DEDUP_MAX_DOCUMENTS, save_partial=False, converge=False, convergence_tolerance=CONVERGENCE_TOLERANCE,
+               convergence_patience=CONVERGENCE_PATIENCE, on_convergence='stop', prefetch=PREFETCH_DEPTH):
     tree_store = DEFAULT_TREE_STORE
+    budget = FlushBudget(memory_budget, node_budget, prune_frequency)
+    metrics = Metrics(metrics_path, metrics_interval) if metrics_path else None
+    dedup = Deduplicator(dedup_threshold, dedup_documents) if dedup_threshold else None
+    checkpoint = save_position
+    writer = None
+    if background_checkpoints:
+        writer = BackgroundWriter()
+        checkpoint = partial(save_position_in_background, writer)
     training_path = 'training'
 
     # Clear previous training data if not retaining
@@ -70,76 +322,276 @@ async def main(retain=False):
 
     os.makedirs(training_path, exist_ok=True)
 
-    # Load dataset from Hugging Face datasets
-    datasets.logging.set_verbosity(datasets.logging.WARNING)
-    logging.getLogger('fsspec').setLevel(logging.WARNING)
-    logging.getLogger('urllib3').setLevel(logging.WARNING)
-    dataset = datasets.load_dataset('oscar-corpus/OSCAR-2201', language='en', split='train', streaming=True, trust_remote_code=True)
+    # Load dataset from Hugging Face datasets or local shards
+    dataset = open_source(source, corpus)
+    if prefetch and background_checkpoints:
+        # Each checkpoint forks, and a child forked while the reader thread holds a lock, in the queue or
+        # inside a decompressor, would wait on it forever
+        print("Reading ahead is off with --background-checkpoints.")
+        prefetch = 0
+    if prefetch:
+        # Read ahead in a thread while this one files
+        dataset = Prefetcher(dataset, prefetch)
 
     word_count = 0
-    start_position = 0
     state_dict = None
+    # Words of the first document that were filed before a partial tree was saved
+    resume_word = 0
+
+    if heavy_hitters:
+        tree_store = HeavyHitterStore(HEAVY_HITTER_ANCHORS, HEAVY_HITTER_CONTEXTS, HEAVY_HITTER_PREDICTIONS)
+        checkpoint = save_heavy_hitters
+        # The summaries never outgrow their fixed size, so they are snapshotted on word count alone.
+        budget = FlushBudget(words=prune_frequency or PRUNE_FREQUENCY)
 
     # Load previous progress (either old or new format)
-    if retain:
+    if retain and heavy_hitters and os.path.exists(HEAVY_HITTERS_FILE):
+        with open(HEAVY_HITTERS_FILE, 'rb') as f:
+            state_dict, word_count, tree_store = pickle.load(f)
+        dataset.load_state_dict(state_dict)
+        print(f"Loaded heavy hitter summaries with word count {word_count}")
+    elif retain and not heavy_hitters and os.path.exists(PARTIAL_TREE_FILE):
+        if workers > 1:
+            raise SystemExit(f"{PARTIAL_TREE_FILE} holds one process's tree. Resume without --workers until the next batch is written.")
+        with open(PARTIAL_TREE_FILE, 'rb') as f:
+            state_dict, resume_word, word_count, tree_store = pickle.load(f)
+        # From here on its tree goes out with the next batch, so it must never be loaded a second time
+        os.remove(PARTIAL_TREE_FILE)
+        dataset.load_state_dict(state_dict)
+        print(f"Loaded the partial tree with word count {word_count}")
+    elif retain:
         state_dict, word_count = await load_progress('training/processing_progress.txt')
         if isinstance(state_dict, dict):
             dataset.load_state_dict(state_dict)
         else:
             # Resume using old method; we still skip to start position but will save with state_dict
-            start_position = state_dict if isinstance(state_dict, int) else 0
+            dataset.skip(state_dict if isinstance(state_dict, int) else 0)
+
+    monitor = None
+    if converge:
+        # Picks up the snapshots of earlier runs with --retain. Without it the training directory was just cleared.
+        monitor = ConvergenceMonitor.load(tolerance=convergence_tolerance, patience=convergence_patience)
+        if monitor.converged and on_convergence == 'stop':
+            print("Training has already converged.")
+            return
 
     # Initialize progress bar
     pbar = tqdm(total=TOTAL_WORD_COUNT, unit='word', desc="Processing dataset", position=1)
     pbar.update(word_count)
 
-    # Processing dataset
-    for i, entry in enumerate(dataset.skip(start_position)):
-        if interrupted:
-            print("Script will terminate when done.")
-            sys.exit(0)
+    if workers > 1:
+        await train_with_workers(dataset, word_count, pbar, workers, budget, metrics, dedup, monitor, on_convergence)
+        report_duplicates(dedup)
+        return
 
-        # Extract text and process words
-        text = entry['text']
-        words = text.split()
+    last_checkpoint = word_count
 
-        # Update the progress bar with the number of words processed
-        pbar.update(len(words))
+    chunks = dataset.iter_chunks()
+    if metrics is not None:
+        # Time spent waiting on the source: network for Hugging Face, reading and parsing shards for local
+        chunks = metrics.timed_iter("read", chunks)
 
-        # Replace reserved characters
-        words = [word.replace("score", "\sscore") for word in words]
-        words = [word.replace("prediction", "\sprediction") for word in words]
+    chunk_number = 0
+    sample_every = sampling_interval(monitor, on_convergence)
 
-        # Process words three at a time with a shifting window
-        for j in range(len(words) - 2):
-            word_count += 1
+    try:
+        # Processing dataset
+        for documents in chunks:
+            # The first chunk after starting or resuming is always filed: a partial tree's resume word belongs to its first document
+            sampled_out = chunk_number % sample_every
+            chunk_number += 1
+            if sampled_out:
+                if metrics is not None:
+                    metrics.count("chunks_sampled_out")
+                continue
 
-            # Get context and predictive words
-            context_words = process_context_words(words, j)
-            predictive_words = process_predictive_words(words, j)
+            # Where in the chunk an interrupt stopped filing, as (document, word)
+            stopped_at = None
 
-            if not predictive_words:
-                continue
+            if metrics is None:
+                for index, text in enumerate(documents):
+                    if interrupted:
+                        stopped_at = (index, 0)
+                        break
+
+                    # Extract text and process words
+                    words = text.split()
+
+                    # Update the progress bar with the number of words processed
+                    pbar.update(len(words))
+
+                    if dedup is not None and dedup.is_duplicate(text, words):
+                        continue
+
+                    counted, word = file_document(tree_store, words, resume_word)
+                    resume_word = 0
+                    word_count += counted
+                    if word is not None:
+                        stopped_at = (index, word)
+                        break
+            else:
+                # Same loop, timed. A few perf_counter calls per document next to thousands of dict updates.
+                words_read = 0
+                chunk_word_count = 0
+                split_seconds = 0.0
+                progress_seconds = 0.0
+                dedup_seconds = 0.0
+                dedup_counters = dedup.counters() if dedup is not None else None
+                for index, text in enumerate(documents):
+                    if interrupted:
+                        stopped_at = (index, 0)
+                        break
+
+                    start = time.perf_counter()
+                    words = text.split()
+                    split = time.perf_counter()
+                    pbar.update(len(words))
+                    split_seconds += split - start
+                    progress_seconds += time.perf_counter() - split
+                    words_read += len(words)
 
-            # File the words
-            tree_store = finish_filing(tree_store, context_words, predictive_words)
+                    if dedup is not None:
+                        start = time.perf_counter()
+                        duplicate = dedup.is_duplicate(text, words)
+                        dedup_seconds += time.perf_counter() - start
+                        if duplicate:
+                            continue
 
-            # Save position and prune periodically
-            if (word_count + 1) % PRUNE_FREQUENCY == 0:
-                tree_store = await save_position('training/processing_progress.txt', dataset, word_count, tree_store)
-                gc.collect()
+                    counted, word = file_document(tree_store, words, resume_word, metrics)
+                    resume_word = 0
+                    chunk_word_count += counted
+                    if word is not None:
+                        stopped_at = (index, word)
+                        break
+
+                word_count += chunk_word_count
+                metrics.add_time("split", split_seconds, len(documents))
+                metrics.add_time("progress_bar", progress_seconds, len(documents))
+                if dedup is not None:
+                    metrics.add_time("dedup", dedup_seconds, len(documents))
+                    count_duplicates(dedup, dedup_counters, metrics)
+                metrics.count("chunks")
+                metrics.count("documents", len(documents))
+                metrics.count("words_read", words_read)
+                metrics.count("words_counted", chunk_word_count)
+                metrics.observe_usage(tree_store.usage())
+                if isinstance(dataset, Prefetcher):
+                    dataset.record(metrics)
+                metrics.maybe_export()
+
+            if stopped_at is not None:
+                print("Script will terminate when done.")
+                if save_partial:
+                    # The partial tree carries on from the last batch, so that has to be on disk first
+                    if writer is not None:
+                        writer.wait(metrics)
+                    save_partial_tree(dataset, *stopped_at, word_count, tree_store)
+                sys.exit(0)
+
+            # Save position and prune once the tree store is over budget. Only between chunks, where the dataset
+            # state matches what was filed. The store keeps its counts as it goes, so this check is O(1).
+            if budget.reached(tree_store.usage(), word_count - last_checkpoint):
+                # Once converged there's nothing left to watch for
+                watching = monitor is not None and not monitor.converged
+                converged = False
+                if watching and writer is not None:
+                    # A batch can only be read once its write is done. The checkpoint would wait for it anyway.
+                    writer.wait(metrics)
+                    converged = check_convergence(monitor, heavy_hitters, metrics)
+                with timed(metrics, "checkpoint"):
+                    tree_store = await checkpoint('training/processing_progress.txt', dataset, word_count, tree_store, metrics)
+                last_checkpoint = word_count
+                if watching and writer is None:
+                    converged = check_convergence(monitor, heavy_hitters, metrics)
+                with timed(metrics, "gc"):
+                    gc.collect()
+
+                if converged:
+                    report_convergence(monitor, on_convergence)
+                    if on_convergence == 'stop':
+                        break
+                    sample_every = sampling_interval(monitor, on_convergence)
 
             # Silencing for now. Creating too many problems.
             # Merge batches periodically
             # if (word_count + 1) % (PRUNE_FREQUENCY * 25) == 0:
                 # await merge_batches()
 
-    # Final batch creation after processing is complete
-    await create_batch(tree_store, TARGET_DICTIONARY_COUNT)
+        # In-flight background writes finish before the final batch so both trees are never in memory at once
+        if writer is not None:
+            writer.wait(metrics)
+
+        # Final batch creation after processing is complete
+        with timed(metrics, "checkpoint"):
+            if heavy_hitters:
+                await save_heavy_hitters('training/processing_progress.txt', dataset, word_count, tree_store, metrics)
+            else:
+                await create_batch(tree_store, TARGET_DICTIONARY_COUNT, metrics=metrics)
+
+        report_duplicates(dedup)
+        if metrics is not None:
+            metrics.export()
+    finally:
+        # Interrupted or not, never exit with a checkpoint half written
+        if writer is not None:
+            writer.wait(metrics)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Training script with position retain functionality.')
     parser.add_argument('--retain', action='store_true', help='Retain and resume from last saved position.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of training processes to split the dataset across.')
+    parser.add_argument('--source', choices=sorted(SOURCES), default='huggingface', help='Where to read training documents from.')
+    parser.add_argument('--corpus', nargs='+', help='Shard files or directories (.txt, .jsonl, optionally .gz/.zst) for --source local.')
+    parser.add_argument('--heavy-hitters', action='store_true', help='Keep fixed-size global counts instead of flushing batches, and write training/dictionary.pkl directly.')
+    parser.add_argument('--memory-budget', type=parse_size, default=FLUSH_MEMORY_BUDGET, help='Write a batch once the tree store is estimated to hold this much memory, e.g. 512M or 2G. 0 turns it off.')
+    parser.add_argument('--node-budget', type=int, default=FLUSH_NODE_BUDGET, help='Write a batch once the tree store holds this many words, anchors, contexts and predictions.')
+    parser.add_argument('--prune-frequency', type=int, help=f'Also write a batch every this many words. With --heavy-hitters, words between snapshots (default {PRUNE_FREQUENCY}).')
+    parser.add_argument('--background-checkpoints', action='store_true', help='Prune and write each batch in a forked process while training carries on into a fresh tree store.')
+    parser.add_argument('--dedup', action='store_true', help='Skip documents that exactly or nearly repeat one seen recently.')
+    parser.add_argument('--dedup-threshold', type=float, default=DEDUP_THRESHOLD, help='Estimated word shingle similarity (Jaccard) at which --dedup treats a document as a near duplicate.')
+    parser.add_argument('--dedup-documents', type=int, default=DEDUP_MAX_DOCUMENTS, help='Recent documents --dedup remembers, at roughly 1.3KB each.')
+    parser.add_argument('--save-partial', action='store_true', help=f'When interrupted, save the tree filed since the last batch to {PARTIAL_TREE_FILE} so --retain carries on from the exact word it stopped at.')
+    parser.add_argument('--converge', action='store_true', help='Compare the ranked anchors, contexts and predictions after every checkpoint and stop once they hold steady.')
+    parser.add_argument('--convergence-tolerance', type=float, default=CONVERGENCE_TOLERANCE, help='How far below 1 top-k overlap and Kendall tau between checkpoints may fall and still count as steady.')
+    parser.add_argument('--convergence-patience', type=int, default=CONVERGENCE_PATIENCE, help='Steady checkpoints in a row that count as converged.')
+    parser.add_argument('--on-convergence', choices=['stop', 'sample'], default='stop', help=f'Stop training once converged, or carry on filing one chunk in {round(1 / CONVERGENCE_SAMPLE_RATE)}.')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_DEPTH, help='Chunks of documents to read ahead in a background thread while training files words. 0 reads in between instead. Off with --background-checkpoints.')
+    parser.add_argument('--metrics', help='Time each training stage and export the metrics to this file: Prometheus text if it ends in .prom, JSON otherwise.')
+    parser.add_argument('--metrics-interval', type=float, default=30.0, help='Seconds between metrics exports.')
     args = parser.parse_args()
 
-    asyncio.run(main(retain=args.retain))
\ No newline at end of file
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.source == 'local' and not args.corpus:
+        parser.error('--source local needs --corpus')
+    if args.heavy_hitters and args.workers > 1:
+        parser.error('--heavy-hitters keeps one global summary and can\'t be split across --workers')
+    if args.prune_frequency is not None and args.prune_frequency < 1:
+        parser.error('--prune-frequency must be at least 1')
+    if args.node_budget is not None and args.node_budget < 1:
+        parser.error('--node-budget must be at least 1')
+    if args.background_checkpoints and (args.workers > 1 or args.heavy_hitters):
+        parser.error('--background-checkpoints is for single-process batch training; workers already write their own batches')
+    if args.save_partial and (args.workers > 1 or args.heavy_hitters):
+        parser.error('--save-partial is for single-process batch training; --heavy-hitters already saves its whole summary')
+    if args.background_checkpoints and not hasattr(os, 'fork'):
+        parser.error('--background-checkpoints needs a platform with os.fork')
+    if not 0 < args.dedup_threshold <= 1:
+        parser.error('--dedup-threshold must be above 0 and at most 1')
+    if args.dedup_documents < 1:
+        parser.error('--dedup-documents must be at least 1')
+    if args.prefetch < 0:
+        parser.error('--prefetch must be at least 0')
+    if not 0 <= args.convergence_tolerance < 1:
+        parser.error('--convergence-tolerance must be at least 0 and below 1')
+    if args.convergence_patience < 1:
+        parser.error('--convergence-patience must be at least 1')
+    if not (args.memory_budget or args.node_budget or args.prune_frequency or args.heavy_hitters):
+        parser.error('Set at least one of --memory-budget, --node-budget or --prune-frequency')
+
+    asyncio.run(main(retain=args.retain, workers=args.workers, source=args.source, corpus=args.corpus, heavy_hitters=args.heavy_hitters, prune_frequency=args.prune_frequency,
+                     metrics_path=args.metrics, metrics_interval=args.metrics_interval, memory_budget=args.memory_budget or None, node_budget=args.node_budget,
+                     background_checkpoints=args.background_checkpoints, dedup_threshold=args.dedup_threshold if args.dedup else None,
+                     dedup_documents=args.dedup_documents, save_partial=args.save_partial,
+                     converge=args.converge, convergence_tolerance=args.convergence_tolerance, convergence_patience=args.convergence_patience, on_convergence=args.on_convergence,
+                     prefetch=args.prefetch))
\ No newline at end of file